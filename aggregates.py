@@ -0,0 +1,145 @@
+import heapq
+import threading
+from typing import Optional
+
+
+def _amount(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class ExpenseAggregates:
+    """Running totals of spending, updated in O(1) per expense.
+
+    Totals are the sum of IMPORTE and the number of expenses, kept per day,
+    month, category, category/subcategory and place, plus per-month
+    breakdowns by category, subcategory and place. Rows are added and
+    removed as they appear in (or disappear from) the sheet, so queries
+    never re-read the sheet.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.days = {}
+            self.months = {}
+            self.categories = {}
+            self.subcategories = {}
+            self.places = {}
+            self.month_categories = {}
+            self.month_subcategories = {}
+            self.month_places = {}
+            self.total = [0.0, 0]
+
+    @staticmethod
+    def _bump(table: dict, key, amount: float, count: int):
+        entry = table.get(key)
+        if entry is None:
+            entry = table[key] = [0.0, 0]
+        entry[0] += amount
+        entry[1] += count
+        if entry[1] <= 0:
+            del table[key]
+
+    def _apply(self, row: list, sign: int):
+        date, _, place, category, subcategory, amount = (str(row[0]), row[1], str(row[2]),
+                                                         str(row[3]), str(row[4]), _amount(row[5]))
+        amount *= sign
+        day, month = date[:10], date[:7]
+        with self._lock:
+            self.total[0] += amount
+            self.total[1] += sign
+            self._bump(self.days, day, amount, sign)
+            self._bump(self.months, month, amount, sign)
+            self._bump(self.categories, category, amount, sign)
+            self._bump(self.subcategories, (category, subcategory), amount, sign)
+            self._bump(self.places, place, amount, sign)
+            self._bump(self.month_categories.setdefault(month, {}), category, amount, sign)
+            self._bump(self.month_subcategories.setdefault(month, {}), (category, subcategory), amount, sign)
+            self._bump(self.month_places.setdefault(month, {}), place, amount, sign)
+
+    def add(self, row: list):
+        """Count a sheet row (fecha, producto, lugar, categoria, subcategoria, importe, cantidad)."""
+        self._apply(row, 1)
+
+    def remove(self, row: list):
+        """Undo a row that was edited or deleted in the sheet."""
+        self._apply(row, -1)
+
+    @staticmethod
+    def _entry(entry) -> dict:
+        amount, count = entry if entry else (0.0, 0)
+        return {"total": round(amount, 2), "gastos": count}
+
+    @staticmethod
+    def _top(table: dict, limit: int) -> list:
+        return heapq.nlargest(limit, table.items(), key=lambda item: item[1][0])
+
+    def find_category(self, name: str) -> Optional[str]:
+        """Return the stored category matching ``name`` ignoring case, if any."""
+        wanted = name.strip().casefold()
+        with self._lock:
+            for category in self.categories:
+                if category.casefold() == wanted:
+                    return category
+        return None
+
+    def day(self, day: str) -> dict:
+        with self._lock:
+            return self._entry(self.days.get(day))
+
+    def month(self, month: str, limit: int = 10) -> dict:
+        """Totals for a YYYY-MM month with category and top place breakdowns."""
+        with self._lock:
+            return {
+                "mes": month,
+                **self._entry(self.months.get(month)),
+                "categorias": [
+                    {"categoria": category, **self._entry(entry)}
+                    for category, entry in self._top(self.month_categories.get(month, {}), limit)
+                ],
+                "lugares": [
+                    {"lugar": place, **self._entry(entry)}
+                    for place, entry in self._top(self.month_places.get(month, {}), limit)
+                ],
+            }
+
+    def category(self, category: str, month: Optional[str] = None, limit: int = 10) -> dict:
+        """Totals for a category (all time or one month) with its subcategories."""
+        with self._lock:
+            if month:
+                entry = self.month_categories.get(month, {}).get(category)
+                subcategories = self.month_subcategories.get(month, {})
+            else:
+                entry = self.categories.get(category)
+                subcategories = self.subcategories
+            matching = {sub: value for (cat, sub), value in subcategories.items() if cat == category}
+            return {
+                "categoria": category,
+                "mes": month,
+                **self._entry(entry),
+                "subcategorias": [
+                    {"subcategoria": subcategory, **self._entry(value)}
+                    for subcategory, value in self._top(matching, limit)
+                ],
+            }
+
+    def overview(self, limit: int = 10) -> dict:
+        """All-time totals with top categories and places."""
+        with self._lock:
+            return {
+                **self._entry(self.total),
+                "categorias": [
+                    {"categoria": category, **self._entry(entry)}
+                    for category, entry in self._top(self.categories, limit)
+                ],
+                "lugares": [
+                    {"lugar": place, **self._entry(entry)}
+                    for place, entry in self._top(self.places, limit)
+                ],
+            }
@@ -0,0 +1,576 @@
+#!/usr/bin/env python3
+"""
+Benchmark sin conexión del flujo mensaje -> fila de la hoja
+
+Reemplaza Google Sheets por una hoja falsa en memoria (con latencia y fallos
+configurables) y reproduce, dentro del mismo proceso, Updates sintéticos de
+Telegram y POSTs a /add_expense. También mide, en procesos nuevos, cuánto
+tarda en importarse el bot y en responder /health tras arrancar, y la latencia
+de la primera escritura tras un periodo inactivo contra un Google falso local
+(token que caduca, conexiones que se cierran), con la sesión sin gestionar y con
+GoogleSession. Informa rendimiento, latencias p50/p95/p99 y
+memoria de cada etapa, y compara con una línea base guardada para detectar
+regresiones (termina con código 1 si las hay).
+
+Uso:
+    python benchmark.py --save-baseline
+    python benchmark.py
+    python benchmark.py --storage direct --latency 0.2 --failure-rate 0.05
+    python benchmark.py --startup-runs 0   # sin medir el arranque
+    python benchmark.py --idle-runs 0      # sin medir la escritura tras inactividad
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import statistics
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from load_test import percentile
+
+DEFAULT_BASELINE = os.path.join("data", "benchmark_baseline.json")
+
+# Settings that must match for two runs to be comparable
+CONFIG_KEYS = ("storage", "messages", "concurrency", "chats", "latency", "reply_latency", "failure_rate", "seed",
+               "tracemalloc")
+
+
+def fake_credentials() -> str:
+    """Service account JSON with a throwaway key; nothing is ever sent to Google."""
+    import rsa
+
+    _, private_key = rsa.newkeys(512)
+    return json.dumps({
+        "type": "service_account",
+        "project_id": "benchmark",
+        "private_key_id": "benchmark",
+        "private_key": private_key.save_pkcs1().decode(),
+        "client_email": "benchmark@benchmark.iam.gserviceaccount.com",
+        "client_id": "0",
+        "token_uri": "https://oauth2.googleapis.com/token"
+    })
+
+
+def configure_environment(args, workdir):
+    """Point every local store at a temporary directory and lift the Google API budgets."""
+    os.environ.setdefault("BOT_TOKEN", "123456:benchmark")
+    os.environ.setdefault("GOOGLE_CREDS", fake_credentials())
+    os.environ["OUTBOX_PATH"] = os.path.join(workdir, "outbox.db") if args.storage == "outbox" else ""
+    os.environ["TENANTS_PATH"] = os.path.join(workdir, "tenants.db")
+    os.environ["IDEMPOTENCY_PATH"] = os.path.join(workdir, "idempotency.db")
+    os.environ["SHEET_CACHE_PATH"] = os.path.join(workdir, "sheet_cache.json")
+    os.environ["GOOGLE_READS_PER_MINUTE"] = "1000000000"
+    os.environ["GOOGLE_WRITES_PER_MINUTE"] = "1000000000"
+
+
+def api_error(status: int):
+    """Build a gspread APIError like the ones Google returns."""
+    import requests
+    from gspread.exceptions import APIError
+
+    response = requests.Response()
+    response.status_code = status
+    response._content = json.dumps({
+        "error": {"code": status, "message": "Injected by benchmark", "status": "UNAVAILABLE"}
+    }).encode()
+    return APIError(response)
+
+
+class FakeWorksheet:
+    """In-memory worksheet with per-call latency and randomly injected 503 errors."""
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.rows = []
+        self.calls = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def append_rows(self, rows, **kwargs):
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls += 1
+            if self.random.random() < self.failure_rate:
+                self.failures += 1
+                raise api_error(503)
+            self.rows.extend(rows)
+
+    def append_row(self, row, **kwargs):
+        self.append_rows([row])
+
+    def get(self, range_name, **kwargs):
+        time.sleep(self.latency)
+        return []
+
+
+def expense_text(number: int) -> str:
+    return f"Producto {number}\nSupermercado\nComida\nProductos básicos\n{100 + number % 900}\n{1 + number % 3}"
+
+
+def make_update(bot, number: int, chats: int):
+    """Synthetic Telegram text message update from one of ``chats`` chats."""
+    from telegram import Update
+
+    chat_id = 1000 + number % chats
+    return Update.de_json({
+        "update_id": number + 1,
+        "message": {
+            "message_id": number + 1,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Benchmark"},
+            "text": expense_text(number)
+        }
+    }, bot)
+
+
+def make_bot(latency: float = 0.0):
+    """Telegram Bot whose replies take ``latency`` seconds and are counted instead of sent."""
+    from telegram import Bot
+
+    class RecordingBot(Bot):
+        replies = 0
+        confirmations = 0
+
+        async def send_message(self, *args, **kwargs):
+            await asyncio.sleep(latency)
+            text = kwargs.get("text", args[1] if len(args) > 1 else "")
+            RecordingBot.replies += 1
+            # Queued confirmations of one chat arrive merged into one message
+            RecordingBot.confirmations += max(1, text.count("Gasto registrado"))
+
+    return RecordingBot("123456:benchmark")
+
+
+def summarize(name, latencies, elapsed, errors=0, **extra):
+    result = {
+        "scenario": name,
+        "operations": len(latencies),
+        "errors": errors,
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(statistics.median(latencies) * 1000, 3) if latencies else 0.0,
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "max_rss_mb": round(max_rss_mb(), 1),
+    }
+    result.update(extra)
+    return result
+
+
+def max_rss_mb() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return usage / (1024 * 1024) if sys.platform == "darwin" else usage / 1024
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+
+def wait_for_sheet(bot, timeout=120.0):
+    """Wait until the outbox is drained and return the seconds it took."""
+    started = time.perf_counter()
+    if not bot.outbox:
+        return 0.0
+    bot.replayer.wake()
+    deadline = started + timeout
+    while bot.outbox.depth() and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    return round(time.perf_counter() - started, 3)
+
+
+def bench_parse(bot, args):
+    texts = [expense_text(number) for number in range(args.messages)]
+    latencies = []
+    started = time.perf_counter()
+    for text in texts:
+        latency, _ = timed(bot._parse_expense_message, text)
+        latencies.append(latency)
+    return summarize("parse", latencies, time.perf_counter() - started)
+
+
+def bench_log_expense(bot, sheet, args):
+    expenses = [bot._parse_expense_message(expense_text(number)) for number in range(args.messages)]
+    rows_before = len(sheet.rows)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda expense: timed(bot._log_expense_to_sheet, expense), expenses))
+    elapsed = time.perf_counter() - started
+    drain = wait_for_sheet(bot)
+    return summarize(
+        "log_expense", [latency for latency, _ in results], elapsed,
+        errors=sum(1 for _, ok in results if not ok),
+        drain_seconds=drain, sheet_rows=len(sheet.rows) - rows_before
+    )
+
+
+def bench_telegram(bot_module, sheet, args, queued=False):
+    """Updates handled per second with replies awaited inline or queued through the ReplyScheduler."""
+    from update_processor import PerChatUpdateProcessor
+    from outbound import ReplyScheduler
+
+    telegram_bot = make_bot(args.reply_latency)
+    # Message IDs of their own, or the idempotency index would skip them as redeliveries of the inline run
+    first = args.messages if queued else 0
+    updates = [make_update(telegram_bot, number, args.chats) for number in range(first, first + args.messages)]
+    processor = PerChatUpdateProcessor(args.concurrency)
+    bot = bot_module.init_bot()
+    rows_before = len(sheet.rows)
+    latencies = []
+    delivery = {}
+
+    async def handle(update):
+        started = time.perf_counter()
+        await bot_module.handle_expense_message(update, None)
+        latencies.append(time.perf_counter() - started)
+
+    async def run():
+        if queued:
+            bot.replies = ReplyScheduler(telegram_bot.send_message)
+            bot.replies.start()
+        await asyncio.gather(*(processor.process_update(update, handle(update)) for update in updates))
+        delivery["handled"] = time.perf_counter()
+        if queued:
+            await bot.replies.close(timeout=120)
+            bot.replies = None
+
+    started = time.perf_counter()
+    asyncio.run(run())
+    elapsed = delivery["handled"] - started
+    replies_seconds = round(time.perf_counter() - started, 3)
+    drain = wait_for_sheet(bot)
+    return summarize(
+        "telegram_update_queued" if queued else "telegram_update", latencies, elapsed,
+        errors=args.messages - type(telegram_bot).confirmations,
+        drain_seconds=drain, sheet_rows=len(sheet.rows) - rows_before,
+        messages_sent=type(telegram_bot).replies, replies_seconds=replies_seconds
+    )
+
+
+def bench_api(bot, sheet, args):
+    import keep_alive
+
+    local = threading.local()
+    rows_before = len(sheet.rows)
+
+    def post(number):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = keep_alive.app.test_client()
+        body = {
+            "producto": f"Producto {number}", "lugar": "Supermercado", "categoria": "Comida",
+            "subcategoria": "Productos básicos", "importe": 100 + number % 900, "cantidad": 1
+        }
+        started = time.perf_counter()
+        response = client.post("/add_expense", json=body)
+        return time.perf_counter() - started, response.status_code == 200
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(post, range(args.messages)))
+    elapsed = time.perf_counter() - started
+    drain = wait_for_sheet(bot)
+    return summarize(
+        "api_add_expense", [latency for latency, _ in results], elapsed,
+        errors=sum(1 for _, ok in results if not ok),
+        drain_seconds=drain, sheet_rows=len(sheet.rows) - rows_before
+    )
+
+
+def bench_startup(args, workdir):
+    """Import time of the bot module and time until a fresh bot process answers /health."""
+    import socket
+    import subprocess
+    import urllib.request
+    from http.server import ThreadingHTTPServer
+    from fake_telegram import FakeTelegram, make_handler
+
+    # The bot polls a local fake Bot API, so the process keeps running and nothing leaves the machine
+    telegram = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(FakeTelegram(0, 1)))
+    threading.Thread(target=telegram.serve_forever, daemon=True).start()
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    env = dict(
+        os.environ,
+        HTTP_SERVER="builtin",
+        TELEGRAM_MODE="polling",
+        TELEGRAM_BASE_URL=f"http://127.0.0.1:{telegram.server_address[1]}/bot",
+        OUTBOX_PATH=os.path.join(workdir, "startup", "outbox.db"),
+        TENANTS_PATH=os.path.join(workdir, "startup", "tenants.db"),
+        SHEET_CACHE_PATH=os.path.join(workdir, "startup", "sheet_cache.json"),
+        IDEMPOTENCY_PATH=os.path.join(workdir, "startup", "idempotency.db")
+    )
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+    import_times = []
+    for _ in range(args.startup_runs):
+        output = subprocess.run(
+            [sys.executable, "-c",
+             "import time; started = time.perf_counter(); import expense_bot; print(time.perf_counter() - started)"],
+            cwd=directory, env=env, capture_output=True, text=True, check=True
+        ).stdout
+        import_times.append(float(output.split()[-1]))
+
+    latencies = []
+    errors = 0
+    started_all = time.perf_counter()
+    for _ in range(args.startup_runs):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        started = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "expense_bot.py"], cwd=directory, env=dict(env, PORT=str(port)),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            while process.poll() is None and time.perf_counter() - started < 60:
+                try:
+                    with opener.open(f"http://127.0.0.1:{port}/health", timeout=1) as response:
+                        if response.status == 200:
+                            latencies.append(time.perf_counter() - started)
+                            break
+                except OSError:
+                    time.sleep(0.005)
+            else:
+                errors += 1
+        finally:
+            process.kill()
+            process.wait()
+
+    telegram.shutdown()
+    return summarize(
+        "startup", latencies, time.perf_counter() - started_all, errors=errors,
+        import_ms=round(statistics.median(import_times) * 1000, 1)
+    )
+
+
+def fake_google(token_latency: float, connect_latency: float, idle_timeout: float, token_lifetime: int):
+    """Local stand-in for Google's token and Sheets endpoints.
+
+    Tokens take ``token_latency`` to issue and live ``token_lifetime``
+    seconds; a new connection costs ``connect_latency`` (the TLS handshake)
+    and connections idle for ``idle_timeout`` seconds are closed, as Google's
+    front end does.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        timeout = idle_timeout
+
+        def log_message(self, format, *args):
+            pass
+
+        def setup(self):
+            time.sleep(connect_latency)
+            super().setup()
+
+        def _reply(self, status, payload=b""):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(payload)
+
+        def do_HEAD(self):
+            self._reply(404)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if self.path == "/token":
+                time.sleep(token_latency)
+                payload = {"access_token": f"token-{time.time()}", "expires_in": token_lifetime, "token_type": "Bearer"}
+                self._reply(200, json.dumps(payload).encode())
+            else:
+                self._reply(200, json.dumps({"updates": {"updatedRows": 1}, "size": len(body)}).encode())
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_idle_write(args):
+    """Latency of the first Sheets write after an idle period, without and with GoogleSession."""
+    from google.auth.transport.requests import AuthorizedSession
+    from google.oauth2.service_account import Credentials
+    from google_session import GoogleSession
+
+    # google-auth refreshes a token on demand once less than 225 s are left; tokens here become
+    # stale one second after being issued, so every idle period ends with an expired token
+    idle = 2.0
+    server = fake_google(token_latency=0.2, connect_latency=0.1, idle_timeout=idle / 2, token_lifetime=226)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    info = dict(json.loads(fake_credentials()), token_uri=f"{base_url}/token")
+    scopes = ["https://www.googleapis.com/auth/spreadsheets"]
+    append_url = f"{base_url}/v4/spreadsheets/benchmark/values/A1:append"
+    row = {"values": [["2025-06-01 10:00:00", "Pan", "Panadería", "Comida", "Básicos", 1200, 1]]}
+
+    def measure(name, session):
+        session.post(append_url, json=row)
+        latencies = []
+        started_all = time.perf_counter()
+        for _ in range(args.idle_runs):
+            time.sleep(idle)
+            started = time.perf_counter()
+            session.post(append_url, json=row)
+            latencies.append(time.perf_counter() - started)
+        return summarize(name, latencies, time.perf_counter() - started_all)
+
+    results = [measure("idle_write_lazy", AuthorizedSession(Credentials.from_service_account_info(info, scopes=scopes)))]
+
+    managed = GoogleSession(info, scopes, refresh_margin=225.5, keepalive_interval=idle / 4,
+                            keepalive_url=f"{base_url}/")
+    managed.start()
+    results.append(measure("idle_write_managed", managed.session))
+    managed.close()
+    server.shutdown()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return the regressions of ``results`` against ``baseline`` as readable strings."""
+    previous = {result["scenario"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get(result["scenario"])
+        if not before:
+            continue
+        if before["throughput"] and result["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append(f"{result['scenario']}: throughput {before['throughput']} -> {result['throughput']}/s")
+        for key in ("p95_ms", "p99_ms"):
+            # Sub-millisecond tails are mostly scheduler noise
+            if before[key] >= 1 and result[key] > before[key] * (1 + tolerance):
+                regressions.append(f"{result['scenario']}: {key} {before[key]} -> {result[key]}")
+        if result["errors"] > before["errors"]:
+            regressions.append(f"{result['scenario']}: errors {before['errors']} -> {result['errors']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sin conexión del Bot de Gastos")
+    parser.add_argument("--storage", choices=["outbox", "direct"], default="outbox",
+                        help="outbox: SQLite + replayer; direct: escritura agrupada esperando la hoja")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05, help="Segundos por llamada a la hoja falsa")
+    parser.add_argument("--reply-latency", type=float, default=0.05, help="Segundos por mensaje enviado a Telegram")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fracción de escrituras que fallan con 503")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--startup-runs", type=int, default=3, help="Arranques medidos en procesos nuevos (0 para omitir)")
+    parser.add_argument("--idle-runs", type=int, default=5, help="Escrituras medidas tras un periodo inactivo (0 para omitir)")
+    parser.add_argument("--tracemalloc", action="store_true", help="Medir también el pico de memoria de Python por etapa (más lento)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Variación aceptada respecto a la línea base")
+    parser.add_argument("--verbose", action="store_true", help="Mostrar los logs del bot")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="expense-benchmark-")
+    configure_environment(args, workdir)
+
+    # Configured before the bot module does, so its per-expense logs stay quiet
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO if args.verbose else logging.CRITICAL
+    )
+    import expense_bot as bot_module
+
+    bot = bot_module.init_bot()
+    sheet = FakeWorksheet(args.latency, args.failure_rate, args.seed)
+    bot.sheet = sheet
+    # Injected failures are retried quickly so the run measures the pipeline, not the backoff
+    bot.quota.base_delay = 0.01
+    bot.quota.max_delay = 0.1
+    if bot.mirror is not None:
+        bot.mirror.load()
+
+    scenarios = [
+        ("parse", lambda: bench_parse(bot, args)),
+        ("log_expense", lambda: bench_log_expense(bot, sheet, args)),
+        ("telegram_update", lambda: bench_telegram(bot_module, sheet, args)),
+        ("telegram_update_queued", lambda: bench_telegram(bot_module, sheet, args, queued=True)),
+        ("api_add_expense", lambda: bench_api(bot, sheet, args)),
+    ]
+    if args.startup_runs:
+        scenarios.append(("startup", lambda: bench_startup(args, workdir)))
+    if args.idle_runs:
+        scenarios.append(("idle_write", lambda: bench_idle_write(args)))
+
+    results = []
+    for _, run in scenarios:
+        if args.tracemalloc:
+            tracemalloc.start()
+        scenario_results = run()
+        if isinstance(scenario_results, dict):
+            scenario_results = [scenario_results]
+        if args.tracemalloc:
+            peak = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 2)
+            for result in scenario_results:
+                result["python_peak_mb"] = peak
+            tracemalloc.stop()
+        for result in scenario_results:
+            results.append(result)
+            print(json.dumps(result))
+
+    bot.writer.close()
+    if bot.replayer:
+        bot.replayer.close()
+
+    config = {key: getattr(args, key) for key in CONFIG_KEYS}
+    report = {
+        "config": config,
+        "python": platform.python_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "sheet": {"calls": sheet.calls, "failures": sheet.failures, "rows": len(sheet.rows)},
+        "results": results
+    }
+    print(json.dumps({"sheet": report["sheet"]}))
+
+    if args.save_baseline:
+        directory = os.path.dirname(args.baseline)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 Línea base guardada en {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"ℹ️ No hay línea base en {args.baseline}; usa --save-baseline para crearla")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("config") != config:
+        print(f"⚠️ La línea base usa otra configuración ({baseline.get('config')}); no se compara")
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("❌ Regresiones respecto a la línea base:")
+        for regression in regressions:
+            print(f"   {regression}")
+        return 1
+    print("✅ Sin regresiones respecto a la línea base")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
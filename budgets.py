@@ -0,0 +1,274 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Monthly budgets per category or category/subcategory; empty disables budgets
+BUDGETS_PATH = os.getenv("BUDGETS_PATH", os.path.join("data", "budgets.db"))
+
+# Percentages of a budget at which the chat is warned, e.g. "80,100"
+BUDGET_ALERT_THRESHOLDS = [float(value) for value in os.getenv("BUDGET_ALERT_THRESHOLDS", "80,100").split(",") if value.strip()]
+
+# Rows recorded while the totals are rebuilt are matched against the rows read dated up to this
+# many seconds before the rebuild started, so an expense is not counted twice
+REBUILD_OVERLAP = 300
+
+
+def _amount(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def budget_key(category: str, subcategory: Optional[str] = None) -> Tuple[str, str]:
+    """Case-insensitive key of a budget; an empty subcategory covers the whole category."""
+    return category.strip().casefold(), (subcategory or "").strip().casefold()
+
+
+def current_month() -> str:
+    return datetime.now().strftime("%Y-%m")
+
+
+class BudgetStore:
+    """Persistent budgets (SQLite in WAL mode), shared by the bot and the web API.
+
+    ``version()`` changes whenever a budget is set or removed through any
+    connection, so readers can keep the budgets in memory and reload them
+    only after a change.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._changes = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS budgets ("
+            " category_key TEXT NOT NULL,"
+            " subcategory_key TEXT NOT NULL,"
+            " category TEXT NOT NULL,"
+            " subcategory TEXT NOT NULL,"
+            " amount REAL NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " PRIMARY KEY (category_key, subcategory_key))"
+        )
+
+    def set(self, category: str, subcategory: Optional[str], amount: float):
+        category_key, subcategory_key = budget_key(category, subcategory)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO budgets (category_key, subcategory_key, category, subcategory, amount, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(category_key, subcategory_key) DO UPDATE SET"
+                " category = excluded.category, subcategory = excluded.subcategory,"
+                " amount = excluded.amount, updated_at = excluded.updated_at",
+                (category_key, subcategory_key, category.strip(), (subcategory or "").strip(), amount, time.time())
+            )
+            self._changes += 1
+
+    def remove(self, category: str, subcategory: Optional[str] = None) -> bool:
+        """Remove a budget; False when there was none."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM budgets WHERE category_key = ? AND subcategory_key = ?", budget_key(category, subcategory)
+            )
+            self._changes += 1
+            return cursor.rowcount > 0
+
+    def all(self) -> List[Tuple[str, str, float]]:
+        """Every budget as (category, subcategory, amount); subcategory is '' for a whole category."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT category, subcategory, amount FROM budgets ORDER BY category_key, subcategory_key"
+            ).fetchall()
+
+    def version(self) -> Tuple[int, int]:
+        # data_version only moves for commits made by other connections
+        with self._lock:
+            return self._conn.execute("PRAGMA data_version").fetchone()[0], self._changes
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class BudgetTracker:
+    """Spending of the current month per category and category/subcategory, checked against budgets.
+
+    ``record(rows)`` is called once per committed expense row and costs two
+    dictionary updates per row, so every expense is checked without reading
+    the sheet. It returns the budgets whose alert thresholds the rows just
+    crossed; each threshold is crossed once per month, as totals only grow.
+    Totals start over when the clock moves into a new month, rows dated in
+    any other month are left out, and ``rebuild(pages)`` loads the month's
+    rows once at startup.
+    """
+
+    def __init__(self, store: BudgetStore, thresholds: Iterable[float] = BUDGET_ALERT_THRESHOLDS):
+        self.store = store
+        self.thresholds = sorted(thresholds)
+        self._lock = threading.Lock()
+        self._budgets: Dict[Tuple[str, str], Tuple[str, str, float]] = {}
+        self._version = None
+        self.month = current_month()
+        self.categories: Dict[str, float] = {}
+        self.subcategories: Dict[Tuple[str, str], float] = {}
+        # Rows recorded while a rebuild is reading, or None when no rebuild is running
+        self._recorded: Optional[list] = None
+        self.loaded = False
+        self.alerts = 0
+
+    def _reload(self):
+        # Callers hold the lock
+        version = self.store.version()
+        if version != self._version:
+            self._budgets = {
+                budget_key(category, subcategory): (category, subcategory, amount)
+                for category, subcategory, amount in self.store.all()
+            }
+            self._version = version
+
+    def _roll(self):
+        """Start the totals over once the clock is in a newer month."""
+        # Only the clock moves the month: a row dated in the future must not wipe the current totals
+        month = current_month()
+        if month > self.month:
+            self.month = month
+            self.categories = {}
+            self.subcategories = {}
+
+    def _crossed(self, key: Tuple[str, str], before: float, after: float) -> Optional[dict]:
+        budget = self._budgets.get(key)
+        if budget is None:
+            return None
+        category, subcategory, limit = budget
+        crossed = [threshold for threshold in self.thresholds if before < limit * threshold / 100 <= after]
+        if not crossed:
+            return None
+        return {
+            "categoria": category,
+            "subcategoria": subcategory or None,
+            "mes": self.month,
+            "presupuesto": limit,
+            "gastado": round(after, 2),
+            "umbral": crossed[-1],
+        }
+
+    def _add(self, row: list, alerts: Optional[dict] = None):
+        # Callers hold the lock and have rolled the month
+        if str(row[0])[:7] != self.month:
+            return
+        category_key, subcategory_key = budget_key(str(row[3]), str(row[4]))
+        amount = _amount(row[5])
+
+        before = self.categories.get(category_key, 0.0)
+        self.categories[category_key] = before + amount
+        sub_before = self.subcategories.get((category_key, subcategory_key), 0.0)
+        self.subcategories[(category_key, subcategory_key)] = sub_before + amount
+
+        if alerts is not None:
+            for key, spent in (((category_key, ""), before), ((category_key, subcategory_key), sub_before)):
+                alert = self._crossed(key, spent, spent + amount)
+                if alert is not None:
+                    alerts[key] = alert
+
+    def record(self, rows: List[list]) -> List[dict]:
+        """Add committed rows (fecha, producto, lugar, categoria, subcategoria, importe, ...) to the totals.
+
+        Returns one alert per budget that went over a threshold, with the
+        highest threshold crossed.
+        """
+        alerts = {}
+        with self._lock:
+            self._reload()
+            self._roll()
+            for row in rows:
+                self._add(row, alerts)
+            if self._recorded is not None:
+                self._recorded.extend(rows)
+            self.alerts += len(alerts)
+        return list(alerts.values())
+
+    @staticmethod
+    def _row_key(row: list) -> tuple:
+        return str(row[0]), str(row[1]), str(row[2]), str(row[3]), str(row[4]), _amount(row[5])
+
+    def rebuild(self, pages: Iterable[List[list]]):
+        """Replace the totals with the current month's rows, read page by page.
+
+        Rows recorded while the pages are read may or may not be among them;
+        those already read are not counted a second time.
+        """
+        with self._lock:
+            month = current_month()
+            self._recorded = []
+        overlap_start = (datetime.now() - timedelta(seconds=REBUILD_OVERLAP)).strftime("%Y-%m-%d %H:%M:%S")
+
+        categories: Dict[str, float] = {}
+        subcategories: Dict[Tuple[str, str], float] = {}
+        recent = Counter()
+        try:
+            for page in pages:
+                for row in page:
+                    date = str(row[0])
+                    if date[:7] != month:
+                        continue
+                    category_key, subcategory_key = budget_key(str(row[3]), str(row[4]))
+                    amount = _amount(row[5])
+                    categories[category_key] = categories.get(category_key, 0.0) + amount
+                    subcategories[(category_key, subcategory_key)] = subcategories.get((category_key, subcategory_key), 0.0) + amount
+                    if date >= overlap_start:
+                        recent[self._row_key(row)] += 1
+        except Exception:
+            with self._lock:
+                self._recorded = None
+            raise
+
+        with self._lock:
+            recorded, self._recorded = self._recorded, None
+            self.month, self.categories, self.subcategories = month, categories, subcategories
+            for row in recorded:
+                key = self._row_key(row)
+                if recent[key] > 0:
+                    recent[key] -= 1
+                else:
+                    self._add(row)
+            self.loaded = True
+
+    def status(self) -> List[dict]:
+        """Every budget with this month's spending and the share of it used."""
+        with self._lock:
+            self._reload()
+            self._roll()
+            result = []
+            for (category_key, subcategory_key), (category, subcategory, limit) in sorted(self._budgets.items()):
+                if subcategory_key:
+                    spent = self.subcategories.get((category_key, subcategory_key), 0.0)
+                else:
+                    spent = self.categories.get(category_key, 0.0)
+                result.append({
+                    "categoria": category,
+                    "subcategoria": subcategory or None,
+                    "presupuesto": limit,
+                    "gastado": round(spent, 2),
+                    "porcentaje": round(spent / limit * 100, 1) if limit else None,
+                })
+            return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "month": self.month,
+                "budgets": len(self._budgets),
+                "loaded": self.loaded,
+                "alerts": self.alerts,
+            }
@@ -0,0 +1,102 @@
+import io
+import csv
+import json
+import codecs
+from typing import BinaryIO, Iterator, Tuple
+
+# Bytes read from the request body at a time
+READ_SIZE = 64 * 1024
+
+# Largest single JSON element accepted, so a malformed body cannot grow the buffer unbounded
+MAX_ELEMENT_SIZE = 1024 * 1024
+
+
+class BulkFormatError(ValueError):
+    """Raised when the body cannot be split into records at all."""
+
+
+def iter_ndjson(stream: BinaryIO) -> Iterator[Tuple[int, object]]:
+    """Yield (row number, parsed object or ValueError) for each line of an NDJSON body."""
+    number = 0
+    for raw_line in stream:
+        line = raw_line.strip()
+        if not line:
+            continue
+        number += 1
+        try:
+            yield number, json.loads(line)
+        except ValueError as e:
+            yield number, ValueError(f"JSON inválido: {e}")
+
+
+def iter_csv(stream: BinaryIO) -> Iterator[Tuple[int, object]]:
+    """Yield (row number, dict) for each data row of a CSV body with a header line."""
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    reader = csv.DictReader(text)
+    for number, record in enumerate(reader, start=1):
+        yield number, record
+
+
+def iter_json_array(stream: BinaryIO) -> Iterator[Tuple[int, object]]:
+    """Yield (row number, object) for each element of a JSON array without loading it whole."""
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    started = False
+    number = 0
+    eof = False
+
+    def fill():
+        nonlocal buffer, position, eof
+        chunk = stream.read(READ_SIZE)
+        if not chunk:
+            eof = True
+            return
+        buffer = buffer[position:] + text_decoder.decode(chunk)
+        position = 0
+
+    def skip_whitespace():
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position < len(buffer) or eof:
+                return
+            fill()
+
+    skip_whitespace()
+    if position >= len(buffer) or buffer[position] != "[":
+        raise BulkFormatError("Se esperaba un arreglo JSON")
+    position += 1
+
+    while True:
+        skip_whitespace()
+        if position >= len(buffer):
+            raise BulkFormatError("Arreglo JSON incompleto")
+
+        if buffer[position] == "]":
+            return
+        if started:
+            if buffer[position] != ",":
+                raise BulkFormatError(f"Se esperaba ',' después del elemento {number}")
+            position += 1
+            skip_whitespace()
+
+        # Decode the next element, reading more of the body until it is complete
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+                # A number at the end of the buffer may continue in the next chunk
+                if end == len(buffer) and not eof:
+                    raise ValueError("incomplete")
+                break
+            except ValueError:
+                if eof or len(buffer) - position > MAX_ELEMENT_SIZE:
+                    raise BulkFormatError(f"JSON inválido en el elemento {number + 1}")
+                fill()
+
+        position = end
+        started = True
+        number += 1
+        yield number, value
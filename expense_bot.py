@@ -1,22 +1,111 @@
+from __future__ import annotations
+
 import os
+import re
 import json
+import time
+import atexit
+import signal
+import asyncio
 import logging
+import functools
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Optional
-
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext
-from keep_alive import keep_alive, set_bot_instance
-
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+from typing import TYPE_CHECKING, Optional, Tuple
+
+from keep_alive import keep_alive, set_bot_instance, set_webhook_handler, WEBHOOK_PATH
+from sheet_writer import BatchedSheetWriter
+from outbox import ExpenseOutbox, OutboxReplayer, expense_row, OUTBOX_PATH
+from quota import QuotaScheduler, classify_error, QUOTA_EXCEEDED, NOT_FOUND
+from sheet_mirror import SheetMirror
+from partitions import SheetPartitions, PartitionedMirror, append_cells_request, SHEET_PARTITION
+from aggregates import ExpenseAggregates
+from budgets import BudgetStore, BudgetTracker, BUDGETS_PATH
+from metrics import (PARSE, PARSE_FAILURES, SHEET_RESOLVE, SHEET_APPEND, OUTBOX_APPEND, STORE_APPEND, ROWS_APPENDED,
+                     TELEGRAM_UPDATE, TELEGRAM_REPLY, start_http_server as start_metrics_server)
+from export import iter_sheet_pages, filter_pages, EXPORT_PAGE_SIZE
+from idempotency import IdempotencyIndex, IDEMPOTENCY_PATH
+from log_pipeline import setup_logging, elapsed_ms
+from outbound import ReplyScheduler
+from recurring import (RecurringStore, RecurringRunner, parse_frequency, RECURRING_PATH,
+                       RECURRING_CHECK_INTERVAL, RECURRING_CATCHUP_INTERVAL)
+from storage import (SheetsBackend, SQLiteBackend, STORAGE_BACKEND, STORAGE_BACKENDS, EXPENSES_DB_PATH,
+                     STORAGE_SYNC_INTERVAL, STORAGE_PAGE_SIZE)
+from tenants import TenantRegistry, TenantSheets, open_first_worksheet, parse_spreadsheet_id, TENANTS_PATH
+
+# gspread, google-auth and telegram are imported where they are first needed, so
+# importing this module is fast and the web server answers before they are loaded
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import Application, CallbackContext
+
+# Configure logging: handlers only enqueue records, a background thread writes them as JSON
+setup_logging()
 logger = logging.getLogger(__name__)
 
+# Write-behind batching for sheet appends
+SHEETS_BATCH_SIZE = int(os.getenv("SHEETS_BATCH_SIZE", "50"))
+SHEETS_FLUSH_INTERVAL = float(os.getenv("SHEETS_FLUSH_INTERVAL", "0.5"))
+SHEETS_QUEUE_SIZE = int(os.getenv("SHEETS_QUEUE_SIZE", "1000"))
+SHEETS_COMMIT_TIMEOUT = float(os.getenv("SHEETS_COMMIT_TIMEOUT", "30"))
+
+# Worker threads that run blocking gspread calls off the event loop
+SHEETS_WORKERS = int(os.getenv("SHEETS_WORKERS", "4"))
+
+# Durable local outbox (OUTBOX_PATH, see outbox.py); empty path writes straight to the sheet
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "200"))
+OUTBOX_REPLAY_INTERVAL = float(os.getenv("OUTBOX_REPLAY_INTERVAL", "1.0"))
+
+# "builtin" runs Flask's server in a thread of this process; "gunicorn" means the
+# web API is served by gunicorn workers (see start.sh) that share the outbox
+HTTP_SERVER = os.getenv("HTTP_SERVER", "builtin")
+
+# Seconds between checks for expenses written by the gunicorn workers, which are then added to the budgets
+WORKER_ROWS_INTERVAL = float(os.getenv("WORKER_ROWS_INTERVAL", "5"))
+
+# "polling" long-polls Telegram; "webhook" receives updates on the web API port
+TELEGRAM_MODE = os.getenv("TELEGRAM_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+TELEGRAM_CONCURRENT_UPDATES = int(os.getenv("TELEGRAM_CONCURRENT_UPDATES", "256"))
+# Alternative Bot API server, e.g. the local fake in fake_telegram.py
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "")
+
+# Only message updates are handled, so only those are requested from Telegram
+ALLOWED_UPDATES = ["message"]  # Update.MESSAGE
+
+# Port for /metrics in this process when the web API runs in gunicorn (empty to disable)
+METRICS_PORT = os.getenv("METRICS_PORT", "")
+
+# Spreadsheet resolution: a configured ID wins, otherwise the resolved ID is persisted locally
+SPREADSHEET_ID = os.getenv("SPREADSHEET_ID", "")
+SHEET_CACHE_PATH = os.getenv("SHEET_CACHE_PATH", os.path.join("data", "sheet_cache.json"))
+
+# Open worksheet handles kept for chats and API keys with their own spreadsheet (TENANTS_PATH, see tenants.py)
+TENANT_CACHE_SIZE = int(os.getenv("TENANT_CACHE_SIZE", "256"))
+
+# Chat warned about budgets crossed by expenses added through the web API (empty to only log them)
+BUDGET_ALERT_CHAT_ID = os.getenv("BUDGET_ALERT_CHAT_ID", "")
+
+# Several expenses per message: 6-line blocks separated by blank lines or one delimited line each
+EXPENSE_FIELD_SEPARATOR = ";"
+MAX_EXPENSES_PER_MESSAGE = int(os.getenv("MAX_EXPENSES_PER_MESSAGE", "50"))
+
+# Header row of the shared sheet and of each partition worksheet
+SHEET_HEADERS = ["FECHA DEL GASTO", "PRODUCTO", "LUGAR", "CATEGORIA", "SUB CATEGORIA", "IMPORTE", "CANTIDAD"]
+
+# Per-minute Google API budgets (per service account) and retry policy
+GOOGLE_READS_PER_MINUTE = float(os.getenv("GOOGLE_READS_PER_MINUTE", "60"))
+GOOGLE_WRITES_PER_MINUTE = float(os.getenv("GOOGLE_WRITES_PER_MINUTE", "60"))
+GOOGLE_MAX_RETRIES = int(os.getenv("GOOGLE_MAX_RETRIES", "5"))
+
+# In-memory mirror of the sheet for read queries
+SHEET_MIRROR_ENABLED = os.getenv("SHEET_MIRROR", "1") == "1"
+SHEET_MIRROR_PAGE_SIZE = int(os.getenv("SHEET_MIRROR_PAGE_SIZE", "5000"))
+SHEET_MIRROR_SYNC_INTERVAL = float(os.getenv("SHEET_MIRROR_SYNC_INTERVAL", "300"))
+
 class ExpenseBot:
     def __init__(self):
         """Initialize the expense bot with Google Sheets and Telegram integration."""
@@ -29,20 +118,141 @@ class ExpenseBot:
         if not self.google_creds_json:
             raise ValueError("GOOGLE_CREDS environment variable is required")
         
-        # Initialize Google Sheets client
+        # Google Sheets client, authorized on first use (see _client and connect); its
+        # session keeps the token fresh and the connections open (see google_session.py)
         self.gc = None
+        self.google_session = None
         self.sheet = None
+        self.service_account_email = None
         self.quota_exceeded = False
-        self._setup_google_sheets()
+        self._client_lock = threading.Lock()
+        self._sheet_lock = threading.Lock()
+        self._sheet_scan_done = False
+        
+        # Startup progress reported by /status: starting, connecting, ready, degraded or failed
+        self.state = "starting"
+        self.state_error = None
+        self.state_since = datetime.now()
+        
+        # Every Sheets/Drive call goes through the quota scheduler
+        self.quota = QuotaScheduler(
+            reads_per_minute=GOOGLE_READS_PER_MINUTE,
+            writes_per_minute=GOOGLE_WRITES_PER_MINUTE,
+            max_retries=GOOGLE_MAX_RETRIES
+        )
+        
+        # Expenses are committed through a storage backend: Google Sheets, or a local SQLite
+        # database that in sync mode is copied to the sheet periodically (see storage.py)
+        if STORAGE_BACKEND not in STORAGE_BACKENDS:
+            raise ValueError(f"STORAGE_BACKEND must be one of {', '.join(STORAGE_BACKENDS)}, not '{STORAGE_BACKEND}'")
+        self.sheets = SheetsBackend(self._append_rows, self._iter_sheet_pages)
+        self.storage = self.sheets
+        if STORAGE_BACKEND != "sheets":
+            self.storage = SQLiteBackend(EXPENSES_DB_PATH, route=self._destination)
+        
+        # Rows from Telegram and the web API are flushed together in batches
+        self.writer = BatchedSheetWriter(
+            self.sheets.append_rows,
+            max_batch=SHEETS_BATCH_SIZE,
+            flush_interval=SHEETS_FLUSH_INTERVAL,
+            max_queue=SHEETS_QUEUE_SIZE,
+            route=self._destination
+        )
+        atexit.register(self.writer.close)
+        
+        # Bounded pool for blocking Sheets calls made from async handlers
+        self.executor = ThreadPoolExecutor(max_workers=SHEETS_WORKERS, thread_name_prefix="sheets")
+        
+        # Expenses are stored locally before replying and replayed to the sheet in the background
+        # (the SQLite backend is durable itself and takes over rows left in the outbox)
+        self.outbox = None
+        self.replayer = None
+        if OUTBOX_PATH and self.storage is self.sheets:
+            self.outbox = ExpenseOutbox(OUTBOX_PATH)
+            self.replayer = OutboxReplayer(
+                self.outbox,
+                self.sheets.append_rows,
+                batch_size=OUTBOX_BATCH_SIZE,
+                interval=OUTBOX_REPLAY_INTERVAL,
+                route=self._destination,
+                # Rows from web workers are only replayed once their budgets are tracked
+                before_drain=self.track_worker_rows
+            )
+            atexit.register(self.replayer.close)
+        
+        # In sync mode the rows not yet in the sheet are copied there by the same replayer
+        self.store_sync = None
+        if STORAGE_BACKEND == "sync":
+            self.store_sync = OutboxReplayer(
+                self.storage,
+                self.sheets.append_rows,
+                batch_size=OUTBOX_BATCH_SIZE,
+                interval=STORAGE_SYNC_INTERVAL,
+                route=self._destination,
+                name="sheet-sync"
+            )
+            atexit.register(self.store_sync.close)
+        
+        # Optional worksheet per month or year in the shared spreadsheet; the first sheet keeps older history
+        self.partitions = SheetPartitions(SHEET_PARTITION, self.quota.call, SHEET_HEADERS) if SHEET_PARTITION else None
+        
+        # Local indexed copy of the sheet, kept in sync incrementally (not needed when the database is primary)
+        self.mirror = None
+        if SHEET_MIRROR_ENABLED and self.storage is self.sheets:
+            if self.partitions is not None:
+                self.mirror = PartitionedMirror(self.partitions, self._read_range, self._read_partition_range,
+                                                page_size=SHEET_MIRROR_PAGE_SIZE)
+            else:
+                self.mirror = SheetMirror(self._read_range, page_size=SHEET_MIRROR_PAGE_SIZE)
+        self._mirror_thread = None
+        
+        # Running totals for /resumen, /gastos and /summary
+        self.aggregates = ExpenseAggregates()
+        if self.mirror is not None:
+            self.mirror.listeners.append(self.aggregates)
+        # With the SQLite backend they follow the database by id (see refresh_aggregates)
+        self._aggregated_id = 0
+        self._aggregates_lock = threading.Lock()
+        
+        # Chats and API keys can have their own spreadsheet; the rest share the default one
+        self.tenants = None
+        if TENANTS_PATH:
+            self.tenants = TenantSheets(
+                TenantRegistry(TENANTS_PATH),
+                self._open_tenant_worksheet,
+                capacity=TENANT_CACHE_SIZE
+            )
+        
+        # Redelivered Telegram updates and retried API requests are not logged twice
+        self.idempotency = IdempotencyIndex(IDEMPOTENCY_PATH)
+        
+        # Monthly budgets checked on every expense of the shared sheet (see budgets.py);
+        # alert_handler(tenant, alerts) is set once the Telegram bot can send messages
+        self.budgets = BudgetTracker(BudgetStore(BUDGETS_PATH)) if BUDGETS_PATH else None
+        self.alert_handler = None
+        
+        # Replies to expense messages are queued and paced to Telegram's flood limits
+        # (see outbound.py); set once the event loop runs, handlers reply inline until then
+        self.replies: Optional[ReplyScheduler] = None
+        
+        # Recurring expenses (see recurring.py), written by a JobQueue job once the bot runs;
+        # recurring_wakeup() asks for a run now from any thread and is set along with the job
+        self.recurring = RecurringStore(RECURRING_PATH) if RECURRING_PATH else None
+        self.recurring_runner = RecurringRunner(self.recurring, self._commit_recurring) if self.recurring else None
+        self.recurring_wakeup = None
     
     def _setup_google_sheets(self):
         """Setup Google Sheets authentication and connection."""
         try:
+            import gspread
+            from google_session import GoogleSession
+            
             # Parse credentials from environment variable
             if self.google_creds_json is None:
                 raise ValueError("GOOGLE_CREDS is None")
                 
             creds_dict = json.loads(self.google_creds_json)
+            self.service_account_email = creds_dict.get("client_email")
             
             # Define the scope for Google Sheets API
             scope = [
@@ -50,11 +260,13 @@ class ExpenseBot:
                 'https://www.googleapis.com/auth/drive'
             ]
             
-            # Create credentials object
-            credentials = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+            # Credentials and one pooled session shared by every Sheets/Drive call
+            google_session = GoogleSession(creds_dict, scope)
             
             # Authorize and create gspread client
-            self.gc = gspread.authorize(credentials)
+            self.gc = gspread.Client(auth=google_session.credentials, session=google_session.session)
+            self.google_session = google_session
+            google_session.start()
             
             logger.info("Google Sheets authentication successful")
             
@@ -65,50 +277,280 @@ class ExpenseBot:
             logger.error(f"Failed to setup Google Sheets: {e}")
             raise
     
+    def _client(self):
+        """Return the gspread client, authenticating on first use."""
+        if self.gc is None:
+            with self._client_lock:
+                if self.gc is None:
+                    self._setup_google_sheets()
+        return self.gc
+    
+    def _set_state(self, state: str, error: Optional[str] = None):
+        self.state = state
+        self.state_error = error
+        self.state_since = datetime.now()
+    
+    def readiness(self) -> dict:
+        """Connection progress for /status; a sheet resolved later on demand also counts as ready."""
+        state = "ready" if self.sheet is not None else self.state
+        return {
+            "state": state,
+            "ready": state == "ready",
+            "since": self.state_since.isoformat(),
+            "error": self.state_error if state != "ready" else None
+        }
+    
+    def connect(self):
+        """Authenticate, resolve the shared sheet and start the mirror, recording progress for /status."""
+        if self.storage is not self.sheets:
+            self._connect_local()
+            return
+        
+        self._set_state("connecting")
+        try:
+            self._client()
+        except Exception as e:
+            self._set_state("failed", str(e))
+            return
+        
+        if self._get_or_create_sheet():
+            self._set_state("ready")
+            logger.info("Google Sheets ready")
+            # With the mirror, the budgets are loaded from it once it is loaded
+            if self.mirror is None:
+                self.rebuild_budgets()
+        elif self.quota_exceeded:
+            self._set_state("degraded", "Google Drive storage quota exceeded")
+            logger.warning("Google Drive quota exceeded. Bot will start but users need to free up space or create 'Gastos' sheet manually.")
+        else:
+            self._set_state("degraded", "Spreadsheet not available")
+            logger.warning("Could not setup Google Sheets initially. Bot will try again when users send expenses.")
+        
+        # Load the sheet mirror in the background
+        self.start_mirror_sync()
+    
+    def _connect_local(self):
+        """Load the totals from the local database and, in sync mode, start copying rows to the sheet.
+        
+        Google is only contacted by the sync, so the bot is ready as soon as
+        the database is open.
+        """
+        self._set_state("connecting")
+        try:
+            self._adopt_outbox()
+            self.refresh_aggregates()
+        except Exception as e:
+            self._set_state("failed", str(e))
+            return
+        self._set_state("ready")
+        logger.info(f"Local expense database ready ({STORAGE_BACKEND})")
+        # The rebuild reads the database, so rows web workers wrote before it must not be added again later
+        self.track_worker_rows()
+        self.rebuild_budgets()
+        if self.store_sync is not None:
+            self.store_sync.start()
+    
+    def _adopt_outbox(self):
+        """Move rows left in the outbox by a run with the sheets backend into the local database."""
+        if not OUTBOX_PATH or not os.path.exists(OUTBOX_PATH):
+            return
+        outbox = ExpenseOutbox(OUTBOX_PATH)
+        try:
+            while True:
+                batch = outbox.peek(OUTBOX_BATCH_SIZE)
+                if not batch:
+                    return
+                for tenant, entries in itertools.groupby(batch, key=lambda entry: entry[2]):
+                    self.storage.append_rows([row for _, row, _ in entries], tenant)
+                outbox.ack([row_id for row_id, _, _ in batch])
+                logger.info(f"Moved {len(batch)} rows from the outbox to the local database")
+        finally:
+            outbox.close()
+    
+    def refresh_aggregates(self):
+        """Add the rows committed to the local database since the last call, by any process, to the totals."""
+        if self.storage is self.sheets:
+            return
+        with self._aggregates_lock:
+            routes = {}
+            while True:
+                entries = self.storage.rows_after(self._aggregated_id, STORAGE_PAGE_SIZE)
+                for _, row, tenant in entries:
+                    if tenant not in routes:
+                        routes[tenant] = self._destination(tenant)
+                    # Like the mirror, the totals cover the shared sheet's rows
+                    if routes[tenant] is None:
+                        self.aggregates.add(row)
+                if entries:
+                    self._aggregated_id = entries[-1][0]
+                if len(entries) < STORAGE_PAGE_SIZE:
+                    return
+    
+    def rebuild_budgets(self):
+        """Load this month's spending of the shared sheet into the budget totals with one paged read."""
+        if self.budgets is None:
+            return
+        try:
+            self.budgets.rebuild(self.export_pages(start_day=datetime.now().strftime("%Y-%m-01")))
+            logger.info("Budget totals loaded")
+        except Exception as e:
+            logger.error(f"Failed to load budget totals: {e}")
+    
+    def _track_budgets(self, rows: list, tenant: Optional[str] = None):
+        """Add committed rows of the shared sheet to the budget totals and report any threshold crossed."""
+        if self.budgets is None or self._destination(tenant) is not None:
+            return
+        try:
+            alerts = self.budgets.record(rows)
+            if not alerts:
+                return
+            logger.info("Budget threshold crossed", extra={"event": "budget_alert", "tenant": tenant, "alerts": alerts})
+            if self.alert_handler is not None:
+                self.alert_handler(tenant, alerts)
+        except Exception as e:
+            logger.error(f"Failed to check budgets: {e}")
+    
+    def track_worker_rows(self):
+        """Add the rows web workers wrote to the outbox or database to the budget totals.
+        
+        The bot tracks its own rows as it commits them; the workers' rows only
+        reach it through the shared store, where they are flagged until taken.
+        """
+        store = self.outbox or (self.storage if self.storage is not self.sheets else None)
+        if store is None:
+            return
+        while True:
+            entries = store.take_untracked(OUTBOX_BATCH_SIZE)
+            for tenant, group in itertools.groupby(entries, key=lambda entry: entry[2]):
+                self._track_budgets([row for _, row, _ in group], tenant)
+            if len(entries) < OUTBOX_BATCH_SIZE:
+                return
+    
+    def connect_in_background(self) -> threading.Thread:
+        """Run connect() on a daemon thread so startup does not wait for Google."""
+        thread = threading.Thread(target=self.connect, name="sheets-connect", daemon=True)
+        thread.start()
+        return thread
+    
+    def _load_sheet_cache(self) -> dict:
+        """Read the locally persisted spreadsheet resolution, if any."""
+        if not SHEET_CACHE_PATH or not os.path.exists(SHEET_CACHE_PATH):
+            return {}
+        try:
+            with open(SHEET_CACHE_PATH) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable sheet cache {SHEET_CACHE_PATH}: {e}")
+            return {}
+    
+    def _save_sheet_cache(self, spreadsheet):
+        """Persist the resolved spreadsheet ID so restarts skip the lookup."""
+        if not SHEET_CACHE_PATH:
+            return
+        try:
+            directory = os.path.dirname(SHEET_CACHE_PATH)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{SHEET_CACHE_PATH}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"spreadsheet_id": spreadsheet.id, "title": spreadsheet.title}, f)
+            os.replace(tmp_path, SHEET_CACHE_PATH)
+        except OSError as e:
+            logger.warning(f"Could not persist sheet cache: {e}")
+    
+    def _clear_sheet_cache(self):
+        if SHEET_CACHE_PATH and os.path.exists(SHEET_CACHE_PATH):
+            try:
+                os.remove(SHEET_CACHE_PATH)
+            except OSError as e:
+                logger.warning(f"Could not remove sheet cache: {e}")
+    
+    def _invalidate_sheet(self, error: Exception):
+        """Drop the cached worksheet handle, but only when Google says it no longer exists."""
+        if classify_error(error) == NOT_FOUND:
+            logger.warning(f"Cached worksheet not found, it will be resolved again: {error}")
+            self.sheet = None
+            self._clear_sheet_cache()
+    
     def _get_or_create_sheet(self, sheet_name: str = "Gastos"):
-        """Get existing sheet or create a new one with headers."""
+        """Get existing sheet or create a new one with headers.
+        
+        The spreadsheet is resolved by key (SPREADSHEET_ID or the locally
+        persisted ID) whenever possible; looking it up by title, scanning with
+        openall and creating it only happen when no ID is known yet.
+        """
+        with self._sheet_lock:
+            # Another thread may have resolved it while we waited
+            if self.sheet is not None:
+                return True
+            with SHEET_RESOLVE.time():
+                resolved = self._resolve_sheet(sheet_name)
+            if resolved and self.partitions is not None:
+                self.partitions.attach(self.sheet.spreadsheet)
+            return resolved
+    
+    def _resolve_sheet(self, sheet_name: str):
         try:
-            if self.gc is None:
-                logger.error("Google Sheets client not initialized")
-                return False
+            from gspread import SpreadsheetNotFound
+            
+            gc = self._client()
+            
+            # Open by key when the ID is configured or was resolved before
+            cached_id = self._load_sheet_cache().get("spreadsheet_id")
+            spreadsheet_id = SPREADSHEET_ID or cached_id
+            if spreadsheet_id:
+                try:
+                    spreadsheet = self.quota.call("read", gc.open_by_key, spreadsheet_id)
+                    self.sheet = self.quota.call("read", lambda: spreadsheet.sheet1)
+                    logger.info(f"Opened spreadsheet by key: {spreadsheet.title}")
+                    return True
+                except Exception as e:
+                    if classify_error(e) != NOT_FOUND or SPREADSHEET_ID:
+                        raise
+                    logger.warning(f"Cached spreadsheet {spreadsheet_id} no longer exists, resolving again")
+                    self._clear_sheet_cache()
                 
             # Try to open existing spreadsheet first
             try:
-                spreadsheet = self.gc.open(sheet_name)
-                self.sheet = spreadsheet.sheet1
+                spreadsheet = self.quota.call("read", gc.open, sheet_name)
+                self.sheet = self.quota.call("read", lambda: spreadsheet.sheet1)
+                self._save_sheet_cache(spreadsheet)
                 logger.info(f"Opened existing spreadsheet: {sheet_name}")
                 return True
-            except gspread.SpreadsheetNotFound:
+            except SpreadsheetNotFound:
                 logger.info(f"Spreadsheet '{sheet_name}' not found, trying alternative methods...")
                 
-                # Try to find sheet by searching all available sheets
-                try:
-                    all_sheets = self.gc.openall()
-                    for sheet in all_sheets:
-                        if "gasto" in sheet.title.lower():
-                            spreadsheet = sheet
-                            self.sheet = spreadsheet.sheet1
-                            logger.info(f"Found sheet with 'gasto' in name: {sheet.title}")
-                            return True
-                except Exception as e:
-                    logger.warning(f"Could not search through sheets: {e}")
+                # Scan all available sheets only once per process; the result is persisted
+                if not self._sheet_scan_done:
+                    self._sheet_scan_done = True
+                    try:
+                        all_sheets = self.quota.call("read", gc.openall)
+                        for sheet in all_sheets:
+                            if "gasto" in sheet.title.lower():
+                                spreadsheet = sheet
+                                self.sheet = self.quota.call("read", lambda: spreadsheet.sheet1)
+                                self._save_sheet_cache(spreadsheet)
+                                logger.info(f"Found sheet with 'gasto' in name: {sheet.title}")
+                                return True
+                    except Exception as e:
+                        logger.warning(f"Could not search through sheets: {e}")
                 
                 logger.info(f"Will try to create new spreadsheet: {sheet_name}")
             
             # Try to create new spreadsheet if it doesn't exist
             try:
-                spreadsheet = self.gc.create(sheet_name)
-                self.sheet = spreadsheet.sheet1
+                spreadsheet = self.quota.call("write", gc.create, sheet_name)
+                self.sheet = self.quota.call("read", lambda: spreadsheet.sheet1)
+                self._save_sheet_cache(spreadsheet)
                 
                 # Add headers
-                headers = ["FECHA DEL GASTO", "PRODUCTO", "LUGAR", "CATEGORIA", "SUB CATEGORIA", "IMPORTE", "CANTIDAD"]
-                self.sheet.append_row(headers)
+                self.quota.call("write", self.sheet.append_row, SHEET_HEADERS)
                 
                 logger.info(f"Created new spreadsheet with headers: {sheet_name}")
                 return True
                 
             except Exception as create_error:
-                if "quota" in str(create_error).lower() or "403" in str(create_error):
+                if classify_error(create_error) == QUOTA_EXCEEDED:
                     logger.error(f"Google Drive storage quota exceeded. Please free up space or use an existing spreadsheet.")
                     # Set a flag to indicate quota issue
                     self.quota_exceeded = True
@@ -120,6 +562,164 @@ class ExpenseBot:
             logger.error(f"Failed to setup spreadsheet: {e}")
             return False
     
+    def _open_tenant_worksheet(self, spreadsheet_id: str):
+        """Open a tenant's spreadsheet with a single read through the quota scheduler."""
+        return self.quota.call("read", open_first_worksheet, self._client(), spreadsheet_id)
+    
+    def has_own_sheet(self, tenant: Optional[str]) -> bool:
+        """Whether a chat or API key writes to its own spreadsheet instead of the shared one."""
+        return bool(tenant) and self.tenants is not None and self.tenants.registry.get(tenant) is not None
+    
+    def _destination(self, tenant: Optional[str]) -> Optional[str]:
+        """Tenant whose spreadsheet receives its rows, or None for the shared sheet."""
+        return tenant if self.has_own_sheet(tenant) else None
+    
+    def _append_rows(self, rows: list, tenant: Optional[str] = None):
+        """Append rows to the tenant's or the shared sheet through the quota scheduler, connecting if needed."""
+        worksheet = self.tenants.worksheet(tenant) if tenant and self.tenants is not None else None
+        if worksheet is not None:
+            try:
+                with SHEET_APPEND.time():
+                    self.quota.call("write", worksheet.append_rows, rows)
+            except Exception as e:
+                if classify_error(e) == NOT_FOUND:
+                    self.tenants.invalidate(worksheet.spreadsheet.id)
+                raise
+            ROWS_APPENDED.inc(len(rows))
+            return
+        
+        if not self.sheet:
+            self._get_or_create_sheet()
+        if self.sheet is None:
+            raise RuntimeError("Sheet not available")
+        if self.mirror is None:
+            self._append_shared(rows)
+            if self.storage is self.sheets:
+                # With the SQLite backend the totals follow the database instead
+                for row in rows:
+                    self.aggregates.add(row)
+            return
+        # The mirror's sync must not read these rows from the sheet before append_rows adds them
+        with self.mirror.appending():
+            self._append_shared(rows)
+            self.mirror.append_rows(rows)
+    
+    def _append_shared(self, rows: list):
+        """Append rows to the shared sheet, or to its partitions, through the quota scheduler."""
+        try:
+            with SHEET_APPEND.time():
+                if self.partitions is not None:
+                    self._append_partitioned(rows)
+                else:
+                    self.quota.call("write", self.sheet.append_rows, rows)
+        except Exception as e:
+            self._invalidate_sheet(e)
+            raise
+        ROWS_APPENDED.inc(len(rows))
+    
+    def _append_partitioned(self, rows: list):
+        """Append rows to the worksheet of their period in one atomic batchUpdate.
+        
+        A batch spanning several periods (e.g. an import) is committed all or
+        nothing, so a retry never duplicates the part that succeeded. Rows
+        whose date is not YYYY-MM-DD... go to the first sheet.
+        """
+        groups = {}
+        for row in rows:
+            groups.setdefault(self.partitions.key(row[0]), []).append(row)
+        requests = []
+        for period, period_rows in groups.items():
+            worksheet = self.sheet if period is None else self.partitions.worksheet(period)
+            requests.append(append_cells_request(worksheet.id, period_rows))
+        try:
+            self.quota.call("write", self.sheet.spreadsheet.batch_update, {"requests": requests})
+        except Exception:
+            # Re-read the worksheet list on the next attempt, in case a partition was deleted by hand
+            self.partitions.invalidate()
+            raise
+    
+    def _read_partition_range(self, period: str, range_name: str) -> list:
+        """Read a bounded A1 range of a partition worksheet; a missing partition reads as empty."""
+        worksheet = self.partitions.worksheet(period, create=False)
+        if worksheet is None:
+            return []
+        try:
+            return self.quota.call("read", worksheet.get, range_name, value_render_option="UNFORMATTED_VALUE")
+        except Exception as e:
+            if classify_error(e) == NOT_FOUND:
+                self.partitions.invalidate()
+            raise
+    
+    def _read_range(self, range_name: str) -> list:
+        """Read a bounded A1 range with raw (unformatted) values through the quota scheduler."""
+        if not self.sheet:
+            self._get_or_create_sheet()
+        if self.sheet is None:
+            raise RuntimeError("Sheet not available")
+        try:
+            return self.quota.call("read", self.sheet.get, range_name, value_render_option="UNFORMATTED_VALUE")
+        except Exception as e:
+            self._invalidate_sheet(e)
+            raise
+    
+    def export_pages(self, start_day: Optional[str] = None, end_day: Optional[str] = None,
+                     category: Optional[str] = None, tenant: Optional[str] = None):
+        """Pages of matching rows for /export, in storage order.
+        
+        The loaded mirror is scanned when it covers the shared sheet;
+        otherwise the storage backend is read page by page as the pages are
+        consumed.
+        """
+        destination = self._destination(tenant)
+        if destination is None and self.mirror is not None and self.mirror.loaded:
+            stored = self.aggregates.find_category(category) if category else None
+            if category and stored is None:
+                return iter(())
+            return self.mirror.iter_pages(EXPORT_PAGE_SIZE, start_day=start_day, end_day=end_day, category=stored)
+        
+        pages = self.storage.iter_pages(EXPORT_PAGE_SIZE, start_day, end_day, tenant=destination)
+        return filter_pages(pages, start_day, end_day, category)
+    
+    def _iter_sheet_pages(self, start_day: Optional[str], end_day: Optional[str], tenant: Optional[str] = None):
+        """Pages of a tenant's own spreadsheet, or of the shared sheet and its partitions for None."""
+        if tenant is None:
+            return self._iter_shared_pages(start_day, end_day)
+        
+        # Opened now, so a spreadsheet that cannot be opened fails before anything is streamed
+        worksheet = self.tenants.worksheet(tenant)
+        
+        def read_range(range_name):
+            return self.quota.call("read", worksheet.get, range_name, value_render_option="UNFORMATTED_VALUE")
+        
+        return iter_sheet_pages(read_range)
+    
+    def _iter_shared_pages(self, start_day: Optional[str], end_day: Optional[str]):
+        """Pages of the shared sheet, then of the partitions that overlap the day range."""
+        yield from iter_sheet_pages(self._read_range)
+        if self.partitions is not None:
+            for period in self.partitions.periods(start_day, end_day):
+                yield from iter_sheet_pages(functools.partial(self._read_partition_range, period))
+    
+    def start_mirror_sync(self):
+        """Load the sheet mirror in the background and keep it in sync periodically."""
+        if self.mirror is None or (self._mirror_thread and self._mirror_thread.is_alive()):
+            return
+        
+        def run():
+            while True:
+                try:
+                    self.mirror.sync()
+                    delay = SHEET_MIRROR_SYNC_INTERVAL
+                    if self.budgets is not None and not self.budgets.loaded:
+                        self.rebuild_budgets()
+                except Exception as e:
+                    logger.error(f"Failed to sync sheet mirror: {e}")
+                    delay = min(60.0, SHEET_MIRROR_SYNC_INTERVAL)
+                time.sleep(delay)
+        
+        self._mirror_thread = threading.Thread(target=run, name="sheet-mirror", daemon=True)
+        self._mirror_thread.start()
+    
     def _parse_expense_message(self, message_text: str) -> Optional[dict]:
         """Parse expense message and return structured data."""
         lines = [line.strip() for line in message_text.strip().split('\n') if line.strip()]
@@ -129,66 +729,308 @@ class ExpenseBot:
             return None
         
         try:
-            # Extract data from lines
-            product = lines[0]
-            place = lines[1]  # LUGAR (place/location)
-            category = lines[2]
-            subcategory = lines[3]
-            amount = float(lines[4])  # Validate amount is numeric
-            quantity = int(lines[5])  # Validate quantity is integer
-            
             # Add current date
             current_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            return self._expense_from_fields(lines, current_date)
             
-            return {
-                "date": current_date,
-                "product": product,
-                "place": place,
-                "category": category,
-                "subcategory": subcategory,
-                "amount": amount,
-                "quantity": quantity
-            }
-            
-        except (ValueError, IndexError) as e:
+        except ValueError as e:
             logger.error(f"Failed to parse expense data: {e}")
             return None
     
-    def _log_expense_to_sheet(self, expense_data: dict) -> bool:
-        """Log expense data to Google Sheet."""
+    def _expense_from_fields(self, fields: list, date: str) -> dict:
+        """Build an expense from its six fields, raising ValueError with a reason for the user."""
+        if not all(fields):
+            raise ValueError("hay campos vacíos")
+        
+        # Extract data from fields
+        product = fields[0]
+        place = fields[1]  # LUGAR (place/location)
+        category = fields[2]
+        subcategory = fields[3]
+        try:
+            amount = float(fields[4])  # Validate amount is numeric
+        except ValueError:
+            raise ValueError(f"importe inválido '{fields[4]}'")
         try:
+            quantity = int(fields[5])  # Validate quantity is integer
+        except ValueError:
+            raise ValueError(f"cantidad inválida '{fields[5]}'")
+        
+        return {
+            "date": date,
+            "product": product,
+            "place": place,
+            "category": category,
+            "subcategory": subcategory,
+            "amount": amount,
+            "quantity": quantity
+        }
+    
+    def _parse_expense_items(self, message_text: str) -> Tuple[list, list]:
+        """Parse every expense in a message.
+        
+        A message holds one or more 6-line blocks separated by blank lines, or
+        one 'Producto; Lugar; Categoría; Subcategoría; Importe; Cantidad' line
+        per expense. Returns the valid expenses and a list of
+        (item number, first field, reason) for the rejected ones.
+        """
+        current_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        lines = [line.strip() for line in message_text.strip().split('\n')]
+        non_empty = [line for line in lines if line]
+        
+        # A single expense keeps working even with blank lines between its fields
+        if len(non_empty) == 6 and not any(EXPENSE_FIELD_SEPARATOR in line for line in non_empty):
+            items = [non_empty]
+        else:
+            items = []
+            block = []
+            for line in lines + [""]:
+                if line:
+                    block.append(line)
+                    continue
+                if not block:
+                    continue
+                if all(EXPENSE_FIELD_SEPARATOR in item for item in block):
+                    items.extend([field.strip() for field in item.split(EXPENSE_FIELD_SEPARATOR)] for item in block)
+                else:
+                    items.append(block)
+                block = []
+        
+        expenses = []
+        rejected = []
+        for number, fields in enumerate(items[:MAX_EXPENSES_PER_MESSAGE], start=1):
+            if len(fields) != 6:
+                rejected.append((number, fields[0], f"se esperan 6 campos y hay {len(fields)}"))
+                continue
+            try:
+                expenses.append(self._expense_from_fields(fields, current_date))
+            except ValueError as e:
+                rejected.append((number, fields[0], str(e)))
+        
+        for number, fields in enumerate(items[MAX_EXPENSES_PER_MESSAGE:], start=MAX_EXPENSES_PER_MESSAGE + 1):
+            rejected.append((number, fields[0], f"máximo {MAX_EXPENSES_PER_MESSAGE} gastos por mensaje"))
+        
+        return expenses, rejected
+    
+    def outbox_status(self) -> Optional[dict]:
+        """Depth and age of the local outbox, or None when it is disabled."""
+        if not self.outbox:
+            return None
+        oldest_age = self.outbox.oldest_age()
+        return {
+            "depth": self.outbox.depth(),
+            "oldest_age_seconds": round(oldest_age, 3) if oldest_age is not None else None,
+            "last_error": self.replayer.last_error
+        }
+    
+    def storage_status(self) -> dict:
+        """Storage backend in use and, in sync mode, the rows still to be copied to the sheet."""
+        status = self.storage.stats()
+        if self.store_sync is not None:
+            oldest_age = self.storage.oldest_age()
+            status["sync"] = {
+                "pending": self.storage.depth(),
+                "oldest_age_seconds": round(oldest_age, 3) if oldest_age is not None else None,
+                "last_error": self.store_sync.last_error
+            }
+        return status
+    
+    def stores_locally(self) -> bool:
+        """Whether expenses are committed locally (outbox or database) and reach the sheet in the background."""
+        return bool(self.outbox) or self.storage is not self.sheets
+    
+    def _store_locally(self, rows: list, tenant: Optional[str] = None):
+        """Commit rows to the local database or the outbox, raising on failure."""
+        if self.storage is not self.sheets:
+            with STORE_APPEND.time():
+                self.storage.append_rows(rows, tenant)
+            if self.store_sync is not None:
+                self.store_sync.start()
+            return
+        
+        with OUTBOX_APPEND.time():
+            if len(rows) == 1:
+                self.outbox.append(rows[0], tenant)
+            else:
+                self.outbox.append_many(rows, tenant)
+        self.replayer.start()
+        self.replayer.wake()
+    
+    def _log_expense_to_sheet(self, expense_data: dict, tenant: Optional[str] = None) -> bool:
+        """Store expense data locally, or queue it for the sheet and wait for the commit."""
+        try:
+            rows = [expense_row(expense_data)]
+            
+            # With the outbox or the database the row is durable once stored locally
+            if self.stores_locally():
+                self._store_locally(rows, tenant)
+                logger.info("Stored expense locally", extra={"event": "expense_stored", "tenant": tenant, "rows": 1, "sample": True})
+                self._track_budgets(rows, tenant)
+                return True
+            
             # Ensure sheet is available
-            if not self.sheet:
+            if not self.has_own_sheet(tenant):
+                if not self.sheet:
+                    if not self._get_or_create_sheet():
+                        return False
+                
+                if self.sheet is None:
+                    logger.error("Sheet is not available")
+                    return False
+            
+            # Append row through the write-behind buffer
+            future = self.writer.submit(rows[0], tenant=tenant)
+            if not future.result(timeout=SHEETS_COMMIT_TIMEOUT):
+                return False
+            
+            logger.info("Logged expense", extra={"event": "expense_logged", "tenant": tenant, "rows": 1, "sample": True})
+            self._track_budgets(rows, tenant)
+            return True
+            
+        except Exception as e:
+            logger.error(f"Failed to log expense to sheet: {e}")
+            return False
+    
+    def _log_expenses_to_sheet(self, expenses: list, tenant: Optional[str] = None) -> bool:
+        """Store or append several expenses together, committed as one batch."""
+        if not expenses:
+            return True
+        
+        try:
+            rows = [expense_row(expense_data) for expense_data in expenses]
+            
+            if self.stores_locally():
+                self._store_locally(rows, tenant)
+                logger.info("Stored %d expenses locally", len(rows),
+                            extra={"event": "expense_stored", "tenant": tenant, "rows": len(rows), "sample": True})
+                self._track_budgets(rows, tenant)
+                return True
+            
+            if not self.sheet and not self.has_own_sheet(tenant):
                 if not self._get_or_create_sheet():
                     return False
             
-            if self.sheet is None:
-                logger.error("Sheet is not available")
+            future = self.writer.submit_many(rows, tenant=tenant)
+            if not future.result(timeout=SHEETS_COMMIT_TIMEOUT):
                 return False
             
-            # Prepare row data matching your sheet structure
-            row_data = [
-                expense_data["date"],
-                expense_data["product"],
-                expense_data["place"],
-                expense_data["category"],
-                expense_data["subcategory"],
-                expense_data["amount"],
-                expense_data["quantity"]
-            ]
+            logger.info("Logged %d expenses", len(rows),
+                        extra={"event": "expense_logged", "tenant": tenant, "rows": len(rows), "sample": True})
+            self._track_budgets(rows, tenant)
+            return True
             
-            # Append row to sheet
-            self.sheet.append_row(row_data)
+        except Exception as e:
+            logger.error(f"Failed to log expenses to sheet: {e}")
+            return False
+    
+    def _commit_recurring(self, groups: dict) -> dict:
+        """Commit recurring instances grouped by tenant, with one append per destination; returns success per tenant.
+        
+        Unlike expense messages they bypass the write-behind buffer, which
+        splits large batches, so a catch-up of any size is a single write.
+        """
+        results = {}
+        if self.stores_locally():
+            for tenant, rows in groups.items():
+                try:
+                    self._store_locally(rows, tenant)
+                    results[tenant] = True
+                except Exception as e:
+                    logger.error(f"Failed to store recurring expenses: {e}")
+                    results[tenant] = False
+        else:
+            destinations = {}
+            for tenant in groups:
+                destinations.setdefault(self._destination(tenant), []).append(tenant)
+            for destination, tenants in destinations.items():
+                try:
+                    self._append_rows([row for tenant in tenants for row in groups[tenant]], destination)
+                    ok = True
+                except Exception as e:
+                    logger.error(f"Failed to append recurring expenses: {e}")
+                    ok = False
+                results.update((tenant, ok) for tenant in tenants)
+        
+        for tenant, rows in groups.items():
+            if results[tenant]:
+                logger.info("Logged %d recurring expenses", len(rows),
+                            extra={"event": "recurring_logged", "tenant": tenant, "rows": len(rows)})
+                self._track_budgets(rows, tenant)
+        return results
+    
+    async def _run_blocking(self, func, *args):
+        """Run a blocking Sheets call on the worker pool without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+    
+    async def get_or_create_sheet_async(self) -> bool:
+        """Async version of _get_or_create_sheet for use inside handlers."""
+        return await self._run_blocking(self._get_or_create_sheet)
+    
+    async def log_expense_async(self, expense_data: dict, tenant: Optional[str] = None) -> bool:
+        """Async version of _log_expense_to_sheet for use inside handlers."""
+        if self.stores_locally():
+            return await self._run_blocking(self._log_expense_to_sheet, expense_data, tenant)
+        
+        try:
+            if not self.sheet and not self.has_own_sheet(tenant):
+                if not await self.get_or_create_sheet_async():
+                    return False
             
-            logger.info(f"Successfully logged expense: {expense_data['product']}")
+            # Queueing may wait for room in the buffer, so do it on the worker pool
+            row = expense_row(expense_data)
+            submit = functools.partial(self.writer.submit, row, tenant=tenant)
+            future = await self._run_blocking(submit)
+            # Shielded: a timeout must not cancel the writer's future, whose rows may still be committed
+            if not await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), SHEETS_COMMIT_TIMEOUT):
+                return False
+            
+            logger.info("Logged expense", extra={"event": "expense_logged", "tenant": tenant, "rows": 1, "sample": True})
+            self._track_budgets([row], tenant)
             return True
             
         except Exception as e:
             logger.error(f"Failed to log expense to sheet: {e}")
             return False
+    
+    async def log_expenses_async(self, expenses: list, tenant: Optional[str] = None) -> bool:
+        """Async version of _log_expenses_to_sheet: all expenses are committed in one append."""
+        if self.stores_locally():
+            return await self._run_blocking(self._log_expenses_to_sheet, expenses, tenant)
+        
+        try:
+            if not self.sheet and not self.has_own_sheet(tenant):
+                if not await self.get_or_create_sheet_async():
+                    return False
+            
+            rows = [expense_row(expense_data) for expense_data in expenses]
+            submit = functools.partial(self.writer.submit_many, rows, tenant=tenant)
+            future = await self._run_blocking(submit)
+            # Shielded: a timeout must not cancel the writer's future, whose rows may still be committed
+            if not await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), SHEETS_COMMIT_TIMEOUT):
+                return False
+            
+            logger.info("Logged %d expenses", len(rows),
+                        extra={"event": "expense_logged", "tenant": tenant, "rows": len(rows), "sample": True})
+            self._track_budgets(rows, tenant)
+            return True
+            
+        except Exception as e:
+            logger.error(f"Failed to log expenses to sheet: {e}")
+            return False
+
+# Created by main() (or init_bot() in tests and benchmarks) so importing this module has no side effects
+expense_bot: Optional[ExpenseBot] = None
+
+def init_bot() -> ExpenseBot:
+    """Create the ExpenseBot shared by the Telegram handlers and the web API, once."""
+    global expense_bot
+    if expense_bot is None:
+        expense_bot = ExpenseBot()
+        set_bot_instance(expense_bot)
+    return expense_bot
 
 # Telegram bot handlers
-expense_bot = ExpenseBot()
 
 async def start(update: Update, context: CallbackContext) -> None:
     """Send a message when the command /start is issued."""
@@ -213,6 +1055,11 @@ Productos básicos
 2
 
 Lo registraré automáticamente en tu hoja de Google con la fecha y hora actual.
+
+Consulta tus gastos con /resumen o /gastos <categoría>.
+Fija un presupuesto mensual con /presupuesto <categoría> <importe> y te avisaré al acercarte o pasarte.
+Registra gastos fijos (alquiler, suscripciones) con /recurrente y los cargaré solos cada mes.
+Usa /hoja para guardar los gastos de este chat en tu propia hoja.
     """
     await update.message.reply_text(welcome_message)
 
@@ -231,7 +1078,31 @@ async def help_command(update: Update, context: CallbackContext) -> None:
 
 2. Automáticamente agregaré la fecha actual y lo guardaré en tu hoja de Google.
 
-3. Asegúrate de que tu mensaje tenga exactamente 6 líneas y que el importe y cantidad sean números válidos.
+3. Asegúrate de que cada gasto tenga exactamente 6 líneas y que el importe y cantidad sean números válidos.
+
+   ¿Varios gastos? Envíalos en un solo mensaje, en bloques de 6 líneas separados por una línea en blanco, o uno por línea con los campos separados por ";":
+   Pan; Panadería; Comida; Productos básicos; 2500; 1
+   Leche; Supermercado; Comida; Lácteos; 1800; 2
+
+4. Consulta tus gastos:
+   /resumen - Totales del mes actual (o /resumen AAAA-MM)
+   /gastos <categoría> - Totales de una categoría (opcional: AAAA-MM)
+
+5. Presupuestos mensuales:
+   /presupuesto - Presupuestos y gasto del mes
+   /presupuesto <categoría>[/<subcategoría>] <importe> - Fija un presupuesto (0 lo borra)
+   Te aviso cuando un gasto llega al 80% y al 100%.
+
+6. Gastos recurrentes (alquiler, suscripciones):
+   /recurrente - Lista los de este chat
+   /recurrente <mensual|semanal|anual> [AAAA-MM-DD] Producto; Lugar; Categoría; Subcategoría; Importe; Cantidad
+   /recurrente borrar <número> - Deja de registrarlo
+   Los registro solos cada vez que vencen, también los que vencieron mientras el bot estuvo apagado.
+
+7. Usa tu propia hoja:
+   /hoja - Muestra la hoja de este chat
+   /hoja <ID o URL> - Guarda los gastos de este chat en esa hoja
+   /hoja compartida - Vuelve a la hoja común
 
 Ejemplo:
 Pan
@@ -243,15 +1114,68 @@ Productos básicos
     """
     await update.message.reply_text(help_message)
 
+def _tenant_of(update: Update) -> str:
+    """Tenant key of a Telegram update: the chat it came from."""
+    return str(update.effective_chat.id)
+
+async def _reply(update: Update, text: str, merge: bool = False) -> None:
+    """Queue a reply to the message's chat; ``merge`` joins confirmations still waiting to be sent."""
+    if expense_bot.replies is not None:
+        expense_bot.replies.enqueue(update.effective_chat.id, text, merge=merge)
+        return
+    with TELEGRAM_REPLY.time():
+        await update.message.reply_text(text)
+
 async def handle_expense_message(update: Update, context: CallbackContext) -> None:
     """Handle incoming expense messages."""
+    started = time.perf_counter()
+    with TELEGRAM_UPDATE.time():
+        # A redelivered message (same chat and message ID) is a no-op
+        key = _message_key(update)
+        if key is not None:
+            claimed, _ = await expense_bot._run_blocking(expense_bot.idempotency.claim, key)
+            if not claimed:
+                logger.info("Ignoring redelivered message", extra={"event": "message_redelivered", "key": key})
+                return
+        
+        # Stage timings and counts, logged as one structured event per message
+        timings = {}
+        done = await _handle_expense_message(update, timings)
+        
+        if key is not None:
+            if done:
+                await expense_bot._run_blocking(expense_bot.idempotency.complete, key)
+            else:
+                await expense_bot._run_blocking(expense_bot.idempotency.release, key)
+    
+    logger.info("Handled expense message", extra={
+        "event": "expense_message", "chat_id": update.effective_chat.id, "stored": done,
+        **timings, "total_ms": elapsed_ms(started), "sample": True
+    })
+
+def _message_key(update: Update) -> Optional[str]:
+    """Idempotency key of a Telegram message, stable across redeliveries of its update."""
+    message_id = getattr(update.message, "message_id", None)
+    return f"tg:{update.effective_chat.id}:{message_id}" if message_id is not None else None
+
+async def _handle_expense_message(update: Update, timings: dict) -> bool:
+    """Log the expenses in a message and reply; False when they could not be stored.
+    
+    Stage durations (ms) and counts are added to ``timings``.
+    """
+    success = False
     try:
         message_text = update.message.text
+        tenant = _tenant_of(update)
         
-        # Parse the expense message
-        expense_data = expense_bot._parse_expense_message(message_text)
+        # Parse every expense in the message
+        started = time.perf_counter()
+        with PARSE.time():
+            expenses, rejected = expense_bot._parse_expense_items(message_text)
+        timings.update(parse_ms=elapsed_ms(started), expenses=len(expenses), rejected=len(rejected))
         
-        if not expense_data:
+        if not expenses:
+            PARSE_FAILURES.inc()
             error_message = """
 ❌ ¡Formato de mensaje inválido!
 
@@ -270,21 +1194,38 @@ Comida
 Productos básicos
 1200
 2
+
+También puedes enviar varios gastos en un mensaje: bloques de 6 líneas separados por una línea en blanco, o una línea por gasto con los campos separados por ";".
             """
-            await update.message.reply_text(error_message)
-            return
+            if len(rejected) > 1:
+                error_message = error_message.rstrip() + "\n\n" + _rejected_lines(rejected)
+            await _reply(update, error_message)
+            return True
         
-        # Ensure sheet is ready
-        if not expense_bot.sheet:
-            if not expense_bot._get_or_create_sheet():
+        # Ensure sheet is ready (not needed when the outbox or the database absorbs outages)
+        if not expense_bot.stores_locally() and not expense_bot.sheet and not expense_bot.has_own_sheet(tenant):
+            if not await expense_bot.get_or_create_sheet_async():
                 if getattr(expense_bot, 'quota_exceeded', False):
-                    await update.message.reply_text("❌ Cuota de almacenamiento de Google Drive excedida. Por favor libera espacio en tu Google Drive o crea una hoja llamada 'Gastos' manualmente e inténtalo de nuevo.")
+                    await _reply(update, "❌ Cuota de almacenamiento de Google Drive excedida. Por favor libera espacio en tu Google Drive o crea una hoja llamada 'Gastos' manualmente e inténtalo de nuevo.")
                 else:
-                    await update.message.reply_text("❌ Error al conectar con Google Sheets. Por favor inténtalo más tarde.")
-                return
+                    await _reply(update, "❌ Error al conectar con Google Sheets. Por favor inténtalo más tarde.")
+                return False
+        
+        # Several expenses are committed together in a single append
+        started = time.perf_counter()
+        if len(expenses) > 1 or rejected:
+            success = await expense_bot.log_expenses_async(expenses, tenant)
+            timings["store_ms"] = elapsed_ms(started)
+            if success:
+                await _reply(update, _expenses_summary(expenses, rejected), merge=True)
+            else:
+                await _reply(update, "❌ Error al registrar los gastos. Por favor inténtalo más tarde.")
+            return success
         
         # Log expense to sheet
-        success = expense_bot._log_expense_to_sheet(expense_data)
+        expense_data = expenses[0]
+        success = await expense_bot.log_expense_async(expense_data, tenant)
+        timings["store_ms"] = elapsed_ms(started)
         
         if success:
             success_message = f"""
@@ -298,42 +1239,458 @@ Productos básicos
 💰 Importe: {expense_data['amount']}
 📦 Cantidad: {expense_data['quantity']}
             """
-            await update.message.reply_text(success_message)
+            await _reply(update, success_message, merge=True)
         else:
-            await update.message.reply_text("❌ Error al registrar el gasto. Por favor inténtalo más tarde.")
+            await _reply(update, "❌ Error al registrar el gasto. Por favor inténtalo más tarde.")
+        return success
             
     except Exception as e:
-        logger.error(f"Error handling expense message: {e}")
-        await update.message.reply_text("❌ Ocurrió un error al procesar tu gasto. Por favor inténtalo de nuevo.")
+        logger.error("Error handling expense message: %s", e, exc_info=True,
+                     extra={"event": "expense_message_error", "chat_id": update.effective_chat.id})
+        await _reply(update, "❌ Ocurrió un error al procesar tu gasto. Por favor inténtalo de nuevo.")
+        # Once stored, a redelivery must not log the expenses again
+        return success
+
+def _format_amount(amount: float) -> str:
+    """Format an amount with Spanish thousands and decimal separators."""
+    return f"{amount:,.2f}".replace(",", "_").replace(".", ",").replace("_", ".")
+
+# Items listed in a multi-expense reply, keeping it well under Telegram's message size limit
+MAX_LISTED_ITEMS = 20
+
+def _rejected_lines(rejected: list) -> str:
+    lines = [f"⚠️ No registré {len(rejected)} elemento(s):"]
+    lines += [f"• #{number} {first_field}: {reason}" for number, first_field, reason in rejected[:MAX_LISTED_ITEMS]]
+    if len(rejected) > MAX_LISTED_ITEMS:
+        lines.append(f"… y {len(rejected) - MAX_LISTED_ITEMS} más")
+    return "\n".join(lines)
+
+def _expenses_summary(expenses: list, rejected: list) -> str:
+    """Single confirmation for every expense of a multi-expense message."""
+    lines = [f"✅ ¡{len(expenses)} gasto(s) registrado(s)!", ""]
+    lines += [
+        f"• {expense['product']} ({expense['place']}): {_format_amount(expense['amount'])} x{expense['quantity']}"
+        for expense in expenses[:MAX_LISTED_ITEMS]
+    ]
+    if len(expenses) > MAX_LISTED_ITEMS:
+        lines.append(f"… y {len(expenses) - MAX_LISTED_ITEMS} más")
+    lines += ["", f"💰 Total: {_format_amount(sum(expense['amount'] for expense in expenses))}"]
+    if rejected:
+        lines += ["", _rejected_lines(rejected)]
+    return "\n".join(lines)
+
+def _history_note() -> str:
+    if expense_bot.mirror is not None and not expense_bot.mirror.loaded:
+        return "\n⏳ Todavía estoy cargando el historial de la hoja, los totales pueden estar incompletos."
+    return ""
+
+def _own_sheet_note() -> str:
+    return "📄 Este chat usa su propia hoja; los totales solo están disponibles para la hoja compartida."
+
+async def summary_command(update: Update, context: CallbackContext) -> None:
+    """Send spending totals when the command /resumen [AAAA-MM] is issued."""
+    if expense_bot.has_own_sheet(_tenant_of(update)):
+        await update.message.reply_text(_own_sheet_note())
+        return
+    
+    await expense_bot._run_blocking(expense_bot.refresh_aggregates)
+    args = context.args or []
+    month = args[0] if args and re.fullmatch(r"\d{4}-\d{2}", args[0]) else datetime.now().strftime("%Y-%m")
+    today = datetime.now().strftime("%Y-%m-%d")
+    
+    summary = expense_bot.aggregates.month(month, limit=5)
+    today_summary = expense_bot.aggregates.day(today)
+    
+    lines = [
+        f"📊 Resumen de {month}",
+        "",
+        f"💰 Total del mes: {_format_amount(summary['total'])} ({summary['gastos']} gastos)",
+        f"📅 Hoy: {_format_amount(today_summary['total'])} ({today_summary['gastos']} gastos)",
+    ]
+    if summary["categorias"]:
+        lines += ["", "📂 Por categoría:"]
+        lines += [f"• {item['categoria']}: {_format_amount(item['total'])}" for item in summary["categorias"]]
+    if summary["lugares"]:
+        lines += ["", "📍 Lugares principales:"]
+        lines += [f"• {item['lugar']}: {_format_amount(item['total'])}" for item in summary["lugares"]]
+    
+    await update.message.reply_text("\n".join(lines) + _history_note())
+
+async def category_command(update: Update, context: CallbackContext) -> None:
+    """Send totals for a category when the command /gastos <categoría> [AAAA-MM] is issued."""
+    if expense_bot.has_own_sheet(_tenant_of(update)):
+        await update.message.reply_text(_own_sheet_note())
+        return
+    
+    await expense_bot._run_blocking(expense_bot.refresh_aggregates)
+    args = list(context.args or [])
+    month = None
+    if args and re.fullmatch(r"\d{4}-\d{2}", args[-1]):
+        month = args.pop()
+    
+    if not args:
+        await update.message.reply_text("Uso: /gastos <categoría> [AAAA-MM]\nEjemplo: /gastos Comida 2025-06")
+        return
+    
+    name = " ".join(args)
+    category = expense_bot.aggregates.find_category(name)
+    if category is None:
+        await update.message.reply_text(f"❌ No encontré gastos en la categoría '{name}'." + _history_note())
+        return
+    
+    summary = expense_bot.aggregates.category(category, month=month, limit=10)
+    period = f"en {month}" if month else "en total"
+    lines = [
+        f"📂 {category} {period}",
+        "",
+        f"💰 {_format_amount(summary['total'])} ({summary['gastos']} gastos)",
+    ]
+    if summary["subcategorias"]:
+        lines += ["", "📁 Por subcategoría:"]
+        lines += [f"• {item['subcategoria']}: {_format_amount(item['total'])}" for item in summary["subcategorias"]]
+    
+    await update.message.reply_text("\n".join(lines) + _history_note())
+
+def _budget_name(item: dict) -> str:
+    return f"{item['categoria']}/{item['subcategoria']}" if item["subcategoria"] else item["categoria"]
+
+def _budget_alert_text(alerts: list) -> str:
+    lines = []
+    for alert in alerts:
+        state = "superaste" if alert["umbral"] >= 100 else f"llegaste al {alert['umbral']:g}% de"
+        lines.append(
+            f"⚠️ Con este gasto {state} tu presupuesto de {_budget_name(alert)} para {alert['mes']}: "
+            f"{_format_amount(alert['gastado'])} de {_format_amount(alert['presupuesto'])}"
+        )
+    return "\n".join(lines)
+
+def _send_budget_alerts(replies: ReplyScheduler, tenant: Optional[str], alerts: list) -> None:
+    """Warn the chat that logged the expenses, or BUDGET_ALERT_CHAT_ID for web API tenants.
+    
+    Called from handlers and worker threads alike, so the message is queued
+    through the event loop instead of awaited.
+    """
+    chat_id = tenant if tenant and not tenant.startswith("api:") else BUDGET_ALERT_CHAT_ID
+    if chat_id:
+        # Numeric like update.effective_chat.id, so the alert queues behind the chat's replies
+        replies.enqueue_threadsafe(int(chat_id) if chat_id.lstrip("-").isdigit() else chat_id, _budget_alert_text(alerts))
+
+async def _on_startup(application: Application) -> None:
+    """Start the reply queue, budget alerts and recurring expenses once the event loop is running."""
+    expense_bot.replies = ReplyScheduler(application.bot.send_message)
+    expense_bot.replies.start()
+    expense_bot.alert_handler = functools.partial(_send_budget_alerts, expense_bot.replies)
+    
+    if HTTP_SERVER == "gunicorn" and expense_bot.stores_locally() and application.job_queue is not None:
+        application.job_queue.run_repeating(_worker_rows_job, WORKER_ROWS_INTERVAL, name="worker-rows")
+    
+    if expense_bot.recurring_runner is not None:
+        if application.job_queue is None:
+            logger.warning("Recurring expenses need the JobQueue: install python-telegram-bot[job-queue]")
+            return
+        loop = asyncio.get_running_loop()
+        expense_bot.recurring_wakeup = lambda: loop.call_soon_threadsafe(_schedule_recurring, application, 0)
+        # The first run also catches up on instances that fell due while the bot was down
+        _schedule_recurring(application, 0)
+
+async def _on_stop(application: Application) -> None:
+    """Send the replies still queued before the bot shuts down."""
+    if expense_bot.replies is not None:
+        await expense_bot.replies.close()
+
+async def _worker_rows_job(context: CallbackContext) -> None:
+    """Add the expenses written by the gunicorn workers to the budgets, so they alert like the bot's own."""
+    try:
+        await expense_bot._run_blocking(expense_bot.track_worker_rows)
+    except Exception as e:
+        logger.error(f"Failed to track expenses from web workers: {e}")
+
+def _schedule_recurring(application: Application, delay: float) -> None:
+    """(Re)schedule the single recurring expenses job ``delay`` seconds from now."""
+    for job in application.job_queue.get_jobs_by_name("recurring"):
+        job.schedule_removal()
+    application.job_queue.run_once(_recurring_job, delay, name="recurring")
+
+async def _recurring_job(context: CallbackContext) -> None:
+    """Write due recurring expenses, then check again in an hour, or sooner while a backlog or a retry remains."""
+    try:
+        written, backlog = await expense_bot._run_blocking(expense_bot.recurring_runner.run)
+    except Exception as e:
+        logger.error(f"Recurring expenses run failed: {e}")
+        written, backlog = {}, True
+    
+    for tenant, rows in written.items():
+        if tenant and not tenant.startswith("api:") and expense_bot.replies is not None:
+            expense_bot.replies.enqueue(int(tenant), _recurring_written_text(rows), merge=True)
+    delay = RECURRING_CATCHUP_INTERVAL if backlog else RECURRING_CHECK_INTERVAL
+    # Definitions backed off after a failed write are retried when their wait ends, not an hour later
+    retry_at = expense_bot.recurring_runner.retry_at
+    if retry_at is not None:
+        delay = min(delay, max(0.0, retry_at - time.time()))
+    _schedule_recurring(context.application, delay)
+
+def _recurring_written_text(rows: list) -> str:
+    lines = [f"🔁 Registré {len(rows)} gasto(s) recurrente(s):"]
+    lines += [f"• {row[0][:10]} {row[1]}: {_format_amount(row[5])}" for row in rows[:10]]
+    if len(rows) > 10:
+        lines.append(f"… y {len(rows) - 10} más")
+    return "\n".join(lines)
+
+RECURRING_USAGE = (
+    "Uso: /recurrente <mensual|semanal|anual> [AAAA-MM-DD] Producto; Lugar; Categoría; Subcategoría; Importe; Cantidad\n"
+    "Ejemplo: /recurrente mensual 2025-07-01 Alquiler; Inmobiliaria; Vivienda; Alquiler; 350000; 1\n"
+    "/recurrente borrar <número> deja de registrarlo"
+)
+
+async def recurring_command(update: Update, context: CallbackContext) -> None:
+    """List, add (/recurrente <frecuencia> [inicio] campos) or remove (/recurrente borrar <n>) recurring expenses."""
+    if expense_bot.recurring is None:
+        await update.message.reply_text("❌ Los gastos recurrentes no están habilitados en este bot.")
+        return
+    
+    tenant = _tenant_of(update)
+    args = context.args or []
+    if not args:
+        definitions = await expense_bot._run_blocking(expense_bot.recurring.list, tenant)
+        if not definitions:
+            await update.message.reply_text("No hay gastos recurrentes.\n" + RECURRING_USAGE)
+            return
+        lines = ["🔁 Gastos recurrentes", ""]
+        lines += [
+            f"#{item['id']} {item['producto']}: {_format_amount(item['importe'])}, {item['frecuencia']}"
+            f" desde {item['inicio']} (próximo: {item['proximo']})"
+            for item in definitions
+        ]
+        await update.message.reply_text("\n".join(lines))
+        return
+    
+    if args[0].lower() == "borrar":
+        if len(args) != 2 or not args[1].lstrip("#").isdigit():
+            await update.message.reply_text(RECURRING_USAGE)
+            return
+        removed = await expense_bot._run_blocking(expense_bot.recurring.remove, int(args[1].lstrip("#")), tenant)
+        await update.message.reply_text(f"✅ Gasto recurrente #{args[1].lstrip('#')} borrado." if removed
+                                        else f"No hay un gasto recurrente #{args[1].lstrip('#')} en este chat.")
+        return
+    
+    frequency = parse_frequency(args[0])
+    rest = args[1:]
+    start = datetime.now().date()
+    if rest and re.fullmatch(r"\d{4}-\d{2}-\d{2}", rest[0]):
+        try:
+            start = datetime.strptime(rest[0], "%Y-%m-%d").date()
+        except ValueError:
+            frequency = None
+        rest = rest[1:]
+    fields = [field.strip() for field in " ".join(rest).split(EXPENSE_FIELD_SEPARATOR)]
+    if frequency is None or len(fields) != 6:
+        await update.message.reply_text(RECURRING_USAGE)
+        return
+    try:
+        expense = expense_bot._expense_from_fields(fields, start.isoformat())
+    except ValueError as e:
+        await update.message.reply_text(f"❌ Gasto inválido: {e}\n{RECURRING_USAGE}")
+        return
+    
+    definition_id = await expense_bot._run_blocking(expense_bot.recurring.add, expense, frequency, start, tenant)
+    await update.message.reply_text(
+        f"✅ Gasto recurrente #{definition_id}: {expense['product']}, {_format_amount(expense['amount'])}"
+        f" {args[0].lower()} desde {start.isoformat()}."
+    )
+    # Instances already due (a start today or in the past) are written right away
+    if expense_bot.recurring_wakeup is not None:
+        expense_bot.recurring_wakeup()
+
+async def budget_command(update: Update, context: CallbackContext) -> None:
+    """Show budgets, or set one with /presupuesto <categoría>[/<subcategoría>] <importe>."""
+    if expense_bot.budgets is None:
+        await update.message.reply_text("❌ Los presupuestos no están habilitados en este bot.")
+        return
+    if expense_bot.has_own_sheet(_tenant_of(update)):
+        await update.message.reply_text("📄 Este chat usa su propia hoja; los presupuestos solo están disponibles para la hoja compartida.")
+        return
+    
+    args = context.args or []
+    if not args:
+        status = await expense_bot._run_blocking(expense_bot.budgets.status)
+        if not status:
+            await update.message.reply_text(
+                "No hay presupuestos definidos.\n"
+                "Uso: /presupuesto <categoría>[/<subcategoría>] <importe>\nEjemplo: /presupuesto Comida 150000"
+            )
+            return
+        lines = [f"💼 Presupuestos de {expense_bot.budgets.month}", ""]
+        lines += [
+            f"• {_budget_name(item)}: {_format_amount(item['gastado'])} de {_format_amount(item['presupuesto'])}"
+            f" ({item['porcentaje']:g}%)"
+            for item in status
+        ]
+        await update.message.reply_text("\n".join(lines) + _budget_history_note())
+        return
+    
+    try:
+        amount = float(args[-1].replace(",", "."))
+    except ValueError:
+        amount = -1
+    name = " ".join(args[:-1])
+    if amount < 0 or not name.strip(" /"):
+        await update.message.reply_text(
+            "Uso: /presupuesto <categoría>[/<subcategoría>] <importe>\n"
+            "Ejemplo: /presupuesto Comida/Lácteos 20000 (0 borra el presupuesto)"
+        )
+        return
+    
+    category, _, subcategory = name.partition("/")
+    category, subcategory = category.strip(), subcategory.strip() or None
+    label = f"{category}/{subcategory}" if subcategory else category
+    if amount == 0:
+        removed = await expense_bot._run_blocking(expense_bot.budgets.store.remove, category, subcategory)
+        await update.message.reply_text(f"✅ Presupuesto de {label} borrado." if removed else f"No había presupuesto para {label}.")
+        return
+    
+    await expense_bot._run_blocking(expense_bot.budgets.store.set, category, subcategory, amount)
+    await update.message.reply_text(f"✅ Presupuesto mensual de {label}: {_format_amount(amount)}")
+
+def _budget_history_note() -> str:
+    if not expense_bot.budgets.loaded:
+        return "\n⏳ Todavía estoy cargando los gastos del mes, los totales pueden estar incompletos."
+    return ""
+
+async def sheet_command(update: Update, context: CallbackContext) -> None:
+    """Show or change this chat's spreadsheet with /hoja [ID o URL | compartida]."""
+    if expense_bot.tenants is None:
+        await update.message.reply_text("❌ Las hojas por chat no están habilitadas en este bot.")
+        return
+    
+    tenant = _tenant_of(update)
+    args = context.args or []
+    share_hint = f"compártela con {expense_bot.service_account_email} como editor" if expense_bot.service_account_email else "compártela con la cuenta de servicio del bot como editor"
+    
+    if not args:
+        spreadsheet_id = expense_bot.tenants.registry.get(tenant)
+        if spreadsheet_id:
+            await update.message.reply_text(
+                f"📄 Este chat guarda sus gastos en https://docs.google.com/spreadsheets/d/{spreadsheet_id}\n"
+                "Usa /hoja compartida para volver a la hoja común."
+            )
+        else:
+            await update.message.reply_text(
+                "📄 Este chat usa la hoja compartida.\n"
+                f"Para usar tu propia hoja, {share_hint} y envía /hoja <ID o URL de la hoja>."
+            )
+        return
+    
+    if args[0].lower() == "compartida":
+        await expense_bot._run_blocking(expense_bot.tenants.unlink, tenant)
+        await update.message.reply_text("✅ Este chat vuelve a usar la hoja compartida.")
+        return
+    
+    spreadsheet_id = parse_spreadsheet_id(args[0])
+    if not spreadsheet_id:
+        await update.message.reply_text("Uso: /hoja <ID o URL de la hoja>\nEjemplo: /hoja https://docs.google.com/spreadsheets/d/<ID>/edit")
+        return
+    
+    try:
+        await expense_bot._run_blocking(expense_bot.tenants.link, tenant, spreadsheet_id)
+    except Exception as e:
+        logger.warning(f"Could not link chat {tenant} to spreadsheet {spreadsheet_id}: {e}")
+        await update.message.reply_text(f"❌ No pude abrir esa hoja. Verifica el ID y {share_hint}.")
+        return
+    
+    await update.message.reply_text("✅ Listo, los gastos de este chat se guardarán en esa hoja.")
 
 async def error_handler(update: Update, context: CallbackContext) -> None:
-    """Log errors caused by updates."""
-    logger.error(f"Update {update} caused error {context.error}")
+    """Log errors caused by updates (only their IDs; the whole Update is not formatted)."""
+    chat = getattr(update, "effective_chat", None)
+    logger.error("Update caused error: %s", context.error, exc_info=context.error, extra={
+        "event": "update_error",
+        "update_id": getattr(update, "update_id", None),
+        "chat_id": chat.id if chat is not None else None
+    })
+
+async def run_webhook(application: Application) -> None:
+    """Run the bot in webhook mode, receiving updates through the web API's port."""
+    from telegram import Update
+    
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    def enqueue_update(data: dict):
+        # Called from the Flask thread; hand the update over to the event loop
+        update = Update.de_json(data, application.bot)
+        asyncio.run_coroutine_threadsafe(application.update_queue.put(update), loop)
+    
+    async with application:
+        await _on_startup(application)
+        await application.start()
+        set_webhook_handler(enqueue_update, WEBHOOK_SECRET)
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            allowed_updates=ALLOWED_UPDATES,
+            secret_token=WEBHOOK_SECRET or None,
+            max_connections=100
+        )
+        logger.info(f"Webhook registrado en {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        
+        await stop.wait()
+        
+        set_webhook_handler(None, None)
+        await application.stop()
+        await _on_stop(application)
 
 def main():
     """Start the bot."""
+    bot = None
     try:
-        # Start the keep alive server
-        keep_alive()
+        if TELEGRAM_MODE == "webhook":
+            if not WEBHOOK_URL:
+                raise ValueError("WEBHOOK_URL environment variable is required in webhook mode")
+            if HTTP_SERVER != "builtin":
+                raise ValueError("Webhook mode shares the bot's own web server; set HTTP_SERVER=builtin")
         
-        # Try to setup Google Sheets connection, but continue even if it fails
-        # The bot will handle the error when users try to log expenses
-        expense_bot._get_or_create_sheet()
+        # Only reads the configuration and opens the local stores; nothing talks to Google yet
+        bot = init_bot()
         
-        # Set bot instance for API access
-        set_bot_instance(expense_bot)
+        # Start the keep alive server first, so /health answers while the rest starts up,
+        # unless gunicorn serves the API in its own processes
+        if HTTP_SERVER == "builtin":
+            keep_alive()
+        elif METRICS_PORT:
+            # The API's /metrics only covers its own workers; expose this process separately
+            start_metrics_server(int(METRICS_PORT))
         
-        if getattr(expense_bot, 'quota_exceeded', False):
-            logger.warning("Google Drive quota exceeded. Bot will start but users need to free up space or create 'Gastos' sheet manually.")
-        elif not expense_bot.sheet:
-            logger.warning("Could not setup Google Sheets initially. Bot will try again when users send expenses.")
+        # Replay anything left in the outbox from a previous run
+        if bot.replayer:
+            bot.replayer.start()
+        
+        # Authenticate and resolve the sheet in the background; /status reports the progress
+        # and the bot retries on demand when users send expenses before it is ready
+        bot.connect_in_background()
         
-        # Create the Application
-        application = Application.builder().token(expense_bot.bot_token).build()
+        from telegram.ext import Application, CommandHandler, MessageHandler, filters
+        from update_processor import PerChatUpdateProcessor
+        
+        # Create the Application; updates are processed concurrently so a slow
+        # Sheets write never delays replies to other chats or commands, while
+        # updates from the same chat keep their order
+        builder = Application.builder().token(bot.bot_token)
+        builder.concurrent_updates(PerChatUpdateProcessor(TELEGRAM_CONCURRENT_UPDATES))
+        builder.post_init(_on_startup)
+        builder.post_stop(_on_stop)
+        if TELEGRAM_BASE_URL:
+            builder.base_url(TELEGRAM_BASE_URL)
+        application = builder.build()
         
         # Add handlers
         application.add_handler(CommandHandler("start", start))
         application.add_handler(CommandHandler("help", help_command))
+        application.add_handler(CommandHandler("resumen", summary_command))
+        application.add_handler(CommandHandler("gastos", category_command))
+        application.add_handler(CommandHandler("hoja", sheet_command))
+        application.add_handler(CommandHandler("presupuesto", budget_command))
+        application.add_handler(CommandHandler("recurrente", recurring_command))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_expense_message))
         
         # Add error handler
@@ -342,11 +1699,23 @@ def main():
         # Start the bot
         logger.info("Iniciando Bot de Gastos...")
         logger.info("API Web disponible en puerto 8080")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        if TELEGRAM_MODE == "webhook":
+            asyncio.run(run_webhook(application))
+        else:
+            application.run_polling(allowed_updates=ALLOWED_UPDATES)
         
     except Exception as e:
         logger.error(f"Failed to start bot: {e}")
         raise
+    finally:
+        # Flush any rows still waiting in the write-behind buffer
+        if bot is not None:
+            bot.writer.close()
+            if bot.replayer:
+                bot.replayer.close()
+            if bot.store_sync:
+                bot.store_sync.close()
+            bot.executor.shutdown(wait=False)
 
 if __name__ == '__main__':
     main()
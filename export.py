@@ -0,0 +1,60 @@
+import io
+import os
+import csv
+import json
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from sheet_mirror import normalize_row
+
+# Rows read from the sheet (or scanned in the mirror) per page while exporting
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+
+# Same field names as /add_expense and /add_expenses, so an export can be imported again
+EXPORT_COLUMNS = ["fecha", "producto", "lugar", "categoria", "subcategoria", "importe", "cantidad"]
+
+
+def iter_sheet_pages(read_range: Callable[[str], list], page_size: int = EXPORT_PAGE_SIZE) -> Iterator[List[list]]:
+    """Yield the worksheet's expense rows one bounded A1 range at a time, skipping the headers."""
+    first_row = 2
+    while True:
+        values = read_range(f"A{first_row}:G{first_row + page_size - 1}") or []
+        rows = [normalize_row(row) for row in values if any(cell not in ("", None) for cell in row)]
+        if rows:
+            yield rows
+        if len(values) < page_size:
+            return
+        first_row += page_size
+
+
+def filter_pages(pages: Iterable[List[list]], start_day: Optional[str] = None, end_day: Optional[str] = None,
+                 category: Optional[str] = None) -> Iterator[List[list]]:
+    """Keep the rows within the inclusive day range and, if given, the category (case-insensitive)."""
+    category = category.strip().casefold() if category else None
+    for page in pages:
+        rows = [
+            row for row in page
+            if (start_day is None or row[0][:10] >= start_day)
+            and (end_day is None or row[0][:10] <= end_day)
+            and (category is None or row[3].strip().casefold() == category)
+        ]
+        if rows:
+            yield rows
+
+
+def csv_chunks(pages: Iterable[List[list]]) -> Iterator[str]:
+    """Encode pages of rows as CSV, one chunk per page, starting with the header."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    yield buffer.getvalue()
+    for page in pages:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(page)
+        yield buffer.getvalue()
+
+
+def ndjson_chunks(pages: Iterable[List[list]]) -> Iterator[str]:
+    """Encode pages of rows as newline-delimited JSON objects, one chunk per page."""
+    for page in pages:
+        yield "".join(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n" for row in page)
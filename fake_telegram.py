@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Servidor falso de la Bot API de Telegram para medir el bot sin conexión
+
+Responde getMe, getUpdates, setWebhook, deleteWebhook y sendMessage, genera
+mensajes de gastos sintéticos para varios chats y mide cuántas
+actualizaciones por segundo procesa el bot, en modo polling o webhook.
+
+Uso (polling):
+    python fake_telegram.py polling --updates 1000 --chats 50
+    TELEGRAM_BASE_URL=http://127.0.0.1:8081/bot python expense_bot.py
+
+Uso (webhook):
+    python fake_telegram.py webhook --webhook-url http://127.0.0.1:8080/telegram/webhook --secret prueba
+    TELEGRAM_MODE=webhook HTTP_SERVER=builtin WEBHOOK_URL=http://127.0.0.1:8080 \\
+    WEBHOOK_SECRET=prueba TELEGRAM_BASE_URL=http://127.0.0.1:8081/bot python expense_bot.py
+"""
+import re
+import json
+import time
+import argparse
+import threading
+import urllib.request
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakeTelegram:
+    """Estado compartido del servidor falso: actualizaciones pendientes y respuestas recibidas"""
+
+    def __init__(self, updates, chats):
+        self.condition = threading.Condition()
+        self.updates = []
+        self.replies = []
+        self.confirmed = 0
+        self.started_at = None
+        self.finished_at = None
+        self.expected = updates
+        self.webhook_set = threading.Event()
+
+        for number in range(updates):
+            chat_id = 1000 + number % chats
+            sequence = number // chats
+            self.updates.append({
+                "update_id": number + 1,
+                "message": {
+                    "message_id": number + 1,
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": {"id": chat_id, "is_bot": False, "first_name": "Prueba"},
+                    "text": f"Producto {sequence}\nLugar\nCategoria\nSubcategoria\n100\n1"
+                }
+            })
+
+    def get_updates(self, offset, timeout, limit):
+        """Devuelve las actualizaciones desde ``offset``; espera hasta ``timeout`` si no hay"""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                pending = [update for update in self.updates if update["update_id"] >= offset][:limit]
+                if pending:
+                    if self.started_at is None:
+                        self.started_at = time.perf_counter()
+                    return pending
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self.condition.wait(remaining)
+
+    def record_reply(self, chat_id, text):
+        with self.condition:
+            self.replies.append((int(chat_id), text))
+            # El bot une en un solo mensaje las confirmaciones seguidas de un chat
+            self.confirmed += max(1, text.count("Gasto registrado"))
+            if self.confirmed >= self.expected and self.finished_at is None:
+                self.finished_at = time.perf_counter()
+            self.condition.notify_all()
+
+    def wait_done(self, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: self.finished_at is not None, timeout)
+        return self.finished_at is not None
+
+    def ordered_per_chat(self):
+        """Comprueba que cada chat recibió las confirmaciones en el orden enviado"""
+        last = {}
+        for chat_id, text in self.replies:
+            for match in re.findall(r"Producto: Producto (\d+)", text):
+                sequence = int(match)
+                if sequence < last.get(chat_id, -1):
+                    return False
+                last[chat_id] = sequence
+        return True
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _params(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length).decode() if length else ""
+            if "json" in (self.headers.get("Content-Type") or ""):
+                return json.loads(body or "{}")
+            params = {key: values[0] for key, values in parse_qs(body).items()}
+            for key, value in params.items():
+                try:
+                    params[key] = json.loads(value)
+                except ValueError:
+                    pass
+            return params
+
+        def _reply(self, result):
+            payload = json.dumps({"ok": True, "result": result}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            self.do_POST()
+
+        def do_POST(self):
+            method = self.path.rsplit("/", 1)[-1].split("?")[0]
+            params = self._params()
+
+            if method == "getMe":
+                self._reply({"id": 1, "is_bot": True, "first_name": "Bot Falso", "username": "fake_gastos_bot"})
+            elif method == "getUpdates":
+                updates = state.get_updates(int(params.get("offset") or 0),
+                                            float(params.get("timeout") or 0),
+                                            int(params.get("limit") or 100))
+                self._reply(updates)
+            elif method == "sendMessage":
+                state.record_reply(params["chat_id"], params.get("text", ""))
+                self._reply({
+                    "message_id": len(state.replies),
+                    "date": int(time.time()),
+                    "chat": {"id": int(params["chat_id"]), "type": "private"},
+                    "text": params.get("text", "")
+                })
+            else:
+                # setWebhook, deleteWebhook, getWebhookInfo...
+                if method == "setWebhook":
+                    state.webhook_set.set()
+                self._reply(True)
+
+    return Handler
+
+def push_webhook(state, url, secret, concurrency):
+    """Envía las actualizaciones al webhook del bot como lo haría Telegram"""
+    headers = {"Content-Type": "application/json"}
+    if secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+
+    def send(update):
+        request = urllib.request.Request(url, data=json.dumps(update).encode(), headers=headers)
+        with urllib.request.urlopen(request, timeout=30) as response:
+            response.read()
+
+    state.started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, state.updates))
+
+def main():
+    parser = argparse.ArgumentParser(description="Bot API de Telegram falsa para medir el bot")
+    parser.add_argument("mode", choices=["polling", "webhook"])
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--webhook-url", default="http://127.0.0.1:8080/telegram/webhook")
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    state = FakeTelegram(args.updates, args.chats)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"🤖 Bot API falsa en http://127.0.0.1:{args.port}/bot (TELEGRAM_BASE_URL)")
+
+    if args.mode == "webhook":
+        print("⏳ Esperando a que el bot registre el webhook...")
+        if not state.webhook_set.wait(args.timeout):
+            print("❌ El bot no llamó a setWebhook")
+            return
+        push_webhook(state, args.webhook_url, args.secret, args.concurrency)
+    else:
+        print("⏳ Esperando a que el bot haga getUpdates...")
+
+    if not state.wait_done(args.timeout):
+        print(f"❌ Solo se confirmaron {state.confirmed} de {args.updates} gastos")
+        return
+
+    elapsed = state.finished_at - state.started_at
+    print(json.dumps({
+        "mode": args.mode,
+        "updates": args.updates,
+        "chats": args.chats,
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(args.updates / elapsed, 1),
+        "messages_sent": len(state.replies),
+        "ordered_per_chat": state.ordered_per_chat()
+    }))
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# The access token is refreshed in the background this many seconds before it expires
+TOKEN_REFRESH_MARGIN = float(os.getenv("TOKEN_REFRESH_MARGIN", "300"))
+
+# Keep-alive connections kept per Google host, enough for the Sheets workers and the background syncs
+GOOGLE_POOL_SIZE = int(os.getenv("GOOGLE_POOL_SIZE", "16"))
+
+# After this many idle seconds a connection is exercised so Google does not close it (0 disables)
+GOOGLE_KEEPALIVE_INTERVAL = float(os.getenv("GOOGLE_KEEPALIVE_INTERVAL", "60"))
+
+# Answered by Google's front end without touching the Sheets API or its quota
+KEEPALIVE_URL = "https://sheets.googleapis.com/"
+
+
+class GoogleSession:
+    """Service account credentials and the HTTP session shared by every Sheets/Drive call.
+
+    ``session`` is an AuthorizedSession with a keep-alive pool sized for the
+    worker threads; it is handed to gspread's Client, so every call reuses
+    open connections, and token requests go through a pooled session of
+    their own. A daemon thread refreshes the access token ``refresh_margin``
+    seconds before it expires and, when no call was made for
+    ``keepalive_interval`` seconds, sends a HEAD request so the connection
+    stays open. The first request after an idle period then waits neither
+    for a new token nor for a new TLS handshake.
+    """
+
+    def __init__(self, info: dict, scopes: list, refresh_margin: float = TOKEN_REFRESH_MARGIN,
+                 pool_size: int = GOOGLE_POOL_SIZE, keepalive_interval: float = GOOGLE_KEEPALIVE_INTERVAL,
+                 keepalive_url: str = KEEPALIVE_URL):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from google.oauth2.service_account import Credentials
+        from google.auth.transport.requests import AuthorizedSession, Request
+
+        self.credentials = Credentials.from_service_account_info(info, scopes=scopes)
+        self.refresh_margin = refresh_margin
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_url = keepalive_url
+
+        token_session = requests.Session()
+        for prefix in ("https://", "http://"):
+            token_session.mount(prefix, HTTPAdapter(pool_maxsize=2))
+        self._token_request = Request(token_session)
+
+        self.session = AuthorizedSession(self.credentials, auth_request=self._token_request)
+        for prefix in ("https://", "http://"):
+            self.session.mount(prefix, HTTPAdapter(pool_connections=4, pool_maxsize=pool_size))
+        self.session.hooks["response"].append(self._touch)
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_used = time.monotonic()
+        self.refreshes = 0
+        self.keepalives = 0
+        self.last_refresh_ms: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    def _touch(self, response, *args, **kwargs):
+        self._last_used = time.monotonic()
+        return response
+
+    def start(self):
+        """Start the refresh thread if it is not running yet."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="google-token", daemon=True)
+                self._thread.start()
+
+    def close(self):
+        self._stop.set()
+
+    def refresh(self):
+        """Fetch a new access token now."""
+        started = time.perf_counter()
+        self.credentials.refresh(self._token_request)
+        self.refreshes += 1
+        self.last_refresh_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    def expires_in(self) -> Optional[float]:
+        """Seconds until the current token expires, or None before the first token."""
+        expiry = self.credentials.expiry
+        if not self.credentials.token or expiry is None:
+            return None
+        # google-auth keeps expiry as naive UTC
+        return (expiry - datetime.now(timezone.utc).replace(tzinfo=None)).total_seconds()
+
+    def _run(self):
+        failures = 0
+        while not self._stop.is_set():
+            expires_in = self.expires_in()
+            if expires_in is None or expires_in <= self.refresh_margin:
+                try:
+                    self.refresh()
+                    failures = 0
+                    self.last_error = None
+                    # A token that lives less than the margin is refreshed at most once a second
+                    delay = max(1.0, self.expires_in() - self.refresh_margin)
+                except Exception as e:
+                    # Requests still refresh on demand while this keeps failing
+                    failures += 1
+                    self.last_error = str(e)
+                    logger.warning(f"Failed to refresh Google access token: {e}")
+                    delay = min(60.0, 2.0 ** failures)
+            else:
+                delay = expires_in - self.refresh_margin
+
+            if self.keepalive_interval > 0:
+                idle = time.monotonic() - self._last_used
+                if idle >= self.keepalive_interval:
+                    self._keepalive()
+                    idle = 0.0
+                delay = min(delay, self.keepalive_interval - idle)
+            self._stop.wait(max(0.01, delay))
+
+    def _keepalive(self):
+        try:
+            self.session.head(self.keepalive_url, timeout=10)
+            self.keepalives += 1
+        except Exception as e:
+            logger.debug(f"Keep-alive request to Google failed: {e}")
+            self._last_used = time.monotonic()
+
+    def stats(self) -> dict:
+        expires_in = self.expires_in()
+        return {
+            "token_expires_in": round(expires_in, 1) if expires_in is not None else None,
+            "refreshes": self.refreshes,
+            "last_refresh_ms": self.last_refresh_ms,
+            "keepalives": self.keepalives,
+            "last_error": self.last_error,
+        }
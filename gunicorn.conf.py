@@ -0,0 +1,13 @@
+import os
+import multiprocessing
+
+# Web API served by several workers; every worker writes expenses to the
+# shared SQLite outbox that the bot process drains to Google Sheets
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_CONCURRENCY", min(4, multiprocessing.cpu_count() * 2 + 1)))
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", "4"))
+timeout = 60
+keepalive = 5
+accesslog = None
+errorlog = "-"
@@ -0,0 +1,157 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+# Shared by the bot process and any standalone web workers; empty keeps the index in memory only
+IDEMPOTENCY_PATH = os.getenv("IDEMPOTENCY_PATH", os.path.join("data", "idempotency.db"))
+
+# How long a processed key is remembered, and how many keys are kept at most
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "100000"))
+
+# A claim that is never completed (e.g. the process died) can be taken again after this many seconds
+IDEMPOTENCY_PENDING_TIMEOUT = float(os.getenv("IDEMPOTENCY_PENDING_TIMEOUT", "300"))
+
+# Stored result of a key that is claimed but not completed yet
+PENDING = None
+
+# Expired keys are pruned from SQLite once every this many claims
+PRUNE_EVERY = 1000
+
+
+class IdempotencyIndex:
+    """Bounded, time-expiring index of processed requests.
+
+    ``claim(key)`` returns ``(True, None)`` to the first caller, who must then
+    ``complete`` the key with its result (or ``release`` it on failure so a
+    retry can run). Later callers get ``(False, result)`` while the key is
+    remembered, with ``result`` None while the first one is still running.
+
+    Keys live in an in-memory LRU; with a ``path`` they are also stored in
+    SQLite (WAL mode), so claims survive restarts and are atomic across
+    processes sharing the file.
+    """
+
+    def __init__(self, path: str = "", ttl: float = IDEMPOTENCY_TTL, max_keys: int = IDEMPOTENCY_MAX_KEYS,
+                 pending_timeout: float = IDEMPOTENCY_PENDING_TIMEOUT):
+        self.path = path
+        self.ttl = ttl
+        self.max_keys = max(1, max_keys)
+        self.pending_timeout = pending_timeout
+        self._lock = threading.Lock()
+        # key -> (expires_at, result); insertion order is close to expiry order
+        self._keys = OrderedDict()
+        self._claims = 0
+        self.duplicates = 0
+
+        self._conn = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("PRAGMA busy_timeout=5000")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS idempotency ("
+                " key TEXT PRIMARY KEY,"
+                " expires_at REAL NOT NULL,"
+                " result TEXT)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idempotency_expires ON idempotency (expires_at)")
+
+    def claim(self, key: str) -> Tuple[bool, Optional[str]]:
+        """Claim a key for processing, or return the result stored by whoever claimed it first."""
+        now = time.time()
+        with self._lock:
+            self._claims += 1
+            entry = self._keys.get(key)
+            if entry is not None and entry[0] > now:
+                self.duplicates += 1
+                return False, entry[1]
+
+            if self._conn is not None:
+                stored = self._claim_stored(key, now)
+                if stored is not None:
+                    expires_at, result = stored
+                    if result is not PENDING:
+                        self._remember(key, expires_at, result)
+                    self.duplicates += 1
+                    return False, result
+
+            self._remember(key, now + self.pending_timeout, PENDING)
+            return True, None
+
+    def _claim_stored(self, key: str, now: float) -> Optional[Tuple[float, Optional[str]]]:
+        """Insert the claim in SQLite, returning the live entry that prevented it, if any."""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._conn.execute(
+                "SELECT expires_at, result FROM idempotency WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[0] > now:
+                self._conn.execute("COMMIT")
+                return row
+            self._conn.execute(
+                "INSERT INTO idempotency (key, expires_at, result) VALUES (?, ?, NULL)"
+                " ON CONFLICT(key) DO UPDATE SET expires_at = excluded.expires_at, result = NULL",
+                (key, now + self.pending_timeout)
+            )
+            if self._claims % PRUNE_EVERY == 0:
+                self._prune_stored(now)
+            self._conn.execute("COMMIT")
+            return None
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def _prune_stored(self, now: float):
+        self._conn.execute("DELETE FROM idempotency WHERE expires_at <= ?", (now,))
+        excess = self._conn.execute("SELECT COUNT(*) FROM idempotency").fetchone()[0] - self.max_keys
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM idempotency WHERE key IN"
+                " (SELECT key FROM idempotency ORDER BY expires_at LIMIT ?)", (excess,)
+            )
+
+    def _remember(self, key: str, expires_at: float, result: Optional[str]):
+        self._keys[key] = (expires_at, result)
+        self._keys.move_to_end(key)
+        # Drop expired keys from the front, then the oldest ones over the limit
+        now = time.time()
+        while self._keys:
+            oldest = next(iter(self._keys.values()))
+            if oldest[0] > now and len(self._keys) <= self.max_keys:
+                break
+            self._keys.popitem(last=False)
+
+    def complete(self, key: str, result: str = ""):
+        """Mark a claimed key as processed; repeats get ``result`` until it expires."""
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, expires_at, result)
+            if self._conn is not None:
+                self._conn.execute(
+                    "UPDATE idempotency SET expires_at = ?, result = ? WHERE key = ?",
+                    (expires_at, result, key)
+                )
+
+    def release(self, key: str):
+        """Forget a claim whose processing failed, so a retry is processed again."""
+        with self._lock:
+            self._keys.pop(key, None)
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM idempotency WHERE key = ? AND result IS NULL", (key,))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"keys_in_memory": len(self._keys), "duplicates": self.duplicates}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
@@ -1,14 +1,257 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g, stream_with_context
 from threading import Thread
+import functools
+import hashlib
+import io
 import json
 import os
+import re
+import time
 from datetime import datetime
 
+from bulk_ingest import iter_json_array, iter_ndjson, iter_csv, BulkFormatError, READ_SIZE
+from export import csv_chunks, ndjson_chunks
+from outbox import ExpenseOutbox, expense_row, OUTBOX_PATH
+from idempotency import IdempotencyIndex, IDEMPOTENCY_PATH
+from storage import SQLiteBackend, STORAGE_BACKEND, EXPENSES_DB_PATH
+from recurring import RecurringStore, parse_frequency, FREQUENCY_NAMES, RECURRING_PATH
+import log_pipeline
+from metrics import API_ADD_EXPENSE, API_ADD_EXPENSES, CONTENT_TYPE, render as render_metrics
+
 app = Flask(__name__)
 
+# Request latency recorded per endpoint
+TIMED_ENDPOINTS = {
+    'add_expense': API_ADD_EXPENSE,
+    'add_expenses': API_ADD_EXPENSES
+}
+
+@app.before_request
+def start_timer():
+    if request.endpoint in TIMED_ENDPOINTS:
+        g.started = time.perf_counter()
+
+@app.after_request
+def record_latency(response):
+    histogram = TIMED_ENDPOINTS.get(request.endpoint)
+    if histogram is not None and 'started' in g:
+        histogram.observe(time.perf_counter() - g.started)
+    return response
+
 # Global variable to store bot instance
 bot_instance = None
 
+# Telegram webhook: the bot registers a callback that hands updates to its event loop
+WEBHOOK_PATH = '/telegram/webhook'
+webhook_handler = None
+webhook_secret = None
+
+class OutboxStorage:
+    """Storage for standalone web workers (e.g. gunicorn) running without the bot.
+    
+    Expenses are appended to the shared SQLite outbox, which the bot process
+    drains to Google Sheets, or with the sqlite and sync backends to the
+    shared expense database, so every worker writes through the same backend.
+    """
+    sheet = None
+    mirror = None
+    aggregates = None
+    quota = None
+    tenants = None
+    partitions = None
+    google_session = None
+    budgets = None
+    replies = None
+    recurring_runner = None
+    recurring_wakeup = None
+    
+    def __init__(self, path):
+        self.outbox = None
+        self.storage = None
+        if STORAGE_BACKEND != "sheets":
+            self.storage = SQLiteBackend(EXPENSES_DB_PATH)
+        else:
+            self.outbox = ExpenseOutbox(path)
+        # Persisted in the shared file, so a retry landing on another worker is still detected
+        self.idempotency = IdempotencyIndex(IDEMPOTENCY_PATH)
+        # Definitions registered here are written by the bot process on its next check
+        self.recurring = RecurringStore(RECURRING_PATH) if RECURRING_PATH else None
+    
+    def _log_expense_to_sheet(self, expense_data, tenant=None):
+        return self._log_expenses_to_sheet([expense_data], tenant)
+    
+    def _log_expenses_to_sheet(self, expenses, tenant=None):
+        rows = [expense_row(expense_data) for expense_data in expenses]
+        # Flagged so the bot adds them to its budget totals, as it does with the rows it writes itself
+        if self.storage is not None:
+            self.storage.append_rows(rows, tenant, untracked=True)
+        else:
+            self.outbox.append_many(rows, tenant, untracked=True)
+        return True
+    
+    def readiness(self):
+        # Only the local outbox is needed to accept expenses
+        return {"state": "ready", "ready": True, "since": None, "error": None}
+    
+    def storage_status(self):
+        return self.storage.stats() if self.storage is not None else {"backend": STORAGE_BACKEND}
+    
+    def outbox_status(self):
+        if self.outbox is None:
+            return None
+        oldest_age = self.outbox.oldest_age()
+        return {
+            "depth": self.outbox.depth(),
+            "oldest_age_seconds": round(oldest_age, 3) if oldest_age is not None else None
+        }
+
+def get_bot():
+    """Return the bot instance, or the shared local store when running as a standalone web worker."""
+    global bot_instance
+    if bot_instance is None and (OUTBOX_PATH or STORAGE_BACKEND != "sheets"):
+        bot_instance = OutboxStorage(OUTBOX_PATH)
+    return bot_instance
+
+def api_tenant():
+    """Tenant of an API request: its X-Api-Key, if any, otherwise the shared sheet."""
+    api_key = request.headers.get('X-Api-Key')
+    return f"api:{api_key}" if api_key else None
+
+class _HashingInput(io.RawIOBase):
+    """Request body that hashes the bytes as the view reads them, so even a streamed upload gets a fingerprint."""
+    
+    def __init__(self, raw):
+        self.raw = raw
+        self.digest = hashlib.sha256()
+        self.consumed = 0
+    
+    def readable(self):
+        return True
+    
+    def readinto(self, buffer):
+        data = self.raw.read(len(buffer))
+        self.digest.update(data)
+        self.consumed += len(data)
+        buffer[:len(data)] = data
+        return len(data)
+    
+    def fingerprint(self, length):
+        """Hash whatever the view left unread (up to the body's ``length``) and return the body's digest."""
+        while length is None or self.consumed < length:
+            data = self.raw.read(READ_SIZE if length is None else min(READ_SIZE, length - self.consumed))
+            if not data:
+                break
+            self.digest.update(data)
+            self.consumed += len(data)
+        return self.digest.hexdigest()
+
+def idempotent(view):
+    """Process a request once per Idempotency-Key and replay the stored response to retries.
+    
+    Keys are scoped to the endpoint and the X-Api-Key, and remember a hash
+    of the body: reusing a key with a different body is rejected with 422.
+    Server errors release the key so that the client's retry is processed
+    again, unless the view set ``g.committed`` because part of the request
+    was already stored; then the response is kept, so a retry cannot write
+    those rows twice.
+    """
+    @functools.wraps(view)
+    def wrapper():
+        key = request.headers.get('Idempotency-Key')
+        bot = get_bot()
+        index = getattr(bot, 'idempotency', None)
+        if not key or index is None:
+            return view()
+        
+        # Installed before anything reads the body
+        body = _HashingInput(request.environ['wsgi.input'])
+        request.environ['wsgi.input'] = io.BufferedReader(body)
+        
+        scoped_key = f"{request.path}:{api_tenant() or ''}:{key}"
+        claimed, stored = index.claim(scoped_key)
+        if not claimed:
+            if stored is None:
+                return jsonify({"error": "Ya hay una petición en curso con esta Idempotency-Key"}), 409
+            replay = json.loads(stored)
+            if replay.get("fingerprint") not in (None, body.fingerprint(request.content_length)):
+                return jsonify({"error": "Esta Idempotency-Key ya se usó con otro contenido"}), 422
+            response = Response(replay["body"], status=replay["status"], content_type='application/json')
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        
+        try:
+            response = app.make_response(view())
+        except Exception:
+            if not g.get('committed'):
+                index.release(scoped_key)
+                raise
+            response = app.make_response((jsonify({"error": "Error interno tras registrar parte de los gastos"}), 500))
+        if response.status_code >= 500 and not g.get('committed'):
+            index.release(scoped_key)
+        else:
+            index.complete(scoped_key, json.dumps({
+                "status": response.status_code,
+                "body": response.get_data(as_text=True),
+                "fingerprint": body.fingerprint(request.content_length)
+            }))
+        return response
+    
+    return wrapper
+
+# Fields accepted by /add_expense and /add_expenses
+REQUIRED_FIELDS = ['producto', 'lugar', 'categoria', 'subcategoria', 'importe', 'cantidad']
+
+# Formats accepted in 'fecha', as the bot writes dates: partitions, budgets and exports bucket rows by its prefix
+API_DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+# Rows written per sheet batch and per-row errors reported by /add_expenses
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "500"))
+BULK_MAX_ERRORS = int(os.getenv("BULK_MAX_ERRORS", "1000"))
+
+def api_date(value) -> str:
+    """Validate an API 'fecha' (AAAA-MM-DD or AAAA-MM-DD HH:MM:SS) and return it unchanged."""
+    text = str(value)
+    for date_format in API_DATE_FORMATS:
+        try:
+            parsed = datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+        # strptime also takes unpadded fields ("2025-7-1"), which would sort and bucket apart
+        if parsed.strftime(date_format) == text:
+            return text
+    raise ValueError(f"Fecha inválida: {value} (se espera AAAA-MM-DD o AAAA-MM-DD HH:MM:SS)")
+
+def expense_from_api(data):
+    """Map an API record (producto, lugar, ...) to the bot's expense format.
+    
+    An optional 'fecha' keeps the original date of imported expenses.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Se esperaba un objeto con los campos del gasto")
+    
+    missing_fields = [field for field in REQUIRED_FIELDS if field not in data or data[field] in (None, '')]
+    if missing_fields:
+        raise ValueError(f"Faltan campos requeridos: {', '.join(missing_fields)}")
+    
+    try:
+        amount = float(data['importe'])
+    except (TypeError, ValueError):
+        raise ValueError(f"Importe inválido: {data['importe']}")
+    try:
+        quantity = int(data['cantidad'])
+    except (TypeError, ValueError):
+        raise ValueError(f"Cantidad inválida: {data['cantidad']}")
+    
+    return {
+        'date': api_date(data['fecha']) if data.get('fecha') else datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'product': str(data['producto']),
+        'place': str(data['lugar']),
+        'category': str(data['categoria']),
+        'subcategory': str(data['subcategoria']),
+        'amount': amount,
+        'quantity': quantity
+    }
+
 @app.route('/')
 def home():
     return """
@@ -51,16 +294,32 @@ def home():
 @app.route('/status')
 def status():
     """Check bot status"""
+    bot = get_bot()
     return jsonify({
         "status": "running",
-        "bot_connected": bot_instance is not None,
-        "google_sheets_connected": bot_instance.sheet is not None if bot_instance else False,
+        "readiness": bot.readiness() if bot else {"state": "starting", "ready": False, "since": None, "error": None},
+        "bot_connected": bot is not None and not isinstance(bot, OutboxStorage),
+        "google_sheets_connected": bot.sheet is not None if bot else False,
+        "outbox": bot.outbox_status() if bot else None,
+        "storage": bot.storage_status() if bot else None,
+        "google_api": bot.quota.stats() if bot and bot.quota else None,
+        "google_session": bot.google_session.stats() if bot and bot.google_session is not None else None,
+        "mirror": bot.mirror.stats() if bot and bot.mirror is not None else None,
+        "tenants": bot.tenants.stats() if bot and bot.tenants is not None else None,
+        "partitions": bot.partitions.stats() if bot and bot.partitions is not None else None,
+        "idempotency": bot.idempotency.stats() if bot and bot.idempotency is not None else None,
+        "budgets": bot.budgets.stats() if bot and bot.budgets is not None else None,
+        "telegram_replies": bot.replies.stats() if bot and bot.replies is not None else None,
+        "recurring": bot.recurring_runner.stats() if bot and bot.recurring_runner is not None else None,
+        "logging": log_pipeline.pipeline.stats() if log_pipeline.pipeline is not None else None,
+        "pid": os.getpid(),
         "timestamp": datetime.now().isoformat(),
         "message": "Bot de gastos funcionando correctamente",
         "environment": os.getenv("RAILWAY_ENVIRONMENT", "development")
     })
 
 @app.route('/add_expense', methods=['POST'])
+@idempotent
 def add_expense():
     """Add expense via API"""
     try:
@@ -70,28 +329,20 @@ def add_expense():
             return jsonify({"error": "No se proporcionaron datos"}), 400
         
         # Validate required fields
-        required_fields = ['producto', 'lugar', 'categoria', 'subcategoria', 'importe', 'cantidad']
-        missing_fields = [field for field in required_fields if field not in data]
+        missing_fields = [field for field in REQUIRED_FIELDS if field not in data]
         
         if missing_fields:
             return jsonify({"error": f"Faltan campos requeridos: {', '.join(missing_fields)}"}), 400
         
-        if bot_instance is None:
+        bot = get_bot()
+        if bot is None:
             return jsonify({"error": "Bot no está inicializado"}), 500
         
         # Create expense data in the same format as telegram messages
-        expense_data = {
-            'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'product': str(data['producto']),
-            'place': str(data['lugar']),
-            'category': str(data['categoria']),
-            'subcategory': str(data['subcategoria']),
-            'amount': float(data['importe']),
-            'quantity': int(data['cantidad'])
-        }
+        expense_data = expense_from_api(data)
         
         # Use bot's method to log expense
-        success = bot_instance._log_expense_to_sheet(expense_data)
+        success = bot._log_expense_to_sheet(expense_data, tenant=api_tenant())
         
         if success:
             return jsonify({
@@ -110,8 +361,254 @@ def add_expense():
         else:
             return jsonify({"error": "Error al registrar el gasto en Google Sheets"}), 500
             
+    except ValueError as e:
+        # Invalid fields (importe, cantidad, fecha) are the client's error, like in /recurring
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": f"Error interno: {str(e)}"}), 500
+
+@app.route('/add_expenses', methods=['POST'])
+@idempotent
+def add_expenses():
+    """Add many expenses via API from a JSON array, NDJSON or CSV body"""
+    bot = get_bot()
+    if bot is None:
+        return jsonify({"error": "Bot no está inicializado"}), 500
+    
+    tenant = api_tenant()
+    content_type = (request.mimetype or '').lower()
+    if content_type in ('application/x-ndjson', 'application/jsonl', 'application/ndjson'):
+        records = iter_ndjson(request.stream)
+    elif content_type == 'text/csv':
+        records = iter_csv(request.stream)
+    elif content_type == 'application/json':
+        records = iter_json_array(request.stream)
+    else:
+        return jsonify({"error": "Content-Type no soportado. Usa application/json, application/x-ndjson o text/csv"}), 415
+    
+    received = 0
+    registered = 0
+    failed = 0
+    errors = []
+    omitted_errors = 0
+    chunk = []
+    chunk_rows = []
+    
+    def report_error(row_number, message):
+        nonlocal omitted_errors
+        if len(errors) < BULK_MAX_ERRORS:
+            errors.append({"fila": row_number, "error": message})
+        else:
+            omitted_errors += 1
+    
+    def flush_chunk():
+        nonlocal registered, failed
+        if not chunk:
+            return
+        try:
+            stored = bot._log_expenses_to_sheet(chunk, tenant=tenant)
+        except Exception:
+            stored = False
+        if stored:
+            registered += len(chunk)
+            # From here on a retry must not be processed again (see idempotent)
+            g.committed = True
+        else:
+            failed += len(chunk)
+            for row_number in chunk_rows:
+                report_error(row_number, "Error al registrar el gasto en Google Sheets")
+        chunk.clear()
+        chunk_rows.clear()
+    
+    try:
+        # Validate and write row by row so memory stays flat for any upload size
+        for row_number, record in records:
+            received += 1
+            if isinstance(record, Exception):
+                report_error(row_number, str(record))
+                continue
+            try:
+                chunk.append(expense_from_api(record))
+                chunk_rows.append(row_number)
+            except ValueError as e:
+                report_error(row_number, str(e))
+                continue
+            if len(chunk) >= BULK_CHUNK_SIZE:
+                flush_chunk()
+        flush_chunk()
+    except BulkFormatError as e:
+        flush_chunk()
+        report_error(received + 1, str(e))
+    except Exception as e:
+        flush_chunk()
+        return jsonify({"error": f"Error interno: {str(e)}", "recibidos": received, "registrados": registered}), 500
+    
+    response = {
+        "success": not errors and not omitted_errors,
+        "recibidos": received,
+        "registrados": registered,
+        "errores": errors
+    }
+    if omitted_errors:
+        response["errores_omitidos"] = omitted_errors
+    if failed and not registered:
+        # Nothing was stored because the storage failed: a server error, so the retry is processed
+        return jsonify(response), 503
+    return jsonify(response), 200 if registered or not errors else 400
+
+@app.route('/summary')
+def summary():
+    """Spending totals served from the bot's running aggregates"""
+    bot = get_bot()
+    if bot is None:
+        return jsonify({"error": "Bot no está inicializado"}), 500
+    if bot.aggregates is None:
+        return jsonify({"error": "Los totales solo están disponibles en el proceso del bot"}), 503
+    
+    # With the SQLite backend, first take in rows written since the last query
+    if hasattr(bot, 'refresh_aggregates'):
+        bot.refresh_aggregates()
+    
+    aggregates = bot.aggregates
+    now = datetime.now()
+    month = request.args.get('mes', now.strftime('%Y-%m'))
+    day = request.args.get('dia', now.strftime('%Y-%m-%d'))
+    
+    response = {
+        "historial_cargado": bot.mirror.loaded if bot.mirror is not None else None,
+        "total": aggregates.overview(),
+        "mes": aggregates.month(month),
+        "dia": {"dia": day, **aggregates.day(day)}
+    }
+    
+    category = request.args.get('categoria')
+    if category:
+        stored = aggregates.find_category(category)
+        response["categoria"] = aggregates.category(stored, month=request.args.get('mes')) if stored else None
+    
+    return jsonify(response)
+
+@app.route('/budgets', methods=['GET', 'POST'])
+def budgets():
+    """List monthly budgets with this month's spending, or set one (importe 0 removes it)"""
+    bot = get_bot()
+    if bot is None:
+        return jsonify({"error": "Bot no está inicializado"}), 500
+    if bot.budgets is None:
+        return jsonify({"error": "Los presupuestos solo están disponibles en el proceso del bot"}), 503
+    
+    if request.method == 'GET':
+        return jsonify({"mes": bot.budgets.month, "presupuestos": bot.budgets.status(),
+                        "historial_cargado": bot.budgets.loaded})
+    
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not str(data.get('categoria') or '').strip():
+        return jsonify({"error": "Faltan campos requeridos: categoria, importe"}), 400
+    try:
+        amount = float(data.get('importe'))
+    except (TypeError, ValueError):
+        return jsonify({"error": f"Importe inválido: {data.get('importe')}"}), 400
+    if amount < 0:
+        return jsonify({"error": "El importe no puede ser negativo"}), 400
+    
+    category = str(data['categoria']).strip()
+    subcategory = str(data.get('subcategoria') or '').strip() or None
+    if amount == 0:
+        removed = bot.budgets.store.remove(category, subcategory)
+        return jsonify({"success": removed, "categoria": category, "subcategoria": subcategory}), 200 if removed else 404
+    
+    bot.budgets.store.set(category, subcategory, amount)
+    return jsonify({"success": True, "categoria": category, "subcategoria": subcategory, "importe": amount})
+
+@app.route('/recurring', methods=['GET', 'POST', 'DELETE'])
+def recurring():
+    """List recurring expenses, register one (POST with the expense fields, frecuencia and inicio) or remove one (?id=N)"""
+    bot = get_bot()
+    if bot is None:
+        return jsonify({"error": "Bot no está inicializado"}), 500
+    if bot.recurring is None:
+        return jsonify({"error": "Los gastos recurrentes no están habilitados"}), 503
+    tenant = api_tenant()
+    
+    if request.method == 'GET':
+        return jsonify({"recurrentes": bot.recurring.list(tenant)})
+    
+    if request.method == 'DELETE':
+        definition_id = request.args.get('id', '')
+        if not definition_id.isdigit():
+            return jsonify({"error": "Falta el parámetro id"}), 400
+        removed = bot.recurring.remove(int(definition_id), tenant)
+        return jsonify({"success": removed, "id": int(definition_id)}), 200 if removed else 404
+    
+    data = request.get_json(silent=True)
+    frequency = parse_frequency(str(data.get('frecuencia') or 'mensual')) if isinstance(data, dict) else None
+    if isinstance(data, dict) and frequency is None:
+        return jsonify({"error": f"Frecuencia inválida: {data.get('frecuencia')} (mensual, semanal o anual)"}), 400
+    try:
+        expense_data = expense_from_api(data)
+        start = datetime.strptime(str(data.get('inicio') or datetime.now().strftime('%Y-%m-%d')), '%Y-%m-%d').date()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    definition_id = bot.recurring.add(expense_data, frequency, start, tenant)
+    if bot.recurring_wakeup is not None:
+        bot.recurring_wakeup()
+    return jsonify({"success": True, "id": definition_id, "frecuencia": FREQUENCY_NAMES[frequency],
+                    "inicio": start.isoformat()})
+
+@app.route('/export')
+def export():
+    """Stream the expense history as CSV or NDJSON, filtered by date range and category"""
+    bot = get_bot()
+    if bot is None:
+        return jsonify({"error": "Bot no está inicializado"}), 500
+    if not hasattr(bot, 'export_pages'):
+        return jsonify({"error": "La exportación solo está disponible en el proceso del bot"}), 503
+    
+    export_format = request.args.get('formato', 'csv').lower()
+    if export_format not in ('csv', 'ndjson'):
+        return jsonify({"error": "Formato no soportado. Usa formato=csv o formato=ndjson"}), 400
+    start_day = request.args.get('desde')
+    end_day = request.args.get('hasta')
+    for day in (start_day, end_day):
+        if day is not None and not re.fullmatch(r"\d{4}-\d{2}-\d{2}", day):
+            return jsonify({"error": f"Fecha inválida: {day}. Usa AAAA-MM-DD"}), 400
+    
+    try:
+        pages = bot.export_pages(start_day, end_day, request.args.get('categoria'), tenant=api_tenant())
     except Exception as e:
         return jsonify({"error": f"Error interno: {str(e)}"}), 500
+    
+    # Rows are read and encoded page by page while the response is being sent
+    if export_format == 'csv':
+        chunks, mimetype = csv_chunks(pages), 'text/csv'
+    else:
+        chunks, mimetype = ndjson_chunks(pages), 'application/x-ndjson'
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="gastos.{export_format}"'
+    return response
+
+@app.route(WEBHOOK_PATH, methods=['POST'])
+def telegram_webhook():
+    """Receive Telegram updates when the bot runs in webhook mode"""
+    if webhook_handler is None:
+        return jsonify({"error": "Webhook no está activo"}), 503
+    
+    if webhook_secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != webhook_secret:
+        return jsonify({"error": "No autorizado"}), 403
+    
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({"error": "No se proporcionaron datos"}), 400
+    
+    # Processing happens on the bot's event loop; answer Telegram right away
+    webhook_handler(data)
+    return jsonify({"ok": True})
+
+@app.route('/metrics')
+def metrics():
+    """Latency histograms and counters in Prometheus text format"""
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
 
 @app.route('/health')
 def health():
@@ -125,13 +622,23 @@ def help_endpoint():
         "endpoints": {
             "/": "Página principal con estado del bot",
             "/status": "Estado detallado del bot en JSON",
-            "/health": "Health check simple",
+            "/health": "Health check simple (responde aunque el bot siga conectándose)",
             "/add_expense": "Agregar gasto (POST con datos JSON)",
+            "/add_expenses": "Agregar muchos gastos (POST con arreglo JSON, NDJSON o CSV)",
+            "/summary": "Totales por día, mes, categoría y lugar (?mes=AAAA-MM&dia=AAAA-MM-DD&categoria=X)",
+            "/export": "Exportar gastos en CSV o NDJSON (?formato=csv|ndjson&desde=AAAA-MM-DD&hasta=AAAA-MM-DD&categoria=X)",
+            "/budgets": "Presupuestos mensuales y gasto del mes (GET); fijar uno con POST {categoria, subcategoria opcional, importe} (importe 0 lo borra)",
+            "/recurring": "Gastos recurrentes (GET); registrar uno con POST {campos del gasto, frecuencia: mensual|semanal|anual, inicio: AAAA-MM-DD}; borrar con DELETE ?id=N",
+            "/metrics": "Métricas de latencia y errores en formato Prometheus",
             "/help": "Esta ayuda"
         },
         "add_expense_format": {
             "method": "POST",
             "content_type": "application/json",
+            "headers": {
+                "X-Api-Key": "Opcional: clave asociada a una hoja propia (ver tenants.py)",
+                "Idempotency-Key": "Opcional: identificador único del gasto; los reintentos con la misma clave no lo registran otra vez"
+            },
             "body": {
                 "producto": "Nombre del producto",
                 "lugar": "Lugar de compra",
@@ -141,6 +648,12 @@ def help_endpoint():
                 "cantidad": "Cantidad (número)"
             }
         },
+        "add_expenses_format": {
+            "method": "POST",
+            "content_types": ["application/json", "application/x-ndjson", "text/csv"],
+            "headers": {"Idempotency-Key": "Opcional: los reintentos de la misma carga devuelven la respuesta original"},
+            "body": "Arreglo JSON de objetos, un objeto JSON por línea, o CSV con encabezado producto,lugar,categoria,subcategoria,importe,cantidad"
+        },
         "example": {
             "producto": "Pan",
             "lugar": "Panadería",
@@ -151,6 +664,12 @@ def help_endpoint():
         }
     })
 
+def set_webhook_handler(handler, secret):
+    """Set the callback that receives Telegram webhook updates"""
+    global webhook_handler, webhook_secret
+    webhook_handler = handler
+    webhook_secret = secret
+
 def set_bot_instance(bot):
     """Set the bot instance for API access"""
     global bot_instance
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Prueba de carga de la API web (/health y /add_expense)
+
+Uso:
+    python load_test.py http://localhost:8080 --concurrency 32 --requests 2000
+"""
+import json
+import time
+import argparse
+import statistics
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+EXPENSE = {
+    "producto": "Pan",
+    "lugar": "Panadería",
+    "categoria": "Comida",
+    "subcategoria": "Productos básicos",
+    "importe": 2500,
+    "cantidad": 1
+}
+
+def request_once(url, body):
+    """Send one request and return (latency in seconds, ok)"""
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            response.read()
+            ok = response.status == 200
+    except Exception:
+        ok = False
+    return time.perf_counter() - started, ok
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run(base_url, path, body, concurrency, total):
+    """Run ``total`` requests against one endpoint with ``concurrency`` threads"""
+    url = base_url.rstrip("/") + path
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda _: request_once(url, body), range(total)))
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for latency, _ in results]
+    errors = sum(1 for _, ok in results if not ok)
+    return {
+        "endpoint": path,
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": errors,
+        "rps": round(total / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga de la API del Bot de Gastos")
+    parser.add_argument("url", nargs="?", default="http://localhost:8080")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    for path, body in (("/health", None), ("/add_expense", EXPENSE)):
+        result = run(args.url, path, body, args.concurrency, args.requests)
+        print(json.dumps(result))
+
+if __name__ == "__main__":
+    main()
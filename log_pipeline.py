@@ -0,0 +1,139 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Optional
+
+from metrics import LOG_RECORDS_DROPPED
+
+# "json" writes one JSON object per line; "text" keeps the classic one-line format
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+
+# Records waiting for the writer thread; when it falls behind, new records are dropped instead of blocking
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# Fraction of high-volume events (one per expense, update or batch) that are logged; warnings and errors always are
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Attributes every LogRecord has; anything else was passed in ``extra`` and becomes a JSON field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName", "sample"}
+
+# Set by setup_logging, reported by /status
+pipeline: Optional["LogPipeline"] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: ts, level, logger, msg, the ``extra`` fields and exc."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        event = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                event[key] = value
+        if record.exc_info:
+            event["exc"] = self.formatException(record.exc_info)
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+
+class LogPipeline(logging.Handler):
+    """Handler that only enqueues records; one background thread formats and writes them.
+
+    Logging calls from the event loop, the Flask threads and the workers
+    never wait for the sink: records go into a bounded queue, and while the
+    writer is stalled (e.g. a blocked stderr pipe) new ones are dropped and
+    counted. Records logged with ``extra={"sample": True}`` below WARNING
+    are kept with probability ``sample_rate``. Messages are rendered by the
+    writer thread, so pass values as arguments or ``extra`` fields rather
+    than pre-formatting them.
+    """
+
+    def __init__(self, sink: logging.Handler, max_queue: int = LOG_QUEUE_SIZE, sample_rate: float = LOG_SAMPLE_RATE):
+        super().__init__()
+        self.sink = sink
+        self.sample_rate = sample_rate
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.dropped = 0
+        self.sampled_out = 0
+
+    def emit(self, record: logging.LogRecord):
+        if (self.sample_rate < 1.0 and getattr(record, "sample", False) and record.levelno < logging.WARNING
+                and random.random() >= self.sample_rate):
+            self.sampled_out += 1
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            LOG_RECORDS_DROPPED.inc()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 2.0):
+        """Write what is queued, waiting at most ``timeout`` seconds for a stalled sink."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            try:
+                record = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                if self._stop.is_set():
+                    return
+                continue
+            if record.levelno >= self.sink.level:
+                self.sink.handle(record)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+            "sample_rate": self.sample_rate,
+        }
+
+
+def setup_logging() -> Optional[LogPipeline]:
+    """Send the root logger's records through a LogPipeline writing to stderr.
+
+    Like ``logging.basicConfig`` it does nothing when logging is already
+    configured (e.g. by the benchmark or gunicorn).
+    """
+    global pipeline
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+    sink = logging.StreamHandler(sys.stderr)
+    sink.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT))
+    pipeline = LogPipeline(sink)
+    root.addHandler(pipeline)
+    root.setLevel(LOG_LEVEL.upper())
+    pipeline.start()
+    atexit.register(pipeline.stop)
+    return pipeline
+
+
+def elapsed_ms(started: float) -> float:
+    """Milliseconds since a ``time.perf_counter()`` reading, for stage timings in log events."""
+    return round((time.perf_counter() - started) * 1000, 3)
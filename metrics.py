@@ -0,0 +1,262 @@
+import bisect
+import collections
+import threading
+import time
+import weakref
+from typing import Dict, List, Sequence, Tuple
+
+# Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Latency buckets in seconds, from sub-millisecond parsing to slow Sheets calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _Shards:
+    """Per-thread value lists that are summed only when metrics are collected.
+
+    Each thread writes to its own list, so recording never takes a lock;
+    the lock is only held once per thread (to register its list) and while
+    collecting. When a thread exits its list is folded into a base total,
+    so a server that starts a thread per request keeps one list per live
+    thread instead of one per thread it ever ran.
+    """
+
+    def __init__(self, size: int):
+        self._size = size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._all: Dict[int, list] = {}
+        self._base = [0] * size
+        # Filled by finalizers, which may run inside any thread (even one holding the
+        # lock), so they only append here and the folding happens under the lock
+        self._dead: collections.deque = collections.deque()
+
+    def local(self) -> list:
+        holder = getattr(self._local, "holder", None)
+        if holder is None:
+            holder = self._local.holder = _ShardHolder([0] * self._size)
+            key = id(holder.values)
+            # The thread-local (and so the holder) is dropped when the thread exits
+            weakref.finalize(holder, self._dead.append, key)
+            with self._lock:
+                self._fold_dead()
+                self._all[key] = holder.values
+        return holder.values
+
+    def _fold_dead(self):
+        while self._dead:
+            values = self._all.pop(self._dead.popleft(), None)
+            if values is not None:
+                for index, value in enumerate(values):
+                    self._base[index] += value
+
+    def totals(self) -> list:
+        with self._lock:
+            self._fold_dead()
+            totals = list(self._base)
+            shards = list(self._all.values())
+        for values in shards:
+            for index, value in enumerate(values):
+                totals[index] += value
+        return totals
+
+
+class _ShardHolder:
+    __slots__ = ("values", "__weakref__")
+
+    def __init__(self, values: list):
+        self.values = values
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_started")
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._started)
+
+
+class _CounterChild:
+    def __init__(self):
+        self._shards = _Shards(1)
+
+    def inc(self, amount: float = 1):
+        self._shards.local()[0] += amount
+
+    def value(self) -> float:
+        return self._shards.totals()[0]
+
+
+class _HistogramChild:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        # One slot per bucket, one for +Inf, and the running sum
+        self._shards = _Shards(len(self.buckets) + 2)
+
+    def observe(self, value: float):
+        values = self._shards.local()
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def time(self) -> _Timer:
+        """Context manager that observes the elapsed time of its block."""
+        return _Timer(self)
+
+    def snapshot(self) -> Tuple[List[int], int, float]:
+        """Cumulative bucket counts, total count and sum."""
+        totals = self._shards.totals()
+        cumulative = []
+        running = 0
+        for count in totals[:-1]:
+            running += count
+            cumulative.append(running)
+        return cumulative, running, totals[-1]
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[tuple, object] = {}
+        self._lock = threading.Lock()
+        self._default = self.labels() if not self.labelnames else None
+        REGISTRY.append(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """Child for one combination of label values (keep a reference on hot paths)."""
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _label_text(self, values, extra=()) -> str:
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self._default.inc(amount)
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{self._label_text(values)} {_number(child.value())}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _render_child(self, values, child):
+        cumulative, count, total = child.snapshot()
+        lines = []
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), cumulative):
+            le = "+Inf" if bound == float("inf") else _number(bound)
+            lines.append(f"{self.name}_bucket{self._label_text(values, [('le', le)])} {bucket_count}")
+        lines.append(f"{self.name}_sum{self._label_text(values)} {_number(total)}")
+        lines.append(f"{self.name}_count{self._label_text(values)} {count}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+REGISTRY: List[_Metric] = []
+
+# Expense pipeline metrics, recorded by the bot, the quota scheduler and the web API
+STAGE_SECONDS = Histogram(
+    "expense_stage_seconds",
+    "Latency of each stage of the expense pipeline in seconds",
+    ["stage"]
+)
+PARSE_FAILURES = Counter("expense_parse_failures_total", "Telegram messages that could not be parsed as an expense")
+ROWS_APPENDED = Counter("expense_rows_appended_total", "Rows appended to Google Sheets")
+GOOGLE_API_CALLS = Counter("google_api_calls_total", "Google Sheets/Drive calls by kind", ["kind"])
+GOOGLE_API_ERRORS = Counter("google_api_errors_total", "Google Sheets/Drive errors by class", ["error_class"])
+GOOGLE_API_RETRIES = Counter("google_api_retries_total", "Google Sheets/Drive calls retried after an error")
+QUOTA_ERRORS = Counter("google_quota_errors_total", "Rate limit and storage quota errors from Google")
+TELEGRAM_RETRY_AFTER = Counter("telegram_retry_after_total", "Telegram flood control (RetryAfter) responses to replies")
+TELEGRAM_REPLIES_MERGED = Counter("telegram_replies_merged_total", "Confirmations merged into an earlier reply still waiting to be sent")
+LOG_RECORDS_DROPPED = Counter("log_records_dropped_total", "Log records dropped because the log writer fell behind")
+
+# Stage children resolved once so the hot path does not look them up
+PARSE = STAGE_SECONDS.labels("parse")
+SHEET_RESOLVE = STAGE_SECONDS.labels("sheet_resolve")
+SHEET_APPEND = STAGE_SECONDS.labels("sheet_append")
+OUTBOX_APPEND = STAGE_SECONDS.labels("outbox_append")
+STORE_APPEND = STAGE_SECONDS.labels("store_append")
+TELEGRAM_UPDATE = STAGE_SECONDS.labels("telegram_update")
+TELEGRAM_REPLY = STAGE_SECONDS.labels("telegram_reply")
+API_ADD_EXPENSE = STAGE_SECONDS.labels("api_add_expense")
+API_ADD_EXPENSES = STAGE_SECONDS.labels("api_add_expenses")
+
+
+def start_http_server(port: int, host: str = "0.0.0.0"):
+    """Serve /metrics from a daemon thread, for processes without the Flask API."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            payload = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,233 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Set
+
+from quota import TokenBucket
+from metrics import TELEGRAM_REPLY, TELEGRAM_RETRY_AFTER, TELEGRAM_REPLIES_MERGED
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages per second in total and about one per second in each chat
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+
+# Replies waiting to be sent; beyond this new ones are dropped (and logged) instead of piling up
+REPLY_QUEUE_SIZE = int(os.getenv("REPLY_QUEUE_SIZE", "10000"))
+
+# Messages sent concurrently (at most one per chat, so each chat keeps its order)
+REPLY_MAX_IN_FLIGHT = 32
+
+# Network errors are retried this many times; RetryAfter is always waited out
+REPLY_MAX_RETRIES = 3
+
+# Telegram's limit on the text of one message
+MAX_MESSAGE_LENGTH = 4096
+
+# Idle chats whose bucket has refilled are forgotten once this many are tracked
+MAX_TRACKED_CHATS = 1024
+
+
+class _Reply:
+    __slots__ = ("text", "merge", "attempts", "not_before")
+
+    def __init__(self, text: str, merge: bool):
+        self.text = text
+        self.merge = merge
+        self.attempts = 0
+        self.not_before = 0.0
+
+
+class ReplyScheduler:
+    """Outbound Telegram messages, paced by global and per-chat token buckets.
+
+    Handlers ``enqueue`` a reply and return at once; a task on the bot's
+    event loop sends queued replies chat by chat in arrival order, at most
+    one in flight per chat, so each chat still gets its replies in order.
+    A reply enqueued with ``merge=True`` (success confirmations) is joined
+    to the previous one of its chat while that one is still waiting, so a
+    burst of expenses is confirmed with a single message. RetryAfter from
+    Telegram pauses all sending for the time it asks; network errors are
+    retried with backoff, and other errors (blocked bot, bad request) drop
+    the message.
+    """
+
+    def __init__(self, send: Callable[[int, str], Awaitable], global_rate: float = TELEGRAM_GLOBAL_RATE,
+                 chat_rate: float = TELEGRAM_CHAT_RATE, chat_burst: float = TELEGRAM_CHAT_BURST,
+                 max_pending: int = REPLY_QUEUE_SIZE, max_in_flight: int = REPLY_MAX_IN_FLIGHT):
+        self._send = send
+        self.global_bucket = TokenBucket(global_rate * 60, capacity=max(1.0, global_rate))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_pending = max_pending
+        self.max_in_flight = max_in_flight
+        self._queues: Dict[int, Deque[_Reply]] = {}
+        self._buckets: Dict[int, TokenBucket] = {}
+        # Chats with queued replies and none in flight, in the order they are served
+        self._ready: Deque[int] = deque()
+        self._in_flight: Set[int] = set()
+        self._pending = 0
+        self._paused_until = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retry_after = 0
+
+    def start(self):
+        """Start sending from the running event loop."""
+        if self._task is None or self._task.done():
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._task = self._loop.create_task(self._run())
+
+    async def close(self, timeout: float = 5.0):
+        """Send what is queued, waiting at most ``timeout`` seconds, then stop."""
+        deadline = time.monotonic() + timeout
+        while (self._pending or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+        if self._pending:
+            logger.warning(f"Dropped {self._pending} unsent replies on shutdown")
+
+    def enqueue(self, chat_id: int, text: str, merge: bool = False) -> bool:
+        """Queue a message for a chat; False when the queue is full. Must run on the event loop."""
+        queue = self._queues.get(chat_id)
+        if merge and queue:
+            last = queue[-1]
+            if last.merge and not last.attempts and len(last.text) + len(text) + 2 <= MAX_MESSAGE_LENGTH:
+                last.text = f"{last.text}\n\n{text.strip()}"
+                self.merged += 1
+                TELEGRAM_REPLIES_MERGED.inc()
+                return True
+
+        if self._pending >= self.max_pending:
+            self.dropped += 1
+            logger.warning(f"Reply queue full, dropped a reply to chat {chat_id}")
+            return False
+
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+            if chat_id not in self._in_flight:
+                self._ready.append(chat_id)
+        queue.append(_Reply(text.strip() if merge else text, merge))
+        self._pending += 1
+        if len(self._buckets) > MAX_TRACKED_CHATS:
+            self._forget_idle_chats()
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return True
+
+    def enqueue_threadsafe(self, chat_id: int, text: str, merge: bool = False):
+        """Queue a message from another thread (e.g. a Sheets worker)."""
+        self._loop.call_soon_threadsafe(self.enqueue, chat_id, text, merge)
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate * 60, capacity=self.chat_burst)
+        return bucket
+
+    def _forget_idle_chats(self):
+        for chat_id in [chat_id for chat_id, bucket in self._buckets.items()
+                        if chat_id not in self._queues and chat_id not in self._in_flight and bucket.is_full()]:
+            del self._buckets[chat_id]
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._dispatch()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch(self) -> Optional[float]:
+        """Start every send allowed now; return the seconds until the next one may be (None: wait for a wakeup)."""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+
+        delay = None
+        for _ in range(len(self._ready)):
+            if len(self._in_flight) >= self.max_in_flight:
+                return None
+            chat_id = self._ready.popleft()
+            reply = self._queues[chat_id][0]
+            wait = max(reply.not_before - now, self._bucket(chat_id).wait_time())
+            if wait > 0:
+                self._ready.append(chat_id)
+                delay = wait if delay is None else min(delay, wait)
+                continue
+            if not self.global_bucket.try_acquire():
+                self._ready.appendleft(chat_id)
+                return self.global_bucket.wait_time()
+
+            self._bucket(chat_id).try_acquire()
+            self._queues[chat_id].popleft()
+            self._pending -= 1
+            self._in_flight.add(chat_id)
+            self._loop.create_task(self._deliver(chat_id, reply))
+        return delay
+
+    async def _deliver(self, chat_id: int, reply: _Reply):
+        try:
+            with TELEGRAM_REPLY.time():
+                await self._send(chat_id, reply.text)
+            self.sent += 1
+        except Exception as e:
+            if self._should_retry(chat_id, reply, e):
+                queue = self._queues.get(chat_id)
+                if queue is None:
+                    queue = self._queues[chat_id] = deque()
+                queue.appendleft(reply)
+                self._pending += 1
+        finally:
+            self._in_flight.discard(chat_id)
+            if self._queues.get(chat_id):
+                self._ready.append(chat_id)
+            else:
+                self._queues.pop(chat_id, None)
+            self._wakeup.set()
+
+    def _should_retry(self, chat_id: int, reply: _Reply, error: Exception) -> bool:
+        from telegram.error import BadRequest, NetworkError, RetryAfter
+
+        if isinstance(error, RetryAfter):
+            retry_after = error.retry_after
+            seconds = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+            # Flood control applies to the whole bot, so every chat waits
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self.retry_after += 1
+            TELEGRAM_RETRY_AFTER.inc()
+            logger.warning(f"Telegram flood control: pausing replies for {seconds:g}s")
+            return True
+
+        if isinstance(error, NetworkError) and not isinstance(error, BadRequest) and reply.attempts < REPLY_MAX_RETRIES:
+            reply.attempts += 1
+            reply.not_before = time.monotonic() + min(30.0, 2.0 ** reply.attempts)
+            logger.warning(f"Reply to chat {chat_id} failed ({error}), retry {reply.attempts}")
+            return True
+
+        self.failed += 1
+        logger.warning(f"Could not send reply to chat {chat_id}: {error}")
+        return False
+
+    def stats(self) -> dict:
+        return {
+            "pending": self._pending,
+            "in_flight": len(self._in_flight),
+            "sent": self.sent,
+            "merged": self.merged,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "retry_after": self.retry_after,
+            "paused_for": round(max(0.0, self._paused_until - time.monotonic()), 3),
+        }
@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Shared by the bot process and any standalone web workers; empty disables the outbox
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", os.path.join("data", "outbox.db"))
+
+
+def expense_row(expense_data: dict) -> list:
+    """Build the sheet row for an expense, matching the sheet columns."""
+    return [
+        expense_data["date"],
+        expense_data["product"],
+        expense_data["place"],
+        expense_data["category"],
+        expense_data["subcategory"],
+        expense_data["amount"],
+        expense_data["quantity"]
+    ]
+
+
+class ExpenseOutbox:
+    """Append-only local outbox (SQLite in WAL mode) for rows pending upload to the sheet.
+
+    Every parsed expense is stored here before the user gets a reply, so a
+    Sheets outage or quota error never loses data. Rows are removed only
+    after the replayer has committed them to the sheet. Rows appended by web
+    workers are flagged ``untracked`` until the bot has added them to its
+    budget totals (``take_untracked``), and are not replayed before that.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " created_at REAL NOT NULL,"
+            " row TEXT NOT NULL)"
+        )
+        # Outboxes created before per-tenant spreadsheets lack the tenant column
+        columns = [column[1] for column in self._conn.execute("PRAGMA table_info(outbox)")]
+        if "tenant" not in columns:
+            self._conn.execute("ALTER TABLE outbox ADD COLUMN tenant TEXT")
+        if "untracked" not in columns:
+            self._conn.execute("ALTER TABLE outbox ADD COLUMN untracked INTEGER NOT NULL DEFAULT 0")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_untracked ON outbox (id) WHERE untracked = 1")
+
+    def append(self, row: list, tenant: Optional[str] = None) -> int:
+        """Store a single row and return its outbox id."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO outbox (created_at, row, tenant) VALUES (?, ?, ?)",
+                (time.time(), json.dumps(row), tenant)
+            )
+            return cursor.lastrowid
+
+    def append_many(self, rows: List[list], tenant: Optional[str] = None, untracked: bool = False):
+        """Store several rows in a single transaction (``untracked`` for rows written outside the bot)."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO outbox (created_at, row, tenant, untracked) VALUES (?, ?, ?, ?)",
+                    [(now, json.dumps(row), tenant, int(untracked)) for row in rows]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def peek(self, limit: int, skip_tenants=()) -> List[Tuple[int, list, Optional[str]]]:
+        """Return up to ``limit`` of the oldest pending (id, row, tenant) entries without removing them.
+
+        Rows of the tenants in ``skip_tenants`` (None is the shared sheet) are left out,
+        and so are untracked rows, which would otherwise be removed before the bot saw them.
+        """
+        # Filtered here rather than with NOT IN, whose bound variables would grow with the failing tenants
+        skip = {tenant or "" for tenant in skip_tenants}
+        entries = []
+        last_id = 0
+        while len(entries) < limit:
+            with self._lock:
+                page = self._conn.execute(
+                    "SELECT id, row, tenant FROM outbox WHERE untracked = 0 AND id > ? ORDER BY id LIMIT ?",
+                    (last_id, limit)
+                ).fetchall()
+            entries.extend(
+                (row_id, json.loads(row), tenant) for row_id, row, tenant in page if (tenant or "") not in skip
+            )
+            if len(page) < limit:
+                break
+            last_id = page[-1][0]
+        return entries[:limit]
+
+    def take_untracked(self, limit: int) -> List[Tuple[int, list, Optional[str]]]:
+        """Return up to ``limit`` of the oldest untracked (id, row, tenant) entries and mark them tracked."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                entries = self._conn.execute(
+                    "SELECT id, row, tenant FROM outbox WHERE untracked = 1 ORDER BY id LIMIT ?", (limit,)
+                ).fetchall()
+                self._conn.executemany("UPDATE outbox SET untracked = 0 WHERE id = ?", [(entry[0],) for entry in entries])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [(row_id, json.loads(row), tenant) for row_id, row, tenant in entries]
+
+    def ack(self, ids: List[int]):
+        """Remove rows that were committed to the sheet."""
+        if not ids:
+            return
+        with self._lock:
+            self._conn.executemany("DELETE FROM outbox WHERE id = ?", [(row_id,) for row_id in ids])
+
+    def depth(self) -> int:
+        """Number of rows waiting to be uploaded."""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def oldest_age(self) -> Optional[float]:
+        """Age in seconds of the oldest pending row, or None when the outbox is empty."""
+        with self._lock:
+            oldest = self._conn.execute("SELECT MIN(created_at) FROM outbox").fetchone()[0]
+        if oldest is None:
+            return None
+        return max(0.0, time.time() - oldest)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class OutboxReplayer:
+    """Background thread that drains the outbox to the sheet in batches.
+
+    ``route`` maps a row's tenant to the destination passed to
+    ``append_rows`` (None is the shared sheet); rows with the same
+    destination are written together. Any store with the outbox's
+    ``peek``/``ack`` interface can be drained, e.g. the SQLite backend's
+    rows pending copy to the sheet. ``before_drain`` runs at the start of
+    every pass, e.g. to release the untracked rows.
+    """
+
+    def __init__(self, outbox: ExpenseOutbox, append_rows: Callable[[List[list], Optional[str]], None],
+                 batch_size: int = 200, interval: float = 1.0, max_backoff: float = 300.0,
+                 route: Optional[Callable[[Optional[str]], Optional[str]]] = None,
+                 name: str = "outbox-replayer", before_drain: Optional[Callable[[], None]] = None):
+        self.outbox = outbox
+        self.name = name
+        self._append_rows = append_rows
+        self._route = route or (lambda tenant: tenant)
+        self._before_drain = before_drain
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._failures = 0
+        self.last_error: Optional[str] = None
+
+    def start(self):
+        """Start the replayer thread if it is not running yet."""
+        # Called from every handler thread; two replayers would upload rows twice
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        """Ask the replayer to drain now instead of waiting for the next interval."""
+        self._wake.set()
+
+    def close(self, timeout: float = 10.0):
+        """Stop the thread after one last attempt to drain the outbox."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            if self.drain():
+                self._failures = 0
+                if self._stop.is_set():
+                    return
+                self._wake.wait(self.interval)
+                self._wake.clear()
+            else:
+                # Back off exponentially while Sheets keeps failing; new rows
+                # do not cut the backoff short, only shutdown does
+                self._failures += 1
+                if self._stop.is_set():
+                    return
+                self._stop.wait(min(self.max_backoff, self.interval * (2 ** self._failures)))
+                self._wake.clear()
+
+    def drain(self) -> bool:
+        """Upload pending rows until the outbox is empty. Returns False on failure.
+
+        A destination that fails is skipped for the rest of the pass, keeping
+        its rows in order without holding back everybody else's.
+        """
+        if self._before_drain is not None:
+            try:
+                self._before_drain()
+            except Exception as e:
+                logger.error(f"Failed to prepare the outbox for replay ({self.name}): {e}")
+        failed = set()
+        skipped = set()
+        routes = {}
+        while True:
+            batch = self.outbox.peek(self.batch_size, skip_tenants=skipped)
+            if not batch:
+                return not failed
+
+            # Each destination's rows go out in one call, in their original order
+            groups = {}
+            for row_id, row, tenant in batch:
+                if tenant not in routes:
+                    routes[tenant] = self._route(tenant)
+                tenants, ids, rows = groups.setdefault(routes[tenant], (set(), [], []))
+                tenants.add(tenant)
+                ids.append(row_id)
+                rows.append(row)
+
+            for destination, (tenants, ids, rows) in groups.items():
+                if destination not in failed:
+                    started = time.perf_counter()
+                    try:
+                        self._append_rows(rows, destination)
+                        self.outbox.ack(ids)
+                        if not failed:
+                            self.last_error = None
+                        logger.info("Replayed %d rows to sheet (%s)", len(rows), self.name, extra={
+                            "event": "rows_replayed", "rows": len(rows),
+                            "append_ms": round((time.perf_counter() - started) * 1000, 3), "sample": True
+                        })
+                        continue
+                    except Exception as e:
+                        self.last_error = str(e)
+                        logger.error(f"Failed to replay {len(rows)} rows to sheet ({self.name}): {e}")
+                        failed.add(destination)
+                skipped.update(tenants)
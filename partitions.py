@@ -0,0 +1,266 @@
+import os
+import re
+import logging
+import threading
+from typing import Callable, Dict, Iterator, List, Optional
+
+from sheet_mirror import SheetMirror
+
+logger = logging.getLogger(__name__)
+
+# "month" or "year" writes each expense to a worksheet for its period; empty keeps everything in the first sheet
+SHEET_PARTITION = os.getenv("SHEET_PARTITION", "")
+
+# Rows allocated for a new partition worksheet (Sheets grows it as rows are appended)
+PARTITION_INITIAL_ROWS = 1000
+
+# Period key length and title pattern per granularity: "2025-06" or "2025"
+_KEY_LENGTH = {"month": 7, "year": 4}
+_TITLE_PATTERN = {"month": re.compile(r"\d{4}-\d{2}"), "year": re.compile(r"\d{4}")}
+
+
+def partition_key(date_text: str, granularity: str) -> Optional[str]:
+    """Period of an expense date ("2025-06" or "2025"), or None when the date is not YYYY-MM-DD..."""
+    key = str(date_text)[:_KEY_LENGTH[granularity]]
+    return key if _TITLE_PATTERN[granularity].fullmatch(key) else None
+
+
+def append_cells_request(sheet_id: int, rows: List[list]) -> dict:
+    """batchUpdate request that appends rows after the last row with data, like append_rows with RAW values."""
+    def cell(value):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return {"userEnteredValue": {"numberValue": value}}
+        return {"userEnteredValue": {"stringValue": str(value)}}
+
+    return {
+        "appendCells": {
+            "sheetId": sheet_id,
+            "rows": [{"values": [cell(value) for value in row]} for row in rows],
+            "fields": "userEnteredValue"
+        }
+    }
+
+
+class SheetPartitions:
+    """Index of the period worksheets of a spreadsheet, created on demand.
+
+    Partition worksheets are titled after their period, so the index
+    (period -> worksheet) is rebuilt from a single metadata read and needs
+    no storage of its own. ``call(kind, func, *args)`` runs Google calls,
+    normally through the quota scheduler.
+    """
+
+    def __init__(self, granularity: str, call: Callable, headers: List[str]):
+        if granularity not in _KEY_LENGTH:
+            raise ValueError(f"SHEET_PARTITION must be 'month' or 'year', not '{granularity}'")
+        self.granularity = granularity
+        self.headers = headers
+        self._call = call
+        self._lock = threading.Lock()
+        self._spreadsheet = None
+        self._index: Optional[Dict[str, object]] = None
+        self.created = 0
+
+    def attach(self, spreadsheet):
+        """Use the partitions of ``spreadsheet`` (called whenever the shared sheet is resolved)."""
+        with self._lock:
+            if self._spreadsheet is None or self._spreadsheet.id != spreadsheet.id:
+                self._spreadsheet = spreadsheet
+                self._index = None
+
+    def invalidate(self):
+        """Forget the index so the next lookup reads the worksheet list again."""
+        with self._lock:
+            self._index = None
+
+    def key(self, date_text: str) -> Optional[str]:
+        return partition_key(date_text, self.granularity)
+
+    def _load_index(self) -> Dict[str, object]:
+        # Callers hold the lock
+        if self._index is None:
+            if self._spreadsheet is None:
+                raise RuntimeError("Sheet not available")
+            pattern = _TITLE_PATTERN[self.granularity]
+            worksheets = self._call("read", self._spreadsheet.worksheets)
+            self._index = {sheet.title: sheet for sheet in worksheets if pattern.fullmatch(sheet.title)}
+        return self._index
+
+    def worksheet(self, period: str, create: bool = True):
+        """Worksheet for a period, creating it with the sheet headers when ``create`` is set."""
+        with self._lock:
+            index = self._load_index()
+            sheet = index.get(period)
+            if sheet is not None or not create:
+                return sheet
+            try:
+                sheet = self._call("write", self._spreadsheet.add_worksheet, period,
+                                   PARTITION_INITIAL_ROWS, len(self.headers))
+            except Exception:
+                # Created elsewhere since the index was read
+                self._index = None
+                sheet = self._load_index().get(period)
+                if sheet is None:
+                    raise
+                return sheet
+            self._call("write", sheet.append_row, self.headers)
+            index[period] = sheet
+            self.created += 1
+            logger.info(f"Created partition worksheet {period}")
+            return sheet
+
+    def periods(self, start_day: Optional[str] = None, end_day: Optional[str] = None) -> List[str]:
+        """Existing periods, oldest first, that overlap the inclusive day range."""
+        length = _KEY_LENGTH[self.granularity]
+        low = start_day[:length] if start_day else None
+        high = end_day[:length] if end_day else None
+        with self._lock:
+            periods = sorted(self._load_index())
+        return [period for period in periods if (low is None or period >= low) and (high is None or period <= high)]
+
+    def stats(self) -> dict:
+        with self._lock:
+            index = self._index
+            return {
+                "granularity": self.granularity,
+                "partitions": {period: sheet.id for period, sheet in sorted(index.items())} if index is not None else None,
+                "created": self.created,
+            }
+
+
+class _Forwarder:
+    """Listener of one partition's mirror that passes row changes on to the combined mirror's listeners."""
+
+    def __init__(self, listeners: list):
+        self._listeners = listeners
+
+    def add(self, row):
+        for listener in self._listeners:
+            listener.add(row)
+
+    def remove(self, row):
+        for listener in self._listeners:
+            listener.remove(row)
+
+    def reset(self):
+        # Only a full load of the combined mirror resets its listeners
+        pass
+
+
+class PartitionedMirror:
+    """SheetMirror-compatible view over one mirror per partition plus the first (legacy) sheet.
+
+    Each sync reads the legacy sheet, the latest partition and one older
+    partition in rotation, so the cost per sync does not grow with the
+    number of periods; closed periods are rarely edited.
+    """
+
+    def __init__(self, partitions: SheetPartitions, read_legacy: Callable[[str], list],
+                 read_partition: Callable[[str, str], list], page_size: int = 5000):
+        self.partitions = partitions
+        self.page_size = page_size
+        self.listeners = []
+        self._read_legacy = read_legacy
+        self._read_partition = read_partition
+        self._lock = threading.RLock()
+        # One write lock for every mirror, as an append may reach any of them
+        self._write_lock = threading.RLock()
+        self.legacy = self._new_mirror(read_legacy)
+        self.mirrors: Dict[str, SheetMirror] = {}
+        self._rotation = 0
+        self.loaded = False
+
+    def _new_mirror(self, read_range) -> SheetMirror:
+        mirror = SheetMirror(read_range, page_size=self.page_size, write_lock=self._write_lock)
+        mirror.listeners.append(_Forwarder(self.listeners))
+        return mirror
+
+    def _mirror_for(self, period: str) -> SheetMirror:
+        with self._lock:
+            mirror = self.mirrors.get(period)
+            if mirror is None:
+                mirror = self.mirrors[period] = self._new_mirror(
+                    lambda range_name: self._read_partition(period, range_name)
+                )
+            return mirror
+
+    def __len__(self):
+        with self._lock:
+            return len(self.legacy) + sum(len(mirror) for mirror in self.mirrors.values())
+
+    def load(self):
+        """Load the legacy sheet and every partition page by page."""
+        with self._lock:
+            self.loaded = False
+            self.mirrors = {}
+            self.legacy = self._new_mirror(self._read_legacy)
+            for listener in self.listeners:
+                listener.reset()
+        self.partitions.invalidate()
+        self.legacy.load()
+        for period in self.partitions.periods():
+            self._mirror_for(period).load()
+        with self._lock:
+            self.loaded = True
+
+    def appending(self):
+        """Hold off the partitions' tail reads and loads while rows are appended, like SheetMirror.appending."""
+        return self._write_lock
+
+    def append_rows(self, rows: List[list]):
+        """Add rows that were just committed, each to the mirror of its period."""
+        with self._lock:
+            if not self.loaded:
+                return
+            groups: Dict[Optional[str], List[list]] = {}
+            for row in rows:
+                groups.setdefault(self.partitions.key(row[0]), []).append(row)
+            for period, period_rows in groups.items():
+                if period is None:
+                    self.legacy.append_rows(period_rows)
+                    continue
+                mirror = self._mirror_for(period)
+                if not mirror.loaded and not len(mirror):
+                    # A partition created after the load starts out empty
+                    mirror.loaded = True
+                mirror.append_rows(period_rows)
+
+    def sync(self):
+        if not self.loaded:
+            self.load()
+            return
+        self.partitions.invalidate()
+        periods = self.partitions.periods()
+        for period in periods:
+            mirror = self._mirror_for(period)
+            if not mirror.loaded:
+                # A partition created by a write in flight is loaded after append_rows, not before
+                with self._write_lock:
+                    if not mirror.loaded:
+                        mirror.load()
+        self.legacy.sync()
+        if periods:
+            self._mirror_for(periods[-1]).sync()
+            older = periods[:-1]
+            if older:
+                self._rotation %= len(older)
+                self._mirror_for(older[self._rotation]).sync()
+                self._rotation += 1
+
+    def iter_pages(self, page_size: int, start_day: Optional[str] = None, end_day: Optional[str] = None,
+                   **filters) -> Iterator[List[list]]:
+        """Yield matching rows from the legacy sheet, then from the partitions within the day range."""
+        yield from self.legacy.iter_pages(page_size, start_day=start_day, end_day=end_day, **filters)
+        for period in self.partitions.periods(start_day, end_day):
+            mirror = self.mirrors.get(period)
+            if mirror is not None:
+                yield from mirror.iter_pages(page_size, start_day=start_day, end_day=end_day, **filters)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "loaded": self.loaded,
+                "rows": len(self),
+                "partitions": len(self.mirrors),
+                "legacy_rows": len(self.legacy),
+            }
@@ -0,0 +1,216 @@
+import time
+import random
+import logging
+import threading
+from typing import Callable, Optional
+
+from metrics import GOOGLE_API_CALLS, GOOGLE_API_ERRORS, GOOGLE_API_RETRIES, QUOTA_ERRORS
+
+logger = logging.getLogger(__name__)
+
+# Error classes returned by classify_error
+NOT_FOUND = "not_found"
+RATE_LIMITED = "rate_limited"
+QUOTA_EXCEEDED = "quota_exceeded"
+TRANSIENT = "transient"
+FATAL = "fatal"
+
+RETRYABLE = {RATE_LIMITED, TRANSIENT}
+
+# 403 reasons that mean "slow down" rather than "permission denied" or "storage full"
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded", "RATE_LIMIT_EXCEEDED"}
+STORAGE_QUOTA_REASONS = {"storageQuotaExceeded", "quotaExceeded"}
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def _error_reasons(error: Exception) -> set:
+    """Collect the machine-readable reasons from a Google API error body."""
+    reasons = set()
+    try:
+        body = error.response.json().get("error", {})
+    except Exception:
+        return reasons
+    if body.get("status"):
+        reasons.add(body["status"])
+    for item in body.get("errors", []) or []:
+        if item.get("reason"):
+            reasons.add(item["reason"])
+    for detail in body.get("details", []) or []:
+        if detail.get("reason"):
+            reasons.add(detail["reason"])
+    return reasons
+
+
+def classify_error(error: Exception) -> str:
+    """Classify a Google API error by HTTP status instead of by message text."""
+    # Imported here so loading this module does not pull in gspread and requests
+    import requests
+    from gspread.exceptions import APIError, SpreadsheetNotFound, WorksheetNotFound
+
+    if isinstance(error, (SpreadsheetNotFound, WorksheetNotFound)):
+        return NOT_FOUND
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return TRANSIENT
+
+    status = _status_code(error)
+    if status is None:
+        return FATAL
+    if status == 404:
+        return NOT_FOUND
+    if status == 429:
+        return RATE_LIMITED
+    if status == 403:
+        reasons = _error_reasons(error) if isinstance(error, APIError) else set()
+        if reasons & RATE_LIMIT_REASONS:
+            return RATE_LIMITED
+        if reasons & STORAGE_QUOTA_REASONS:
+            return QUOTA_EXCEEDED
+        return FATAL
+    if status in (408, 500, 502, 503, 504):
+        return TRANSIENT
+    return FATAL
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at ``rate_per_minute``."""
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1.0, rate_per_minute / 6.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        # Callers hold the lock
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self) -> float:
+        """Take one token, sleeping until one is available. Returns the time waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def try_acquire(self) -> bool:
+        """Take one token if one is available, without waiting."""
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def wait_time(self) -> float:
+        """Seconds until a token is available (0 if one is now)."""
+        with self._lock:
+            self._refill()
+            return max(0.0, (1 - self._tokens) / self.rate)
+
+    def is_full(self) -> bool:
+        with self._lock:
+            self._refill()
+            return self._tokens >= self.capacity
+
+
+class QuotaScheduler:
+    """Single gateway for Google Sheets/Drive calls.
+
+    Paces calls with per-minute read and write token buckets, retries
+    rate-limited and transient failures with exponential backoff and jitter,
+    and keeps counters of how often it throttled and retried.
+    """
+
+    def __init__(self, reads_per_minute: float = 60, writes_per_minute: float = 60,
+                 max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 64.0):
+        self.buckets = {
+            "read": TokenBucket(reads_per_minute),
+            "write": TokenBucket(writes_per_minute),
+        }
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._stats = {
+            "calls": {"read": 0, "write": 0},
+            "throttled": 0,
+            "throttle_wait_seconds": 0.0,
+            "retries": 0,
+            "errors": {},
+        }
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        """Exponential backoff with jitter, honouring Retry-After when Google sends it."""
+        response = getattr(error, "response", None)
+        retry_after = getattr(response, "headers", {}).get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                return min(self.max_delay, float(retry_after))
+            except ValueError:
+                pass
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _count(self, key: str, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def _count_error(self, error_class: str, status: Optional[int]):
+        key = f"{error_class}:{status}" if status is not None else error_class
+        with self._lock:
+            self._stats["errors"][key] = self._stats["errors"].get(key, 0) + 1
+
+    def call(self, kind: str, func: Callable, *args, **kwargs):
+        """Run ``func`` under the ``kind`` ("read" or "write") budget with retries."""
+        bucket = self.buckets[kind]
+        with self._lock:
+            self._stats["calls"][kind] += 1
+        GOOGLE_API_CALLS.labels(kind).inc()
+
+        attempt = 0
+        while True:
+            waited = bucket.acquire()
+            if waited:
+                self._count("throttled")
+                self._count("throttle_wait_seconds", waited)
+
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                error_class = classify_error(e)
+                self._count_error(error_class, _status_code(e))
+                GOOGLE_API_ERRORS.labels(error_class).inc()
+                if error_class in (RATE_LIMITED, QUOTA_EXCEEDED):
+                    QUOTA_ERRORS.inc()
+                if error_class not in RETRYABLE or attempt >= self.max_retries:
+                    raise
+
+                delay = self._backoff(attempt, e)
+                attempt += 1
+                self._count("retries")
+                GOOGLE_API_RETRIES.inc()
+                logger.warning(f"Google API {kind} call failed ({error_class}), retry {attempt} in {delay:.1f}s")
+                time.sleep(delay)
+
+    def stats(self) -> dict:
+        """Snapshot of the throttling and retry counters."""
+        with self._lock:
+            return {
+                "calls": dict(self._stats["calls"]),
+                "throttled": self._stats["throttled"],
+                "throttle_wait_seconds": round(self._stats["throttle_wait_seconds"], 3),
+                "retries": self._stats["retries"],
+                "errors": dict(self._stats["errors"]),
+            }
@@ -0,0 +1,306 @@
+import os
+import time
+import sqlite3
+import calendar
+import logging
+import threading
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Recurring expense definitions (rent, subscriptions...), shared by the bot and the web API; empty disables them
+RECURRING_PATH = os.getenv("RECURRING_PATH", os.path.join("data", "recurring.db"))
+
+# Seconds between checks for due instances
+RECURRING_CHECK_INTERVAL = float(os.getenv("RECURRING_CHECK_INTERVAL", "3600"))
+
+# Instances written per run; a longer backlog (e.g. after an outage) is caught up one run every
+# RECURRING_CATCHUP_INTERVAL seconds, so it never takes more than one write per destination at a time
+RECURRING_BATCH_SIZE = int(os.getenv("RECURRING_BATCH_SIZE", "500"))
+RECURRING_CATCHUP_INTERVAL = float(os.getenv("RECURRING_CATCHUP_INTERVAL", "60"))
+
+# A definition whose write fails waits RECURRING_RETRY_INTERVAL seconds before it is due again, doubling
+# with each consecutive failure up to RECURRING_MAX_RETRY_INTERVAL, so it neither holds back the others
+# at the head of every batch nor spends write quota on a sheet that keeps failing
+RECURRING_RETRY_INTERVAL = float(os.getenv("RECURRING_RETRY_INTERVAL", "300"))
+RECURRING_MAX_RETRY_INTERVAL = float(os.getenv("RECURRING_MAX_RETRY_INTERVAL", "21600"))
+
+# Accepted frequencies, by the name users type
+FREQUENCIES = {"mensual": "monthly", "semanal": "weekly", "anual": "yearly"}
+FREQUENCY_NAMES = {frequency: name for name, frequency in FREQUENCIES.items()}
+
+# Time of day given to materialized instances, which only have a due day
+INSTANCE_TIME = "00:00:00"
+
+
+def parse_frequency(value: str) -> Optional[str]:
+    """Frequency for a user-given name (mensual, semanal, anual), or None."""
+    value = (value or "").strip().lower()
+    return FREQUENCIES.get(value) or (value if value in FREQUENCY_NAMES else None)
+
+
+def occurrence(start: date, frequency: str, n: int) -> date:
+    """Day of the ``n``-th instance (0 is ``start``); monthly days past the month's end fall on its last day."""
+    if frequency == "weekly":
+        return start + timedelta(weeks=n)
+    months = start.month - 1 + n * (12 if frequency == "yearly" else 1)
+    year, month = start.year + months // 12, months % 12 + 1
+    return date(year, month, min(start.day, calendar.monthrange(year, month)[1]))
+
+
+class RecurringStore:
+    """Recurring expense definitions (SQLite in WAL mode).
+
+    Each definition keeps how many instances were written so far and the
+    day the next one is due, indexed, so finding what is due is one query
+    however long the bot was down. Definitions that failed to be written
+    are left out until their ``retry_after`` time.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS recurring ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " tenant TEXT,"
+            " product TEXT NOT NULL,"
+            " place TEXT NOT NULL,"
+            " category TEXT NOT NULL,"
+            " subcategory TEXT NOT NULL,"
+            " amount REAL NOT NULL,"
+            " quantity INTEGER NOT NULL,"
+            " frequency TEXT NOT NULL,"
+            " start TEXT NOT NULL,"
+            " occurrences INTEGER NOT NULL DEFAULT 0,"
+            " next_due TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        # Stores created before failed writes were backed off lack the retry columns
+        columns = [column[1] for column in self._conn.execute("PRAGMA table_info(recurring)")]
+        if "failures" not in columns:
+            self._conn.execute("ALTER TABLE recurring ADD COLUMN failures INTEGER NOT NULL DEFAULT 0")
+        if "retry_after" not in columns:
+            self._conn.execute("ALTER TABLE recurring ADD COLUMN retry_after REAL NOT NULL DEFAULT 0")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS recurring_next_due ON recurring (next_due)")
+
+    def add(self, expense: dict, frequency: str, start: date, tenant: Optional[str] = None) -> int:
+        """Register a definition from an expense's fields (product, place, ...); returns its id."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO recurring (tenant, product, place, category, subcategory, amount, quantity,"
+                " frequency, start, next_due, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (tenant, expense["product"], expense["place"], expense["category"], expense["subcategory"],
+                 expense["amount"], expense["quantity"], frequency, start.isoformat(), start.isoformat(), time.time())
+            )
+            return cursor.lastrowid
+
+    def remove(self, definition_id: int, tenant: Optional[str] = None) -> bool:
+        """Remove one of the tenant's definitions; False when it has none with that id."""
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM recurring WHERE id = ? AND tenant IS ?", (definition_id, tenant))
+            return cursor.rowcount > 0
+
+    def list(self, tenant: Optional[str] = None) -> List[dict]:
+        """The tenant's definitions, with the day their next instance is due."""
+        with self._lock:
+            entries = self._conn.execute(
+                "SELECT id, product, place, category, subcategory, amount, quantity, frequency, start, next_due"
+                " FROM recurring WHERE tenant IS ? ORDER BY id", (tenant,)
+            ).fetchall()
+        return [{
+            "id": entry[0],
+            "producto": entry[1],
+            "lugar": entry[2],
+            "categoria": entry[3],
+            "subcategoria": entry[4],
+            "importe": entry[5],
+            "cantidad": entry[6],
+            "frecuencia": FREQUENCY_NAMES.get(entry[7], entry[7]),
+            "inicio": entry[8],
+            "proximo": entry[9],
+        } for entry in entries]
+
+    def due(self, today: date, limit: int, now: Optional[float] = None) -> List[Tuple[int, Optional[str], list, List[str]]]:
+        """Instances due up to ``today``, oldest first: (id, tenant, row without date, days), ``limit`` days at most.
+
+        Definitions backed off after a failed write are left out until ``retry_after``.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            entries = self._conn.execute(
+                "SELECT id, tenant, product, place, category, subcategory, amount, quantity, frequency, start, occurrences"
+                " FROM recurring WHERE next_due <= ? AND retry_after <= ? ORDER BY next_due, id LIMIT ?",
+                (today.isoformat(), now, limit)
+            ).fetchall()
+
+        result = []
+        for entry in entries:
+            start = date.fromisoformat(entry[9])
+            days = []
+            n = entry[10]
+            while len(days) < limit and occurrence(start, entry[8], n) <= today:
+                days.append(occurrence(start, entry[8], n).isoformat())
+                n += 1
+            if not days:
+                break
+            result.append((entry[0], entry[1], list(entry[2:8]), days))
+            limit -= len(days)
+            if limit <= 0:
+                break
+        return result
+
+    def advance(self, counts: Dict[int, int]):
+        """Mark instances as written: ``counts`` maps a definition's id to how many, in one transaction."""
+        if not counts:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for definition_id, count in counts.items():
+                    entry = self._conn.execute(
+                        "SELECT frequency, start, occurrences FROM recurring WHERE id = ?", (definition_id,)
+                    ).fetchone()
+                    if entry is None:
+                        # Removed while its instances were being written
+                        continue
+                    occurrences = entry[2] + count
+                    next_due = occurrence(date.fromisoformat(entry[1]), entry[0], occurrences)
+                    self._conn.execute(
+                        "UPDATE recurring SET occurrences = ?, next_due = ?, failures = 0, retry_after = 0 WHERE id = ?",
+                        (occurrences, next_due.isoformat(), definition_id)
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def back_off(self, ids: List[int], now: Optional[float] = None):
+        """Leave definitions whose instances could not be written out of ``due`` for a while, longer after each failure."""
+        if not ids:
+            return
+        now = time.time() if now is None else now
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for definition_id in ids:
+                    entry = self._conn.execute("SELECT failures FROM recurring WHERE id = ?", (definition_id,)).fetchone()
+                    if entry is None:
+                        continue
+                    delay = min(RECURRING_MAX_RETRY_INTERVAL, RECURRING_RETRY_INTERVAL * 2 ** min(entry[0], 30))
+                    self._conn.execute(
+                        "UPDATE recurring SET failures = ?, retry_after = ? WHERE id = ?",
+                        (entry[0] + 1, now + delay, definition_id)
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def next_retry(self, today: date, now: Optional[float] = None) -> Optional[float]:
+        """Earliest time a backed-off definition with due instances may be retried, or None when there is none."""
+        now = time.time() if now is None else now
+        with self._lock:
+            return self._conn.execute(
+                "SELECT MIN(retry_after) FROM recurring WHERE next_due <= ? AND retry_after > ?", (today.isoformat(), now)
+            ).fetchone()[0]
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM recurring").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RecurringRunner:
+    """Writes the due instances of every recurring expense, a batch per run.
+
+    ``run()`` takes up to ``batch_size`` due instances, oldest first, and
+    hands them to ``commit`` grouped by tenant in a single call, which
+    commits each tenant's rows (one append per destination) and returns the
+    tenants that succeeded. Only those definitions move on to their next
+    due day, so nothing is skipped; the definitions of a tenant that failed
+    are backed off and retried once ``retry_at`` passes, without holding
+    back the rest. A crash between the write and the update of the
+    definitions writes those instances again on restart.
+    """
+
+    def __init__(self, store: RecurringStore,
+                 commit: Callable[[Dict[Optional[str], List[list]]], Dict[Optional[str], bool]],
+                 batch_size: int = RECURRING_BATCH_SIZE):
+        self.store = store
+        self._commit = commit
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.written = 0
+        self.failed = 0
+        self.backlog = False
+        self.retry_at: Optional[float] = None
+        self.last_run: Optional[str] = None
+        self.last_error: Optional[str] = None
+
+    def run(self, today: Optional[date] = None, now: Optional[float] = None) -> Tuple[Dict[Optional[str], List[list]], bool]:
+        """Write one batch of due instances; returns the rows written per tenant and whether more are due now.
+
+        Backed-off definitions do not count as due; ``retry_at`` tells when the first of them is.
+        """
+        today = today or date.today()
+        now = time.time() if now is None else now
+        with self._lock:
+            due = self.store.due(today, self.batch_size, now)
+            groups: Dict[Optional[str], List[list]] = {}
+            counts: Dict[Optional[str], Dict[int, int]] = {}
+            for definition_id, tenant, row, days in due:
+                groups.setdefault(tenant, []).extend([f"{day} {INSTANCE_TIME}", *row] for day in days)
+                counts.setdefault(tenant, {})[definition_id] = len(days)
+
+            written = {}
+            if groups:
+                try:
+                    results = self._commit(groups)
+                except Exception as e:
+                    logger.error(f"Failed to write recurring expenses: {e}")
+                    results = {}
+                advanced = {}
+                failed = []
+                for tenant, rows in groups.items():
+                    if results.get(tenant):
+                        written[tenant] = rows
+                        advanced.update(counts[tenant])
+                    else:
+                        failed.extend(counts[tenant])
+                        self.failed += len(rows)
+                        self.last_error = f"Could not write {len(rows)} recurring expenses for tenant {tenant}"
+                self.store.advance(advanced)
+                self.store.back_off(failed, now)
+                self.written += sum(len(rows) for rows in written.values())
+
+            # A full batch may have left instances behind; failed ones wait for retry_at instead
+            self.backlog = sum(len(rows) for rows in groups.values()) >= self.batch_size
+            self.retry_at = self.store.next_retry(today, now)
+            self.runs += 1
+            self.last_run = datetime.now().isoformat(timespec="seconds")
+        return written, self.backlog
+
+    def stats(self) -> dict:
+        return {
+            "definitions": self.store.count(),
+            "runs": self.runs,
+            "written": self.written,
+            "failed": self.failed,
+            "backlog": self.backlog,
+            "next_retry": datetime.fromtimestamp(self.retry_at).isoformat(timespec="seconds") if self.retry_at else None,
+            "last_run": self.last_run,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,391 @@
+import bisect
+import logging
+import threading
+from array import array
+from datetime import datetime, timedelta
+from typing import Callable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Number of columns written by the bot: fecha, producto, lugar, categoria, subcategoria, importe, cantidad
+ROW_WIDTH = 7
+
+# Google Sheets serial dates count days from this epoch
+SHEETS_EPOCH = datetime(1899, 12, 30)
+
+
+def _coerce_date(value) -> str:
+    """Return the date cell as text, converting Sheets serial numbers when needed."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (SHEETS_EPOCH + timedelta(days=float(value))).strftime("%Y-%m-%d %H:%M:%S")
+    return str(value)
+
+
+def _coerce_number(value, cast):
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        try:
+            return cast(float(str(value).replace(",", ".")))
+        except (TypeError, ValueError):
+            return cast(0)
+
+
+def normalize_row(row: list) -> list:
+    """Raw sheet values as [fecha, producto, lugar, categoria, subcategoria, importe, cantidad]."""
+    row = list(row) + [""] * (ROW_WIDTH - len(row))
+    return [
+        _coerce_date(row[0]), str(row[1]), str(row[2]), str(row[3]), str(row[4]),
+        _coerce_number(row[5], float), _coerce_number(row[6], int)
+    ]
+
+
+class _StringColumn:
+    """Dictionary-encoded text column: each distinct value is stored once."""
+
+    def __init__(self):
+        self.values: List[str] = []
+        self.lookup = {}
+        self.codes = array("I")
+
+    def encode(self, value: str) -> int:
+        code = self.lookup.get(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self.lookup[value] = code
+        return code
+
+    def append(self, value: str) -> int:
+        code = self.encode(value)
+        self.codes.append(code)
+        return code
+
+    def get(self, position: int) -> str:
+        return self.values[self.codes[position]]
+
+
+class SheetMirror:
+    """Column-oriented in-memory copy of the expense worksheet.
+
+    Rows are kept in sheet order (position 0 is the first row after the
+    headers). Text columns are dictionary-encoded and numbers live in typed
+    arrays, so six-figure row counts stay compact. Secondary indexes map a
+    day, category, category/subcategory pair and place to row positions.
+
+    ``read_range`` takes an A1 range and returns the raw values for it; the
+    mirror only reads bounded pages of the sheet, never the whole thing.
+    Listeners (objects with ``add``, ``remove`` and ``reset``) are told about
+    every row that enters or leaves the mirror.
+
+    Writers wrap the sheet append and ``append_rows`` in ``appending()``,
+    which ``sync`` also holds while it reads the rows after the last known
+    one, so rows committed by the bot are never picked up a second time.
+    Queries only take the data lock and are not held off by writes.
+    """
+
+    def __init__(self, read_range: Callable[[str], list], page_size: int = 5000,
+                 write_lock: Optional[threading.RLock] = None):
+        self._read_range = read_range
+        self.page_size = page_size
+        self.listeners = []
+        self._lock = threading.RLock()
+        # Shared by the partitions of a PartitionedMirror, whose writes may reach any of them
+        self._write_lock = write_lock or threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self.loaded = False
+        self.dates: List[str] = []
+        self.products = _StringColumn()
+        self.places = _StringColumn()
+        self.categories = _StringColumn()
+        self.subcategories = _StringColumn()
+        self.amounts = array("d")
+        self.quantities = array("q")
+        self.by_day = {}
+        self.days: List[str] = []
+        self.by_category = {}
+        self.by_subcategory = {}
+        self.by_place = {}
+        self._verify_cursor = 0
+        self.version = 0
+
+    def __len__(self):
+        return len(self.dates)
+
+    # Loading and incremental updates
+
+    def _page(self, first_row: int, last_row: int) -> list:
+        """Read sheet rows first_row..last_row (1-based, inclusive), padded to ROW_WIDTH."""
+        values = self._read_range(f"A{first_row}:G{last_row}") or []
+        return [list(row) + [""] * (ROW_WIDTH - len(row)) for row in values]
+
+    def load(self):
+        """Load the whole worksheet page by page."""
+        with self._lock:
+            self._reset()
+            for listener in self.listeners:
+                listener.reset()
+        first_row = 2
+        while True:
+            page = self._page(first_row, first_row + self.page_size - 1)
+            with self._lock:
+                for row in page:
+                    self._append_row(row)
+                self.version += 1
+            if len(page) < self.page_size:
+                break
+            first_row += self.page_size
+        with self._lock:
+            self.loaded = True
+        logger.info(f"Sheet mirror loaded with {len(self)} rows")
+
+    def appending(self):
+        """Hold off the tail read of ``sync`` while rows are appended to the sheet and then to the mirror."""
+        return self._write_lock
+
+    def append_rows(self, rows: List[list]):
+        """Add rows that were just committed to the sheet."""
+        with self._lock:
+            if not self.loaded:
+                # The next load or sync will pick them up from the sheet
+                return
+            for row in rows:
+                self._append_row(list(row) + [""] * (ROW_WIDTH - len(row)))
+            self.version += 1
+
+    def sync(self):
+        """Pick up rows appended elsewhere and re-check one page for direct edits.
+
+        Each call reads at most two bounded pages: the rows after the last
+        known one, and the next page of the rolling verification cursor.
+        """
+        if not self.loaded:
+            self.load()
+            return
+
+        # New rows appended outside the bot; rows the bot is appending reach the mirror
+        # through append_rows, so they must not be in the sheet but not yet in the mirror
+        with self._write_lock:
+            with self._lock:
+                known = len(self)
+                version = self.version
+            tail = self._page(known + 2, known + 1 + self.page_size)
+            with self._lock:
+                if tail and self.version == version:
+                    for row in tail:
+                        self._append_row(row)
+                    self.version += 1
+                    logger.info(f"Sheet mirror picked up {len(tail)} new rows")
+
+        # Rolling verification of existing rows for edits and deletions
+        with self._lock:
+            start = self._verify_cursor if self._verify_cursor < len(self) else 0
+            end = min(len(self), start + self.page_size)
+        if end <= start:
+            return
+        page = self._page(start + 2, end + 1)
+        with self._lock:
+            changed = 0
+            for offset, row in enumerate(page):
+                position = start + offset
+                if position < len(self) and self._row_differs(position, row):
+                    self._replace_row(position, row)
+                    changed += 1
+            if len(page) < end - start:
+                # Rows were deleted from the sheet; drop the tail and let the next
+                # sync read whatever now follows from the sheet again
+                self._truncate(start + len(page))
+                changed += 1
+            if changed:
+                self.version += 1
+                logger.info(f"Sheet mirror updated {changed} edited rows")
+            self._verify_cursor = end if end < len(self) else 0
+
+    # Internal row maintenance (callers hold the lock)
+
+    def _append_row(self, row: list):
+        position = len(self.dates)
+        self.dates.append(_coerce_date(row[0]))
+        self.products.append(str(row[1]))
+        place = self.places.append(str(row[2]))
+        category = self.categories.append(str(row[3]))
+        subcategory = self.subcategories.append(str(row[4]))
+        self.amounts.append(_coerce_number(row[5], float))
+        self.quantities.append(_coerce_number(row[6], int))
+        self._index_add(position, self.dates[position][:10], category, subcategory, place)
+        self._notify("add", position)
+
+    def _notify(self, event: str, position: int):
+        if self.listeners:
+            row = self.row(position)
+            for listener in self.listeners:
+                getattr(listener, event)(row)
+
+    def _index_add(self, position, day, category, subcategory, place):
+        if day not in self.by_day:
+            self.by_day[day] = array("I")
+            bisect.insort(self.days, day)
+        # insort keeps positions sorted when an edited row moves between keys
+        bisect.insort(self.by_day[day], position)
+        bisect.insort(self.by_category.setdefault(category, array("I")), position)
+        bisect.insort(self.by_subcategory.setdefault((category, subcategory), array("I")), position)
+        bisect.insort(self.by_place.setdefault(place, array("I")), position)
+
+    def _index_remove(self, position):
+        day = self.dates[position][:10]
+        category = self.categories.codes[position]
+        subcategory = self.subcategories.codes[position]
+        place = self.places.codes[position]
+        for index, key in ((self.by_day, day), (self.by_category, category),
+                           (self.by_subcategory, (category, subcategory)), (self.by_place, place)):
+            positions = index[key]
+            positions.remove(position)
+            if not positions:
+                del index[key]
+                if index is self.by_day:
+                    self.days.remove(day)
+
+    def _row_differs(self, position: int, row: list) -> bool:
+        return self.row(position) != normalize_row(row)
+
+    def _replace_row(self, position: int, row: list):
+        self._notify("remove", position)
+        self._index_remove(position)
+        self.dates[position] = _coerce_date(row[0])
+        place = self.places.encode(str(row[2]))
+        category = self.categories.encode(str(row[3]))
+        subcategory = self.subcategories.encode(str(row[4]))
+        self.products.codes[position] = self.products.encode(str(row[1]))
+        self.places.codes[position] = place
+        self.categories.codes[position] = category
+        self.subcategories.codes[position] = subcategory
+        self.amounts[position] = _coerce_number(row[5], float)
+        self.quantities[position] = _coerce_number(row[6], int)
+        self._index_add(position, self.dates[position][:10], category, subcategory, place)
+        self._notify("add", position)
+
+    def _truncate(self, length: int):
+        for position in range(len(self.dates) - 1, length - 1, -1):
+            self._notify("remove", position)
+            self._index_remove(position)
+        del self.dates[length:]
+        for column in (self.products, self.places, self.categories, self.subcategories):
+            del column.codes[length:]
+        del self.amounts[length:]
+        del self.quantities[length:]
+
+    # Queries
+
+    def row(self, position: int) -> list:
+        """Return the row at ``position`` in sheet column order."""
+        with self._lock:
+            return [
+                self.dates[position],
+                self.products.get(position),
+                self.places.get(position),
+                self.categories.get(position),
+                self.subcategories.get(position),
+                self.amounts[position],
+                self.quantities[position],
+            ]
+
+    def _matcher(self, start_day, end_day, category, subcategory, place):
+        """Return the filter codes and a position predicate, or None when a value never occurs.
+
+        Callers hold the lock.
+        """
+        category_code = subcategory_code = place_code = None
+        if category is not None:
+            category_code = self.categories.lookup.get(category)
+            if category_code is None:
+                return None
+        if subcategory is not None:
+            subcategory_code = self.subcategories.lookup.get(subcategory)
+            if subcategory_code is None:
+                return None
+        if place is not None:
+            place_code = self.places.lookup.get(place)
+            if place_code is None:
+                return None
+
+        def matches(position):
+            day = self.dates[position][:10]
+            return ((start_day is None or day >= start_day)
+                    and (end_day is None or day <= end_day)
+                    and (category_code is None or self.categories.codes[position] == category_code)
+                    and (subcategory_code is None or self.subcategories.codes[position] == subcategory_code)
+                    and (place_code is None or self.places.codes[position] == place_code))
+
+        return category_code, subcategory_code, place_code, matches
+
+    def positions(self, start_day: Optional[str] = None, end_day: Optional[str] = None,
+                  category: Optional[str] = None, subcategory: Optional[str] = None,
+                  place: Optional[str] = None) -> List[int]:
+        """Row positions matching the filters, using the narrowest index available.
+
+        ``start_day`` and ``end_day`` are inclusive YYYY-MM-DD strings.
+        """
+        with self._lock:
+            matcher = self._matcher(start_day, end_day, category, subcategory, place)
+            if matcher is None:
+                return []
+            category_code, subcategory_code, place_code, matches = matcher
+
+            # Start from the smallest candidate list among the usable indexes
+            options = []
+            if category_code is not None and subcategory_code is not None:
+                options.append(self.by_subcategory.get((category_code, subcategory_code), ()))
+            elif category_code is not None:
+                options.append(self.by_category.get(category_code, ()))
+            if place_code is not None:
+                options.append(self.by_place.get(place_code, ()))
+            if start_day is not None or end_day is not None:
+                low = bisect.bisect_left(self.days, start_day) if start_day else 0
+                high = bisect.bisect_right(self.days, end_day) if end_day else len(self.days)
+                if not options:
+                    by_date = []
+                    for day in self.days[low:high]:
+                        by_date.extend(self.by_day[day])
+                    options.append(sorted(by_date))
+            candidates = min(options, key=len) if options else range(len(self))
+
+            return [position for position in candidates if matches(position)]
+
+    def iter_rows(self, **filters) -> Iterator[list]:
+        """Yield matching rows in sheet order."""
+        for position in self.positions(**filters):
+            yield self.row(position)
+
+    def iter_pages(self, page_size: int, start_day: Optional[str] = None, end_day: Optional[str] = None,
+                   category: Optional[str] = None, subcategory: Optional[str] = None,
+                   place: Optional[str] = None) -> Iterator[List[list]]:
+        """Yield matching rows in sheet order, scanning ``page_size`` positions at a time.
+
+        Unlike ``positions`` nothing proportional to the result is built, and
+        the lock is released between pages, so exporting the whole history
+        uses bounded memory and never holds off writers for long.
+        """
+        start = 0
+        while True:
+            with self._lock:
+                matcher = self._matcher(start_day, end_day, category, subcategory, place)
+                if matcher is None or start >= len(self):
+                    return
+                matches = matcher[-1]
+                end = min(len(self), start + page_size)
+                rows = [self.row(position) for position in range(start, end) if matches(position)]
+            if rows:
+                yield rows
+            start = end
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "loaded": self.loaded,
+                "rows": len(self),
+                "days": len(self.days),
+                "categories": len(self.by_category),
+                "places": len(self.by_place),
+            }
@@ -0,0 +1,154 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from typing import Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Sentinel used to stop the background flusher
+_STOP = object()
+
+
+class WriterQueueFull(Exception):
+    """Raised when the write-behind queue stays full for longer than the submit timeout."""
+
+
+class BatchedSheetWriter:
+    """Write-behind buffer that groups rows into a single append_rows call.
+
+    Rows submitted from any thread (Telegram handlers, Flask requests) are queued
+    and flushed by one background thread, either when ``max_batch`` rows are
+    waiting or when ``flush_interval`` seconds have passed since the first
+    queued row. ``append_rows`` receives the batch's rows for each
+    destination, as given by ``route`` for the rows' tenant (``None`` is the
+    shared sheet), and raises on failure. Each submit returns a Future that resolves to True once the
+    rows were committed to the sheet, or False if the flush failed.
+    """
+
+    def __init__(self, append_rows: Callable[[List[list], Optional[str]], None], max_batch: int = 50,
+                 flush_interval: float = 0.5, max_queue: int = 1000,
+                 route: Optional[Callable[[Optional[str]], Optional[str]]] = None):
+        self._append_rows = append_rows
+        self._route = route or (lambda tenant: tenant)
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def start(self):
+        """Start the background flusher if it is not running yet."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="sheet-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, row: list, timeout: Optional[float] = 5.0, tenant: Optional[str] = None) -> Future:
+        """Queue a single row and return a Future for its commit."""
+        return self.submit_many([row], timeout=timeout, tenant=tenant)
+
+    def submit_many(self, rows: List[list], timeout: Optional[float] = 5.0,
+                    tenant: Optional[str] = None) -> Future:
+        """Queue several rows that are committed together in the same batch."""
+        if self._closed:
+            raise RuntimeError("Sheet writer is closed")
+        self.start()
+        future = Future()
+        try:
+            self._queue.put((list(rows), future, tenant), timeout=timeout)
+        except queue.Full:
+            raise WriterQueueFull(f"Write queue full ({self._queue.maxsize} pending entries)")
+        return future
+
+    def pending(self) -> int:
+        """Number of queued entries not yet picked up by the flusher."""
+        return self._queue.qsize()
+
+    def close(self, timeout: float = 10.0):
+        """Flush everything still queued and stop the background thread."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is None or not self._thread.is_alive():
+            # Nothing is draining the queue; flush it from the caller's thread
+            self._drain_remaining()
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                self._drain_remaining()
+                return
+
+            batch = [item]
+            size = len(item[0])
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+
+            # Keep collecting until the batch is full or the time window closes
+            while size < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+                size += len(item[0])
+
+            self._flush(batch)
+            if stop:
+                self._drain_remaining()
+                return
+
+    def _drain_remaining(self):
+        batch = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                batch.append(item)
+        if batch:
+            self._flush(batch)
+
+    def _flush(self, batch):
+        groups = {}
+        routes = {}
+        for item in batch:
+            tenant = item[2]
+            if tenant not in routes:
+                routes[tenant] = self._route(tenant)
+            groups.setdefault(routes[tenant], []).append(item)
+
+        for destination, items in groups.items():
+            rows = [row for rows, _, _ in items for row in rows]
+            started = time.perf_counter()
+            try:
+                self._append_rows(rows, destination)
+                logger.info("Flushed %d rows to sheet", len(rows), extra={
+                    "event": "rows_flushed", "rows": len(rows),
+                    "append_ms": round((time.perf_counter() - started) * 1000, 3), "sample": True
+                })
+                success = True
+            except Exception as e:
+                logger.error(f"Failed to flush {len(rows)} rows to sheet: {e}")
+                success = False
+
+            for _, future, _ in items:
+                try:
+                    future.set_result(success)
+                except InvalidStateError:
+                    # Cancelled by a caller that gave up waiting; the rest of the batch still resolves
+                    pass
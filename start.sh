@@ -1,2 +1,25 @@
 #!/bin/bash
-python expense_bot.py
+# HTTP_SERVER=builtin (default) keeps Flask's server inside the bot process, which
+# answers every endpoint. HTTP_SERVER=gunicorn serves the web API with gunicorn
+# workers that share the SQLite outbox with the bot; those workers do not have the
+# bot's in-memory totals, so /summary, /export and /budgets answer 503 there.
+export HTTP_SERVER="${HTTP_SERVER:-builtin}"
+
+if [ "$HTTP_SERVER" != "gunicorn" ]; then
+    exec python expense_bot.py
+fi
+
+# Supervise both processes: signals reach both, and when either one exits the
+# other is stopped too, so the platform restarts the whole service instead of
+# leaving gunicorn answering /health for a dead bot
+gunicorn -c gunicorn.conf.py keep_alive:app &
+web=$!
+python expense_bot.py &
+bot=$!
+trap 'kill -TERM "$web" "$bot" 2>/dev/null' TERM INT
+
+wait -n
+status=$?
+kill -TERM "$web" "$bot" 2>/dev/null
+wait
+exit "$status"
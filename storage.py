@@ -0,0 +1,261 @@
+import os
+import time
+import sqlite3
+import threading
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from sheet_mirror import normalize_row
+
+# "sheets" writes to Google Sheets (through the outbox when OUTBOX_PATH is set), "sqlite" keeps
+# expenses in a local database only, "sync" uses the database as the primary store and the sheet as a replica
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sheets")
+STORAGE_BACKENDS = ("sheets", "sqlite", "sync")
+
+# Local expense database for the sqlite and sync backends, shared by the bot and any web workers
+EXPENSES_DB_PATH = os.getenv("EXPENSES_DB_PATH", os.path.join("data", "expenses.db"))
+
+# Seconds between pushes of new rows from the database to the sheet in sync mode
+STORAGE_SYNC_INTERVAL = float(os.getenv("STORAGE_SYNC_INTERVAL", "30"))
+
+# Rows read per query when loading the totals from the database
+STORAGE_PAGE_SIZE = 5000
+
+
+class StorageBackend:
+    """Where expense rows are committed and read back from.
+
+    ``append_rows(rows, tenant)`` commits the rows durably or raises;
+    ``iter_pages`` yields the rows of one destination (a tenant with its own
+    spreadsheet, or None for the shared one) page by page, oldest first.
+    """
+
+    name = ""
+
+    def append_rows(self, rows: List[list], tenant: Optional[str] = None):
+        raise NotImplementedError
+
+    def iter_pages(self, page_size: int, start_day: Optional[str] = None, end_day: Optional[str] = None,
+                   tenant: Optional[str] = None) -> Iterator[List[list]]:
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {"backend": self.name}
+
+    def close(self):
+        pass
+
+
+class SheetsBackend(StorageBackend):
+    """Google Sheets as the store.
+
+    The gspread plumbing (authentication, sheet resolution, tenants,
+    partitions, quota) stays in ExpenseBot, which passes in its append and
+    read functions.
+    """
+
+    name = "sheets"
+
+    def __init__(self, append_rows: Callable[[List[list], Optional[str]], None],
+                 iter_pages: Callable[[Optional[str], Optional[str], Optional[str]], Iterator[List[list]]]):
+        self._append_rows = append_rows
+        self._iter_pages = iter_pages
+
+    def append_rows(self, rows: List[list], tenant: Optional[str] = None):
+        self._append_rows(rows, tenant)
+
+    def iter_pages(self, page_size: int, start_day: Optional[str] = None, end_day: Optional[str] = None,
+                   tenant: Optional[str] = None) -> Iterator[List[list]]:
+        # Sheet reads are paged by EXPORT_PAGE_SIZE ranges
+        return self._iter_pages(start_day, end_day, tenant)
+
+
+class SQLiteBackend(StorageBackend):
+    """Local expense database (SQLite in WAL mode), one row per expense.
+
+    Each append is a single transaction with relaxed fsync, so it takes
+    thousands of writes per second. Rows keep the tenant that wrote them and
+    a ``synced`` flag; ``peek``/``ack`` expose the rows not yet copied to the
+    sheet with the same interface as the outbox, so an OutboxReplayer keeps
+    the sheet as a replica. ``route`` maps a row's tenant to its destination
+    (None is the shared sheet), as in the sheet writer. Rows appended by web
+    workers are flagged ``untracked`` until the bot has added them to its
+    budget totals (``take_untracked``).
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str, route: Optional[Callable[[Optional[str]], Optional[str]]] = None):
+        self.path = path
+        self._route = route or (lambda tenant: tenant)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS expenses ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " date TEXT NOT NULL,"
+            " product TEXT NOT NULL,"
+            " place TEXT NOT NULL,"
+            " category TEXT NOT NULL,"
+            " subcategory TEXT NOT NULL,"
+            " amount REAL NOT NULL,"
+            " quantity INTEGER NOT NULL,"
+            " tenant TEXT,"
+            " created_at REAL NOT NULL,"
+            " synced INTEGER NOT NULL DEFAULT 0)"
+        )
+        # Databases created before web workers flagged their rows lack the untracked column
+        columns = [column[1] for column in self._conn.execute("PRAGMA table_info(expenses)")]
+        if "untracked" not in columns:
+            self._conn.execute("ALTER TABLE expenses ADD COLUMN untracked INTEGER NOT NULL DEFAULT 0")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS expenses_date ON expenses (date)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS expenses_untracked ON expenses (id) WHERE untracked = 1")
+        # Only the rows still to be copied to the sheet are indexed for the replica sync
+        self._conn.execute("CREATE INDEX IF NOT EXISTS expenses_pending ON expenses (id) WHERE synced = 0")
+
+    def append_rows(self, rows: List[list], tenant: Optional[str] = None, untracked: bool = False):
+        """Store rows in a single transaction (``untracked`` for rows written outside the bot)."""
+        now = time.time()
+        values = [(*normalize_row(row), tenant, now, int(untracked)) for row in rows]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO expenses (date, product, place, category, subcategory, amount, quantity,"
+                    " tenant, created_at, untracked) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    values
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def rows_after(self, last_id: int, limit: int) -> List[Tuple[int, list, Optional[str]]]:
+        """Up to ``limit`` (id, row, tenant) entries with an id above ``last_id``, in order."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT id, date, product, place, category, subcategory, amount, quantity, tenant"
+                " FROM expenses WHERE id > ? ORDER BY id LIMIT ?", (last_id, limit)
+            )
+            return [(entry[0], list(entry[1:8]), entry[8]) for entry in cursor.fetchall()]
+
+    def take_untracked(self, limit: int) -> List[Tuple[int, list, Optional[str]]]:
+        """Up to ``limit`` of the oldest untracked (id, row, tenant) entries, which are marked tracked."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                entries = self._conn.execute(
+                    "SELECT id, date, product, place, category, subcategory, amount, quantity, tenant"
+                    " FROM expenses WHERE untracked = 1 ORDER BY id LIMIT ?", (limit,)
+                ).fetchall()
+                self._conn.executemany("UPDATE expenses SET untracked = 0 WHERE id = ?", [(entry[0],) for entry in entries])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [(entry[0], list(entry[1:8]), entry[8]) for entry in entries]
+
+    def iter_pages(self, page_size: int, start_day: Optional[str] = None, end_day: Optional[str] = None,
+                   tenant: Optional[str] = None) -> Iterator[List[list]]:
+        """Yield the destination's rows within the inclusive day range, ``page_size`` rows per query.
+
+        Pages are read by id (keyset), so the lock is only held per page and
+        writers are never held off by a long export.
+        """
+        conditions = ["id > ?"]
+        params: list = []
+        if start_day:
+            conditions.append("date >= ?")
+            params.append(start_day)
+        if end_day:
+            # Dates are 'YYYY-MM-DD HH:MM:SS' or bare days; '~' sorts after both
+            conditions.append("date < ?")
+            params.append(end_day + "~")
+        if tenant is not None:
+            conditions.append("tenant = ?")
+            params.append(tenant)
+        query = (
+            "SELECT id, date, product, place, category, subcategory, amount, quantity, tenant"
+            f" FROM expenses WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?"
+        )
+
+        routes = {}
+        last_id = 0
+        while True:
+            with self._lock:
+                entries = self._conn.execute(query, (last_id, *params, page_size)).fetchall()
+            if not entries:
+                return
+            last_id = entries[-1][0]
+            rows = []
+            for entry in entries:
+                owner = entry[8]
+                if owner not in routes:
+                    routes[owner] = self._route(owner)
+                if routes[owner] == tenant:
+                    rows.append(list(entry[1:8]))
+            if rows:
+                yield rows
+            if len(entries) < page_size:
+                return
+
+    def peek(self, limit: int, skip_tenants=()) -> List[Tuple[int, list, Optional[str]]]:
+        """Oldest (id, row, tenant) entries not copied to the sheet yet, like ExpenseOutbox.peek."""
+        # Filtered here rather than with NOT IN, whose bound variables would grow with the failing tenants
+        skip = {tenant or "" for tenant in skip_tenants}
+        entries = []
+        last_id = 0
+        while len(entries) < limit:
+            with self._lock:
+                page = self._conn.execute(
+                    "SELECT id, date, product, place, category, subcategory, amount, quantity, tenant"
+                    " FROM expenses WHERE synced = 0 AND id > ? ORDER BY id LIMIT ?", (last_id, limit)
+                ).fetchall()
+            entries.extend((entry[0], list(entry[1:8]), entry[8]) for entry in page if (entry[8] or "") not in skip)
+            if len(page) < limit:
+                break
+            last_id = page[-1][0]
+        return entries[:limit]
+
+    def ack(self, ids: List[int]):
+        """Mark rows as copied to the sheet."""
+        if not ids:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany("UPDATE expenses SET synced = 1 WHERE id = ?", [(row_id,) for row_id in ids])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def depth(self) -> int:
+        """Number of rows not copied to the sheet yet."""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM expenses WHERE synced = 0").fetchone()[0]
+
+    def oldest_age(self) -> Optional[float]:
+        """Age in seconds of the oldest row not copied to the sheet, or None when all are."""
+        with self._lock:
+            oldest = self._conn.execute("SELECT MIN(created_at) FROM expenses WHERE synced = 0").fetchone()[0]
+        if oldest is None:
+            return None
+        return max(0.0, time.time() - oldest)
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM expenses").fetchone()[0]
+
+    def stats(self) -> dict:
+        return {"backend": self.name, "rows": self.count()}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,264 @@
+import os
+import re
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+# Chat/API key -> spreadsheet registry; empty disables per-tenant spreadsheets
+TENANTS_PATH = os.getenv("TENANTS_PATH", os.path.join("data", "tenants.db"))
+
+# Returned by LRUCache.get for keys that are not cached
+MISSING = object()
+
+
+def parse_spreadsheet_id(text: str) -> Optional[str]:
+    """Extract a spreadsheet ID from a bare ID or a docs.google.com URL."""
+    text = text.strip()
+    match = re.search(r"/spreadsheets/d/([a-zA-Z0-9_-]+)", text)
+    if match:
+        return match.group(1)
+    if re.fullmatch(r"[a-zA-Z0-9_-]{20,}", text):
+        return text
+    return None
+
+
+# Created by _loaded_spreadsheet_class() on first use, so importing this module does not import gspread
+_LoadedSpreadsheet = None
+
+
+def _loaded_spreadsheet_class():
+    """The Spreadsheet subclass built from metadata that was already fetched."""
+    global _LoadedSpreadsheet
+    if _LoadedSpreadsheet is None:
+        import gspread
+
+        class LoadedSpreadsheet(gspread.Spreadsheet):
+            """Spreadsheet built from metadata that was already fetched (no extra request)."""
+
+            def __init__(self, client, spreadsheet_id: str, metadata: dict):
+                self.client = client
+                self._properties = {"id": spreadsheet_id}
+                self._properties.update(metadata["properties"])
+
+        _LoadedSpreadsheet = LoadedSpreadsheet
+    return _LoadedSpreadsheet
+
+
+def open_first_worksheet(client, spreadsheet_id: str):
+    """Open the first worksheet of a spreadsheet with a single metadata request.
+
+    ``client.open_by_key(...).sheet1`` fetches the spreadsheet metadata twice;
+    this reads it once and builds both handles from it.
+    """
+    # gspread is only needed once a tenant spreadsheet is opened
+    import gspread
+    from gspread.urls import SPREADSHEET_URL
+
+    response = client.request(
+        "get", SPREADSHEET_URL % spreadsheet_id,
+        params={"fields": "properties,sheets.properties"}
+    )
+    metadata = response.json()
+    sheets = metadata.get("sheets") or []
+    if not sheets:
+        raise gspread.WorksheetNotFound(f"Spreadsheet {spreadsheet_id} has no worksheets")
+    spreadsheet = _loaded_spreadsheet_class()(client, spreadsheet_id, metadata)
+    return gspread.Worksheet(spreadsheet, sheets[0]["properties"])
+
+
+class LRUCache:
+    """Thread-safe mapping that keeps at most ``capacity`` entries, dropping the least recently used."""
+
+    def __init__(self, capacity: int):
+        self.capacity = max(1, capacity)
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key, MISSING)
+            if value is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._items.move_to_end(key)
+            return value
+
+    def peek(self, key):
+        """Look a key up without counting it or refreshing its position."""
+        with self._lock:
+            return self._items.get(key, MISSING)
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._items),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class TenantRegistry:
+    """Persistent tenant -> spreadsheet ID mapping (SQLite in WAL mode).
+
+    A tenant is a Telegram chat (its chat ID) or an API key (``api:<key>``).
+    Lookups go to SQLite by primary key, so the registry can hold any number
+    of tenants without keeping them in memory.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tenants ("
+            " tenant_id TEXT PRIMARY KEY,"
+            " spreadsheet_id TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+
+    def get(self, tenant_id: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT spreadsheet_id FROM tenants WHERE tenant_id = ?", (tenant_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, tenant_id: str, spreadsheet_id: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO tenants (tenant_id, spreadsheet_id, updated_at) VALUES (?, ?, ?)"
+                " ON CONFLICT(tenant_id) DO UPDATE SET spreadsheet_id = excluded.spreadsheet_id,"
+                " updated_at = excluded.updated_at",
+                (tenant_id, spreadsheet_id, time.time())
+            )
+
+    def remove(self, tenant_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM tenants WHERE tenant_id = ?", (tenant_id,))
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM tenants").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class TenantSheets:
+    """Resolve a tenant's worksheet through the registry and an LRU of open handles.
+
+    ``open_worksheet`` takes a spreadsheet ID and returns its first worksheet
+    (one API call). Handles are cached by spreadsheet ID, so tenants sharing a
+    spreadsheet share its handle, and concurrent misses for the same
+    spreadsheet share a single open. The registry stays the source of truth:
+    each lookup reads it locally, so a relinked tenant is picked up at once.
+    """
+
+    def __init__(self, registry: TenantRegistry, open_worksheet: Callable[[str], object],
+                 capacity: int = 256):
+        self.registry = registry
+        self._open_worksheet = open_worksheet
+        self.cache = LRUCache(capacity)
+        self._lock = threading.Lock()
+        self._opening = {}
+
+    def worksheet(self, tenant_id: str):
+        """Return the tenant's worksheet, or None when it uses the shared sheet."""
+        spreadsheet_id = self.registry.get(tenant_id)
+        if spreadsheet_id is None:
+            return None
+        return self.open(spreadsheet_id)
+
+    def open(self, spreadsheet_id: str):
+        """Return the first worksheet of a spreadsheet, opening it only on a cache miss."""
+        handle = self.cache.get(spreadsheet_id)
+        if handle is not MISSING:
+            return handle
+
+        with self._lock:
+            lock = self._opening.setdefault(spreadsheet_id, threading.Lock())
+        try:
+            with lock:
+                # Another thread may have opened it while we waited
+                handle = self.cache.peek(spreadsheet_id)
+                if handle is MISSING:
+                    handle = self._open_worksheet(spreadsheet_id)
+                    self.cache.put(spreadsheet_id, handle)
+                return handle
+        finally:
+            with self._lock:
+                self._opening.pop(spreadsheet_id, None)
+
+    def link(self, tenant_id: str, spreadsheet_id: str):
+        """Point a tenant at a spreadsheet after checking that it can be opened."""
+        handle = self.open(spreadsheet_id)
+        self.registry.set(tenant_id, spreadsheet_id)
+        return handle
+
+    def unlink(self, tenant_id: str):
+        """Send a tenant back to the shared sheet."""
+        self.registry.remove(tenant_id)
+
+    def invalidate(self, spreadsheet_id: str):
+        """Forget a cached handle so the next write opens the spreadsheet again."""
+        self.cache.pop(spreadsheet_id)
+
+    def stats(self) -> dict:
+        return {"tenants": self.registry.count(), "cache": self.cache.stats()}
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Asignar hojas de cálculo a chats o claves de API")
+    parser.add_argument("action", choices=["set", "remove", "show"])
+    parser.add_argument("tenant", help="ID del chat de Telegram o api:<clave>")
+    parser.add_argument("spreadsheet", nargs="?", help="ID o URL de la hoja (para set)")
+    args = parser.parse_args()
+
+    registry = TenantRegistry(TENANTS_PATH)
+    if args.action == "set":
+        spreadsheet_id = parse_spreadsheet_id(args.spreadsheet or "")
+        if not spreadsheet_id:
+            parser.error("se requiere un ID o URL de hoja válido")
+        registry.set(args.tenant, spreadsheet_id)
+        print(f"✅ {args.tenant} -> {spreadsheet_id}")
+    elif args.action == "remove":
+        registry.remove(args.tenant)
+        print(f"✅ {args.tenant} usa la hoja compartida")
+    else:
+        print(registry.get(args.tenant) or "hoja compartida")
+
+
+if __name__ == "__main__":
+    main()
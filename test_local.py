@@ -4,6 +4,9 @@ Script de prueba para verificar la configuración local del bot
 """
 import os
 import json
+import time
+import asyncio
+import tempfile
 from datetime import datetime
 
 def test_environment():
@@ -50,10 +53,10 @@ def test_imports():
         print("❌ python-telegram-bot no se puede importar")
     
     try:
-        from oauth2client.service_account import ServiceAccountCredentials
-        print("✅ oauth2client importado correctamente")
+        from google.oauth2.service_account import Credentials
+        print("✅ google-auth importado correctamente")
     except ImportError:
-        print("❌ oauth2client no se puede importar")
+        print("❌ google-auth no se puede importar")
 
 def test_keep_alive():
     """Test keep_alive module"""
@@ -76,10 +79,835 @@ def test_keep_alive():
                 print("✅ Endpoint /health funciona correctamente")
             else:
                 print(f"❌ Endpoint /health devuelve {response.status_code}")
+
+            response = client.get('/metrics')
+            if response.status_code == 200 and b'expense_stage_seconds_bucket' in response.data:
+                print("✅ Endpoint /metrics funciona correctamente")
+            else:
+                print(f"❌ Endpoint /metrics devuelve {response.status_code}")
                 
     except Exception as e:
         print(f"❌ Error en keep_alive: {e}")
 
+def test_metric_shards():
+    """Test that metrics keep no per-thread state for threads that have exited"""
+    print("\n📈 Verificando métricas con muchos hilos...")
+
+    import threading
+    from metrics import _CounterChild
+
+    # A bare child, so the test counter is not added to the exported registry
+    counter = _CounterChild()
+    for _ in range(20):
+        threads = [threading.Thread(target=counter.inc) for _ in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    total = counter.value()
+    shards = len(counter._shards._all)
+    if total == 1000:
+        print("✅ Los incrementos de hilos terminados se conservan")
+    else:
+        print(f"❌ Total tras 1000 incrementos: {total}")
+
+    if shards <= 1:
+        print("✅ Los hilos terminados no dejan contadores propios")
+    else:
+        print(f"❌ Quedan {shards} contadores de hilos terminados")
+
+def test_api_validation():
+    """Test that invalid fields in /add_expense are rejected with 400 before anything is stored"""
+    print("\n🧾 Verificando validación de la API...")
+
+    import keep_alive
+    from keep_alive import app
+
+    class RecordingStorage:
+        """API storage that keeps the expenses it is given"""
+        def __init__(self):
+            self.expenses = []
+        def _log_expense_to_sheet(self, expense_data, tenant=None):
+            self.expenses.append(expense_data)
+            return True
+
+    storage = RecordingStorage()
+    previous, keep_alive.bot_instance = keep_alive.bot_instance, storage
+    expense = {"producto": "Pan", "lugar": "Panadería", "categoria": "Comida", "subcategoria": "Básicos",
+               "importe": 2500, "cantidad": 1}
+    def post(**fields):
+        return app.test_client().post('/add_expense', json=dict(expense, **fields)).status_code
+    try:
+        invalid = [post(importe="mucho"), post(fecha="01/07/2025"), post(fecha="2025-7-1"), post(fecha="2025-07-01T10:00")]
+        valid = [post(fecha="2025-07-01"), post(fecha="2025-07-01 10:30:00")]
+    finally:
+        keep_alive.bot_instance = previous
+
+    if invalid == [400, 400, 400, 400] and valid == [200, 200]:
+        print("✅ Importes y fechas inválidos responden 400")
+    else:
+        print(f"❌ Respuestas inesperadas: {invalid} {valid}")
+
+    if [expense_data["date"] for expense_data in storage.expenses] == ["2025-07-01", "2025-07-01 10:30:00"]:
+        print("✅ Solo se registran los gastos válidos, con su fecha")
+    else:
+        print(f"❌ Gastos registrados: {storage.expenses}")
+
+def test_lazy_import():
+    """Test that importing the bot needs no secrets and loads neither gspread nor telegram"""
+    print("\n🚀 Verificando arranque sin efectos secundarios...")
+
+    import subprocess
+    import sys
+
+    env = {key: value for key, value in os.environ.items() if key not in ("BOT_TOKEN", "GOOGLE_CREDS")}
+    code = "import sys, expense_bot; print(expense_bot.expense_bot is None, 'gspread' in sys.modules, 'telegram' in sys.modules)"
+    result = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    if result.returncode == 0 and result.stdout.split() == ["True", "False", "False"]:
+        print("✅ expense_bot se importa sin credenciales ni dependencias pesadas")
+    else:
+        print(f"❌ Importar expense_bot no es inmediato: {result.stdout.strip() or result.stderr.strip()[-200:]}")
+
+class SlowFakeSheet:
+    """Hoja falsa que tarda en cada escritura, como una llamada real a Sheets"""
+    def __init__(self, delay=1.0):
+        self.delay = delay
+        self.rows = []
+
+    def append_rows(self, rows):
+        time.sleep(self.delay)
+        self.rows.extend(rows)
+
+class FakeMessage:
+    """Mensaje de Telegram falso que guarda las respuestas"""
+    def __init__(self, text):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text):
+        self.replies.append(text)
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+class FakeUpdate:
+    def __init__(self, text, chat_id=1000):
+        self.message = FakeMessage(text)
+        self.effective_chat = FakeChat(chat_id)
+
+def test_async_latency():
+    """Test that a slow sheet write does not delay other commands"""
+    print("\n⏱️ Verificando latencia con una hoja lenta...")
+
+    if not os.getenv("BOT_TOKEN") or not os.getenv("GOOGLE_CREDS"):
+        print("⚠️ Omitido: requiere BOT_TOKEN y GOOGLE_CREDS")
+        return
+
+    import expense_bot as bot_module
+    from outbox import ExpenseOutbox
+
+    bot = bot_module.init_bot()
+    fake_sheet = SlowFakeSheet(delay=1.0)
+    bot.sheet = fake_sheet
+
+    # Use a throwaway outbox so the test never touches real pending expenses
+    if bot.outbox:
+        bot.outbox = bot.replayer.outbox = ExpenseOutbox(os.path.join(tempfile.mkdtemp(), "outbox.db"))
+
+    async def run():
+        expense = FakeUpdate("Pan\nPanadería\nComida\nBásicos\n2500\n1")
+        command = FakeUpdate("/start")
+
+        slow_task = asyncio.create_task(bot_module.handle_expense_message(expense, None))
+        await asyncio.sleep(0.05)
+
+        started = time.perf_counter()
+        await bot_module.start(command, None)
+        start_latency = time.perf_counter() - started
+
+        await slow_task
+        if bot.replayer:
+            await asyncio.to_thread(bot.replayer.drain)
+        return start_latency, expense.message.replies
+
+    start_latency, replies = asyncio.run(run())
+
+    if start_latency < 0.2:
+        print(f"✅ /start respondió en {start_latency * 1000:.1f} ms mientras se escribía en la hoja")
+    else:
+        print(f"❌ /start tardó {start_latency * 1000:.1f} ms detrás de la escritura en la hoja")
+
+    if fake_sheet.rows and replies and replies[0].strip().startswith("✅"):
+        print("✅ El gasto se registró en la hoja lenta")
+    else:
+        print("❌ El gasto no se registró en la hoja lenta")
+
+def test_writer_timeout():
+    """Test that a caller timing out in the middle of a batch does not break the sheet writer"""
+    print("\n⌛ Verificando escrituras tras un timeout...")
+
+    from sheet_writer import BatchedSheetWriter
+
+    appended = []
+    def append_rows(rows, tenant):
+        time.sleep(0.2)
+        appended.extend(rows)
+
+    writer = BatchedSheetWriter(append_rows, max_batch=10, flush_interval=0.05)
+    futures = [writer.submit([f"fila {n}"]) for n in range(3)]
+
+    async def run():
+        # Unshielded, as before: the timeout cancels the writer's future
+        try:
+            await asyncio.wait_for(asyncio.wrap_future(futures[0]), 0.05)
+        except asyncio.TimeoutError:
+            pass
+        # Shielded, as the handlers wait now: the future survives the timeout
+        try:
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(futures[1])), 0.05)
+        except asyncio.TimeoutError:
+            pass
+    asyncio.run(run())
+
+    try:
+        results = [futures[1].result(timeout=2), futures[2].result(timeout=2), writer.submit(["fila 3"]).result(timeout=2)]
+    except Exception as e:
+        results = [e]
+    writer.close()
+    if results == [True, True, True] and len(appended) == 4:
+        print("✅ El resto del lote se confirma y el writer sigue escribiendo")
+    else:
+        print(f"❌ Resultados tras el timeout: {results}, filas escritas: {len(appended)}")
+
+def test_tenant_sheets():
+    """Test that tenant spreadsheets are opened once and evicted when the cache is full"""
+    print("\n🗂️ Verificando hojas por chat...")
+
+    from tenants import TenantRegistry, TenantSheets
+
+    opened = []
+    def open_worksheet(spreadsheet_id):
+        opened.append(spreadsheet_id)
+        return f"hoja-{spreadsheet_id}"
+
+    registry = TenantRegistry(os.path.join(tempfile.mkdtemp(), "tenants.db"))
+    sheets = TenantSheets(registry, open_worksheet, capacity=2)
+    for chat_id in range(3):
+        registry.set(str(chat_id), f"sheet{chat_id}")
+
+    first = sheets.worksheet("0")
+    again = sheets.worksheet("0")
+    if first == again == "hoja-sheet0" and opened == ["sheet0"]:
+        print("✅ La hoja de un chat se abre una sola vez")
+    else:
+        print(f"❌ Aperturas inesperadas: {opened}")
+
+    sheets.worksheet("1")
+    sheets.worksheet("2")
+    if len(sheets.cache) == 2 and sheets.cache.evictions == 1:
+        print("✅ El caché descarta la hoja menos usada")
+    else:
+        print(f"❌ Caché con {len(sheets.cache)} hojas y {sheets.cache.evictions} descartes")
+
+    if sheets.worksheet("desconocido") is None:
+        print("✅ Los chats sin hoja propia usan la hoja compartida")
+    else:
+        print("❌ Un chat sin hoja propia recibió una hoja")
+
+def test_idempotency():
+    """Test that a repeated key is detected, also from another process sharing the file"""
+    print("\n🔁 Verificando idempotencia...")
+
+    from idempotency import IdempotencyIndex
+
+    path = os.path.join(tempfile.mkdtemp(), "idempotency.db")
+    worker1 = IdempotencyIndex(path, ttl=60)
+    worker2 = IdempotencyIndex(path, ttl=60)
+
+    first = worker1.claim("api:clave")
+    in_progress = worker2.claim("api:clave")
+    worker1.complete("api:clave", "respuesta")
+    replay = worker2.claim("api:clave")
+    if first == (True, None) and in_progress == (False, None) and replay == (False, "respuesta"):
+        print("✅ Un reintento recibe la respuesta original sin procesarse de nuevo")
+    else:
+        print(f"❌ Resultados inesperados: {first}, {in_progress}, {replay}")
+
+    worker1.claim("tg:1:1")
+    worker1.release("tg:1:1")
+    if worker2.claim("tg:1:1") == (True, None):
+        print("✅ Una clave liberada tras un error se puede reintentar")
+    else:
+        print("❌ La clave liberada sigue bloqueada")
+
+    import keep_alive
+    from keep_alive import app
+
+    class FlakyStorage:
+        """Bulk API storage whose writes fail while ``failing`` is set"""
+        idempotency = IdempotencyIndex("")
+        failing = True
+        written = 0
+        def _log_expenses_to_sheet(self, expenses, tenant=None):
+            if self.failing:
+                return False
+            self.written += len(expenses)
+            return True
+
+    storage = FlakyStorage()
+    previous, keep_alive.bot_instance = keep_alive.bot_instance, storage
+    body = "producto,lugar,categoria,subcategoria,importe,cantidad\nPan,Panadería,Comida,Básicos,2500,1\n"
+    def post(key, data=body):
+        return app.test_client().post('/add_expenses', data=data.encode(),
+                                      headers={'Content-Type': 'text/csv', 'Idempotency-Key': key})
+    try:
+        failed = post("lote-1")
+        storage.failing = False
+        retried = post("lote-1")
+        replayed = post("lote-1")
+        reused = post("lote-1", body + "Leche,Super,Comida,Lácteos,1800,2\n")
+    finally:
+        keep_alive.bot_instance = previous
+    if ((failed.status_code, retried.status_code, replayed.status_code, reused.status_code) == (503, 200, 200, 422)
+            and replayed.headers.get('Idempotent-Replayed') == 'true' and storage.written == 1):
+        print("✅ Un fallo del almacenamiento se reintenta y una clave con otro contenido se rechaza")
+    else:
+        print(f"❌ Respuestas de la carga masiva: {failed.status_code}, {retried.status_code}, "
+              f"{replayed.status_code}, {reused.status_code}; filas escritas: {storage.written}")
+
+    expiring = IdempotencyIndex("", ttl=0.05)
+    expiring.claim("tg:1:2")
+    expiring.complete("tg:1:2")
+    time.sleep(0.1)
+    if expiring.claim("tg:1:2") == (True, None):
+        print("✅ Las claves expiran")
+    else:
+        print("❌ La clave no expiró")
+
+def test_export():
+    """Test that the export reads the sheet in bounded pages and filters the rows"""
+    print("\n📤 Verificando exportación...")
+
+    from export import iter_sheet_pages, filter_pages, csv_chunks
+
+    sheet = [["2025-06-%02d 10:00:00" % (day % 28 + 1), f"Producto {day}", "Lugar",
+              "Comida" if day % 2 else "Hogar", "Varios", 100, 1] for day in range(25)]
+    ranges = []
+    def read_range(range_name):
+        ranges.append(range_name)
+        first, last = (int(part.strip("AG")) for part in range_name.split(":"))
+        return sheet[first - 2:last - 1]
+
+    pages = filter_pages(iter_sheet_pages(read_range, page_size=10), "2025-06-05", "2025-06-20", "comida")
+    lines = "".join(csv_chunks(pages)).splitlines()
+
+    if ranges == ["A2:G11", "A12:G21", "A22:G31"]:
+        print("✅ La hoja se lee por páginas acotadas")
+    else:
+        print(f"❌ Rangos leídos: {ranges}")
+
+    if lines[0].startswith("fecha,producto") and len(lines) == 9 and all(",Comida," in line for line in lines[1:]):
+        print("✅ El CSV tiene encabezado y solo los gastos filtrados")
+    else:
+        print(f"❌ CSV inesperado: {lines}")
+
+class FakeWorksheet:
+    def __init__(self, sheet_id, title):
+        self.id = sheet_id
+        self.title = title
+        self.rows = []
+
+    def append_row(self, row):
+        self.rows.append(row)
+
+class FakeSpreadsheet:
+    """Hoja de cálculo falsa con pestañas, como la que usan las particiones"""
+    id = "hoja"
+
+    def __init__(self):
+        self.sheets = [FakeWorksheet(0, "Gastos")]
+
+    def worksheets(self):
+        return list(self.sheets)
+
+    def add_worksheet(self, title, rows, cols):
+        self.sheets.append(FakeWorksheet(len(self.sheets), title))
+        return self.sheets[-1]
+
+def test_partitions():
+    """Test that monthly partitions are created once, with headers, and selected by date range"""
+    print("\n🗓️ Verificando particiones mensuales...")
+
+    from partitions import SheetPartitions
+
+    spreadsheet = FakeSpreadsheet()
+    partitions = SheetPartitions("month", lambda kind, func, *args: func(*args), ["FECHA DEL GASTO"])
+    partitions.attach(spreadsheet)
+
+    for date in ("2025-05-31 23:59:00", "2025-06-01 00:01:00", "2025-06-15 12:00:00", "2025-07-02 08:00:00"):
+        partitions.worksheet(partitions.key(date))
+
+    titles = [sheet.title for sheet in spreadsheet.sheets]
+    if titles == ["Gastos", "2025-05", "2025-06", "2025-07"] and spreadsheet.sheets[2].rows == [["FECHA DEL GASTO"]]:
+        print("✅ Se crea una pestaña por mes con los encabezados")
+    else:
+        print(f"❌ Pestañas inesperadas: {titles}")
+
+    if partitions.periods("2025-06-10", "2025-07-01") == ["2025-06", "2025-07"] and partitions.key("15/06/2025") is None:
+        print("✅ Las lecturas por fecha solo usan los meses necesarios")
+    else:
+        print(f"❌ Meses seleccionados: {partitions.periods('2025-06-10', '2025-07-01')}")
+
+def test_mirror_append_race():
+    """Test that rows appended by the bot reach the mirror once even if a sync reads the sheet meanwhile"""
+    print("\n🪞 Verificando la copia local durante una escritura...")
+
+    import threading
+    from aggregates import ExpenseAggregates
+    from sheet_mirror import SheetMirror
+
+    sheet = [["2025-06-01 10:00:00", "Pan", "Panadería", "Comida", "Básicos", 2500, 1]]
+    def read_range(range_name):
+        first, last = (int(part[1:]) for part in range_name.split(":"))
+        return [list(row) for row in sheet[first - 2:last - 1]]
+
+    mirror = SheetMirror(read_range, page_size=100)
+    aggregates = ExpenseAggregates()
+    mirror.listeners.append(aggregates)
+    mirror.load()
+
+    rows = [["2025-06-02 10:00:00", "Leche", "Super", "Comida", "Lácteos", 1800, 2]]
+    written = threading.Event()
+    def append():
+        # Like ExpenseBot._append_rows: the sheet is written, then the mirror is told
+        with mirror.appending():
+            sheet.extend(rows)
+            written.set()
+            time.sleep(0.1)
+            mirror.append_rows(rows)
+    writer = threading.Thread(target=append)
+    writer.start()
+    written.wait()
+    mirror.sync()
+    writer.join()
+
+    if len(mirror) == len(sheet) == 2 and aggregates.month("2025-06")["gastos"] == 2:
+        print("✅ Las filas escritas por el bot entran una sola vez en la copia local")
+    else:
+        print(f"❌ Filas en la copia local: {len(mirror)} de {len(sheet)}")
+
+def test_storage_backend():
+    """Test the SQLite backend's write rate and its sync to the sheet through the replayer"""
+    print("\n💾 Verificando base de datos local...")
+
+    from storage import SQLiteBackend
+    from outbox import OutboxReplayer
+
+    store = SQLiteBackend(os.path.join(tempfile.mkdtemp(), "expenses.db"),
+                          route=lambda tenant: tenant if tenant == "api:propia" else None)
+    writes = 2000
+    started = time.perf_counter()
+    for number in range(writes):
+        store.append_rows([["2025-06-%02d 10:00:00" % (number % 28 + 1), f"Producto {number}", "Lugar",
+                            "Comida", "Varios", 100, 1]])
+    rate = writes / (time.perf_counter() - started)
+    if rate >= 1000:
+        print(f"✅ {rate:.0f} escrituras por segundo")
+    else:
+        print(f"❌ Solo {rate:.0f} escrituras por segundo")
+
+    store.append_rows([["2025-07-01", "Silla", "Tienda", "Hogar", "Muebles", 5000, 1]], "api:propia")
+    shared = [row for page in store.iter_pages(500, start_day="2025-06-28") for row in page]
+    own = [row for page in store.iter_pages(500, tenant="api:propia") for row in page]
+    if len(shared) == writes // 28 and own == [["2025-07-01", "Silla", "Tienda", "Hogar", "Muebles", 5000.0, 1]]:
+        print("✅ Las páginas filtran por fecha y por hoja de destino")
+    else:
+        print(f"❌ Páginas inesperadas: {len(shared)} compartidas, {own}")
+
+    sheet = []
+    replica = OutboxReplayer(store, lambda rows, tenant: sheet.extend(rows), batch_size=500)
+    replica.drain()
+    if len(sheet) == writes + 1 and store.depth() == 0 and store.count() == writes + 1:
+        print("✅ La hoja recibe una copia de cada gasto y la base los conserva")
+    else:
+        print(f"❌ Sincronización incompleta: {len(sheet)} en la hoja, {store.depth()} pendientes")
+
+def test_skipped_tenants():
+    """Test that the replayer can skip any number of failing destinations"""
+    print("\n⏭️ Verificando destinos omitidos al subir pendientes...")
+
+    from outbox import ExpenseOutbox
+
+    outbox = ExpenseOutbox(os.path.join(tempfile.mkdtemp(), "outbox.db"))
+    for number in range(10):
+        outbox.append(["2025-06-01 10:00:00", f"Producto {number}", "Lugar", "Comida", "Varios", 100, 1],
+                      "caido" if number % 2 else None)
+    # More failing tenants than SQLite accepts bound variables in one query (999 in older builds)
+    import sqlite3
+    outbox._conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+    failing = [f"chat {number}" for number in range(2000)] + ["caido"]
+    try:
+        entries = outbox.peek(3, skip_tenants=failing)
+    except Exception as e:
+        entries = e
+    if isinstance(entries, list) and [row[1] for _, row, _ in entries] == ["Producto 0", "Producto 2", "Producto 4"]:
+        print("✅ El outbox omite los destinos que fallan sin límite de cantidad")
+    else:
+        print(f"❌ Pendientes del outbox: {entries}")
+
+    from storage import SQLiteBackend
+
+    store = SQLiteBackend(os.path.join(tempfile.mkdtemp(), "expenses.db"))
+    for number in range(10):
+        store.append_rows([["2025-06-01 10:00:00", f"Producto {number}", "Lugar", "Comida", "Varios", 100, 1]],
+                          "caido" if number % 2 else None)
+    store._conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+    try:
+        entries = store.peek(3, skip_tenants=failing)
+    except Exception as e:
+        entries = e
+    if isinstance(entries, list) and [row[1] for _, row, _ in entries] == ["Producto 0", "Producto 2", "Producto 4"]:
+        print("✅ La base local omite los destinos que fallan sin límite de cantidad")
+    else:
+        print(f"❌ Pendientes de la base local: {entries}")
+
+def test_google_session():
+    """Test that the access token is fetched and renewed in the background, before any request needs it"""
+    print("\n🔑 Verificando renovación del token de Google...")
+
+    from benchmark import fake_credentials, fake_google
+    from google_session import GoogleSession
+
+    server = fake_google(token_latency=0.05, connect_latency=0, idle_timeout=5, token_lifetime=226)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    info = dict(json.loads(fake_credentials()), token_uri=f"{base_url}/token")
+    session = GoogleSession(info, ["https://www.googleapis.com/auth/spreadsheets"], refresh_margin=225.5,
+                            keepalive_interval=0)
+    session.start()
+    deadline = time.time() + 5
+    while session.refreshes < 2 and time.time() < deadline:
+        time.sleep(0.05)
+    session.close()
+    server.shutdown()
+    if session.refreshes >= 2 and session.credentials.valid:
+        print(f"✅ Token renovado {session.refreshes} veces en segundo plano")
+    else:
+        print(f"❌ El token no se renovó a tiempo: {session.stats()}")
+
+def test_log_pipeline():
+    """Test that logging never blocks on a stalled sink, writes JSON and samples high-volume events"""
+    print("\n📝 Verificando registro de logs en segundo plano...")
+
+    import io
+    import logging
+    import threading
+    from log_pipeline import LogPipeline, JsonFormatter
+
+    class StalledSink(logging.Handler):
+        def __init__(self):
+            super().__init__()
+            self.unblock = threading.Event()
+        def emit(self, record):
+            self.unblock.wait()
+
+    sink = StalledSink()
+    pipeline = LogPipeline(sink, max_queue=100)
+    pipeline.start()
+    stalled = logging.getLogger("test_local.stalled")
+    stalled.propagate = False
+    stalled.addHandler(pipeline)
+    started = time.perf_counter()
+    for number in range(5000):
+        stalled.warning("Gasto %d", number)
+    elapsed = time.perf_counter() - started
+    sink.unblock.set()
+    pipeline.stop()
+    if elapsed < 1.0 and pipeline.dropped > 0:
+        print(f"✅ 5000 logs en {elapsed * 1000:.0f} ms con la salida bloqueada ({pipeline.dropped} descartados)")
+    else:
+        print(f"❌ El log bloqueó {elapsed:.2f} s o no descartó nada")
+
+    output = io.StringIO()
+    writer = logging.StreamHandler(output)
+    writer.setFormatter(JsonFormatter())
+    pipeline = LogPipeline(writer, sample_rate=0.0)
+    pipeline.start()
+    structured = logging.getLogger("test_local.structured")
+    structured.propagate = False
+    structured.setLevel(logging.INFO)
+    structured.addHandler(pipeline)
+    structured.info("Handled expense message", extra={"event": "expense_message", "chat_id": 42, "parse_ms": 0.1})
+    for _ in range(100):
+        structured.info("Stored expense locally", extra={"event": "expense_stored", "sample": True})
+    pipeline.stop()
+    events = [json.loads(line) for line in output.getvalue().splitlines()]
+    if len(events) == 1 and events[0]["chat_id"] == 42 and events[0]["event"] == "expense_message" and pipeline.sampled_out == 100:
+        print("✅ Eventos en JSON con sus campos y muestreo de los frecuentes")
+    else:
+        print(f"❌ Salida inesperada: {events}, {pipeline.stats()}")
+
+def test_budgets():
+    """Test budget alerts, the monthly roll-over and the startup rebuild without double counting"""
+    print("\n💼 Verificando presupuestos...")
+
+    from budgets import BudgetStore, BudgetTracker
+
+    path = os.path.join(tempfile.mkdtemp(), "budgets.db")
+    tracker = BudgetTracker(BudgetStore(path), thresholds=[80, 100])
+    # Set through another connection, like the web API in a gunicorn worker
+    BudgetStore(path).set("Comida", None, 1000)
+    tracker.store.set("comida", "Lácteos", 200)
+
+    month = datetime.now().strftime("%Y-%m")
+    def row(amount, subcategory="Varios", date=None):
+        return [date or datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "Producto", "Lugar", "Comida", subcategory, amount, 1]
+
+    alerts = [tracker.record([row(amount)]) for amount in (500, 250, 100, 200)]
+    thresholds = [[alert["umbral"] for alert in batch] for batch in alerts]
+    if thresholds == [[], [], [80], [100]]:
+        print("✅ Cada umbral avisa una sola vez, al cruzarlo")
+    else:
+        print(f"❌ Avisos inesperados: {thresholds}")
+
+    lacteos = tracker.record([row(150, "lácteos"), row(60, "lácteos")])
+    if [(alert["subcategoria"], alert["umbral"]) for alert in lacteos] == [("Lácteos", 100)]:
+        print("✅ Los presupuestos por subcategoría ignoran mayúsculas")
+    else:
+        print(f"❌ Avisos de subcategoría inesperados: {lacteos}")
+
+    # The month's rows as the sheet returns them: one of them was also recorded during the rebuild
+    sheet_rows = [row(300), row(100, date=f"{month}-01")]
+    def pages():
+        tracker.record([sheet_rows[0], row(50)])
+        yield sheet_rows
+    tracker.rebuild(pages())
+    status = {item["subcategoria"]: item["gastado"] for item in tracker.status()}
+    if tracker.loaded and status[None] == 450:
+        print("✅ La reconstrucción no cuenta dos veces los gastos registrados mientras lee")
+    else:
+        print(f"❌ Totales tras reconstruir: {status}")
+
+    # A future-dated expense (e.g. an API 'fecha' years ahead) must not move the tracker to its month
+    future = tracker.record([row(10, date=f"{int(month[:4]) + 5}-01-01 09:00:00")])
+    current = tracker.record([row(400)])
+    if (not future and tracker.month == month and [(alert["mes"], alert["umbral"]) for alert in current] == [(month, 80)]
+            and tracker.status()[0]["gastado"] == 850):
+        print("✅ Un gasto con fecha futura no reemplaza los totales del mes")
+    else:
+        print(f"❌ Tras un gasto futuro: {tracker.month} {tracker.categories} {current}")
+
+    import budgets
+    next_month = f"{int(month[:4]) + int(month[5:]) // 12}-{int(month[5:]) % 12 + 1:02d}"
+    saved_month, budgets.current_month = budgets.current_month, lambda: next_month
+    try:
+        tracker.record([row(900, date=f"{next_month}-01 09:00:00")])
+        tracker.record([row(5000, date=f"{month}-02 09:00:00")])
+    finally:
+        budgets.current_month = saved_month
+    if tracker.month == next_month and tracker.categories == {"comida": 900}:
+        print("✅ Los totales empiezan de cero al cambiar de mes")
+    else:
+        print(f"❌ Totales tras cambiar de mes: {tracker.month} {tracker.categories}")
+
+def test_worker_budgets():
+    """Test that expenses written by web workers reach the bot's budgets once, before they are replayed"""
+    print("\n🧮 Verificando presupuestos con gastos de los workers...")
+
+    if not os.getenv("BOT_TOKEN") or not os.getenv("GOOGLE_CREDS"):
+        print("⚠️ Omitido: requiere BOT_TOKEN y GOOGLE_CREDS")
+        return
+
+    import expense_bot as bot_module
+    from budgets import BudgetStore, BudgetTracker
+    from outbox import ExpenseOutbox
+
+    bot = bot_module.init_bot()
+    if not bot.outbox:
+        print("⚠️ Omitido: requiere OUTBOX_PATH")
+        return
+    directory = tempfile.mkdtemp()
+    bot.outbox = bot.replayer.outbox = ExpenseOutbox(os.path.join(directory, "outbox.db"))
+    saved_budgets, bot.budgets = bot.budgets, BudgetTracker(BudgetStore(os.path.join(directory, "budgets.db")))
+
+    try:
+        # A gunicorn worker appends through its own connection
+        worker = ExpenseOutbox(bot.outbox.path)
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        worker.append_many([[now, "Pan", "Panadería", "Comida", "Básicos", 300, 1]], None, untracked=True)
+        worker.close()
+
+        held = bot.outbox.peek(10)
+        bot.track_worker_rows()
+        bot.track_worker_rows()
+        replayable = bot.outbox.peek(10)
+    finally:
+        bot.budgets, saved = saved_budgets, bot.budgets
+
+    if not held and len(replayable) == 1:
+        print("✅ Los gastos de los workers se suben después de contarlos en los presupuestos")
+    else:
+        print(f"❌ Filas a subir antes/después: {len(held)}/{len(replayable)}")
+
+    if saved.categories == {"comida": 300}:
+        print("✅ Los gastos de los workers se cuentan una sola vez")
+    else:
+        print(f"❌ Totales con gastos de los workers: {saved.categories}")
+
+def test_reply_scheduler():
+    """Test that replies are paced per chat, merged in bursts and resent after RetryAfter"""
+    print("\n📨 Verificando cola de respuestas...")
+
+    from telegram.error import RetryAfter
+    from outbound import ReplyScheduler
+
+    sent = []
+    async def send(chat_id, text):
+        if not sent:
+            sent.append((chat_id, None, time.monotonic()))
+            raise RetryAfter(1)
+        sent.append((chat_id, text, time.monotonic()))
+
+    async def run():
+        replies = ReplyScheduler(send, global_rate=100, chat_rate=20, chat_burst=1)
+        replies.start()
+        started = time.perf_counter()
+        replies.enqueue(1, "Primera respuesta")
+        for number in range(5):
+            replies.enqueue(1, f"✅ Gasto {number}", merge=True)
+        for number in range(3):
+            replies.enqueue(2, f"✅ Gasto {number}", merge=True)
+        enqueue_ms = (time.perf_counter() - started) * 1000
+        await replies.close(timeout=5)
+        return replies, enqueue_ms
+
+    replies, enqueue_ms = asyncio.run(run())
+    delivered = {chat_id: [text for chat, text, _ in sent[1:] if chat == chat_id] for chat_id in (1, 2)}
+    if enqueue_ms < 50 and delivered[1] == ["Primera respuesta", "\n\n".join(f"✅ Gasto {n}" for n in range(5))] \
+            and delivered[2] == ["\n\n".join(f"✅ Gasto {n}" for n in range(3))]:
+        print(f"✅ 9 respuestas encoladas en {enqueue_ms:.1f} ms y enviadas en orden como {len(sent) - 1} mensajes")
+    else:
+        print(f"❌ Mensajes inesperados: {delivered}")
+
+    resent_at = next(at for chat_id, text, at in sent if text == "Primera respuesta")
+    if replies.retry_after == 1 and resent_at - sent[0][2] >= 0.9:
+        print("✅ RetryAfter pausa los envíos el tiempo pedido y el mensaje se reenvía")
+    else:
+        print(f"❌ RetryAfter no se respetó: {replies.stats()}")
+
+def test_recurring():
+    """Test that due recurring instances are caught up in batches, once, with month-end days clamped"""
+    print("\n🔁 Verificando gastos recurrentes...")
+
+    from datetime import date
+    from recurring import RecurringStore, RecurringRunner
+
+    store = RecurringStore(os.path.join(tempfile.mkdtemp(), "recurring.db"))
+    rent = {"product": "Alquiler", "place": "Inmobiliaria", "category": "Vivienda", "subcategory": "Alquiler",
+            "amount": 350000.0, "quantity": 1}
+    store.add(rent, "monthly", date(2025, 1, 31), tenant="123")
+    store.add(dict(rent, product="Gimnasio", amount=9000.0), "weekly", date(2025, 3, 20))
+
+    commits = []
+    failing = {"123"}
+    def commit(groups):
+        commits.append({tenant: [row[0][:10] for row in rows] for tenant, rows in groups.items()})
+        return {tenant: tenant not in failing for tenant in groups}
+
+    runner = RecurringRunner(store, commit, batch_size=4)
+    today = date(2025, 4, 5)
+    now = time.time()
+    written, backlog = runner.run(today, now)
+    if list(written) == [None] and backlog and store.list("123")[0]["proximo"] == "2025-01-31":
+        print("✅ Un destino que falla no avanza")
+    else:
+        print(f"❌ Primera corrida inesperada: {commits} {written}")
+
+    failing.clear()
+    runs = 0
+    while runner.run(today, now)[1]:
+        runs += 1
+    if all("123" not in batch for batch in commits[1:]) and runner.retry_at and runner.retry_at > now:
+        print("✅ El destino que falló espera antes de reintentarse, sin frenar al resto")
+    else:
+        print(f"❌ El destino que falló se reintentó enseguida: {commits}")
+
+    runner.run(today, runner.retry_at)
+    days = sorted(day for batch in commits[1:] for rows in batch.values() for day in rows)
+    expected = ["2025-01-31", "2025-02-28", "2025-03-27", "2025-03-31", "2025-04-03"]
+    if all(sum(map(len, batch.values())) <= 4 for batch in commits) and days == expected and runs == 0:
+        print("✅ Los vencidos se registran por lotes, una escritura por destino, y fin de mes se ajusta")
+    else:
+        print(f"❌ Instancias escritas: {commits}")
+
+    if runner.run(today, runner.retry_at or now) == ({}, False) and runner.written == 6 and runner.retry_at is None:
+        print("✅ Ninguna instancia se registra dos veces")
+    else:
+        print(f"❌ Estado tras ponerse al día: {runner.stats()}")
+
+def test_update_processor():
+    """Test that one chat's burst does not take the concurrency slots of other chats"""
+    print("\n🚦 Verificando el orden y la concurrencia por chat...")
+
+    from telegram import Chat, Message, Update
+    from update_processor import PerChatUpdateProcessor
+
+    def update(chat_id, update_id):
+        chat = Chat(chat_id, Chat.PRIVATE)
+        return Update(update_id, message=Message(update_id, datetime.now(), chat))
+
+    async def run():
+        processor = PerChatUpdateProcessor(max_concurrent_updates=2)
+        release = asyncio.Event()
+        order = []
+
+        async def handle(name, wait):
+            if wait:
+                await release.wait()
+            order.append(name)
+
+        burst = [asyncio.create_task(processor.process_update(update(1, n), handle(f"a{n}", True))) for n in range(5)]
+        await asyncio.sleep(0.05)
+        try:
+            await asyncio.wait_for(processor.process_update(update(2, 10), handle("b", False)), 1)
+        except asyncio.TimeoutError:
+            pass
+        release.set()
+        await asyncio.gather(*burst)
+        return order
+
+    order = asyncio.run(run())
+    if order and order[0] == "b":
+        print("✅ Otro chat se procesa mientras un chat tiene actualizaciones en cola")
+    else:
+        print(f"❌ Otro chat quedó bloqueado detrás de la ráfaga: {order}")
+
+    if [name for name in order if name != "b"] == [f"a{n}" for n in range(5)]:
+        print("✅ Las actualizaciones de un mismo chat se procesan en orden")
+    else:
+        print(f"❌ Orden dentro del chat: {order}")
+
+    async def limited():
+        processor = PerChatUpdateProcessor(max_concurrent_updates=2)
+        running = peak = 0
+        async def handle():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+        await asyncio.gather(*(processor.process_update(update(chat_id, chat_id), handle()) for chat_id in range(10)))
+        return peak
+
+    peak = asyncio.run(limited())
+    if peak == 2:
+        print("✅ No se procesan más actualizaciones a la vez que el límite")
+    else:
+        print(f"❌ Actualizaciones simultáneas: {peak} (límite 2)")
+
 def main():
     """Run all tests"""
     print("🚀 Iniciando pruebas del Bot de Gastos")
@@ -88,6 +916,25 @@ def main():
     test_environment()
     test_imports()
     test_keep_alive()
+    test_metric_shards()
+    test_api_validation()
+    test_lazy_import()
+    test_tenant_sheets()
+    test_idempotency()
+    test_export()
+    test_partitions()
+    test_mirror_append_race()
+    test_storage_backend()
+    test_skipped_tenants()
+    test_google_session()
+    test_log_pipeline()
+    test_budgets()
+    test_worker_budgets()
+    test_reply_scheduler()
+    test_recurring()
+    test_async_latency()
+    test_writer_timeout()
+    test_update_processor()
     
     print("\n" + "=" * 50)
     print("✅ Pruebas completadas")
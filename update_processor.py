@@ -0,0 +1,58 @@
+import asyncio
+from typing import Any, Awaitable, Dict
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Updates admitted by PTB's own limit at once; they only take one of the processor's
+# slots when their chat is free, so this is a memory bound, not the concurrency limit
+MAX_PENDING_UPDATES = 100_000
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently while keeping them in order within each chat.
+
+    Updates from different chats run in parallel (up to
+    ``max_concurrent_updates``); updates from the same chat wait for the
+    previous one to finish, so a user's expenses are logged and confirmed in
+    the order they were sent. Locks are dropped as soon as a chat has no
+    update in flight, so memory does not grow with the number of chats.
+
+    PTB admits updates through its own limit before ``do_process_update``, so
+    that limit is set to ``max_pending_updates`` and the real one is this
+    class's semaphore, taken after the chat's lock: updates queued behind
+    their chat never hold slots that other chats could use.
+    """
+
+    def __init__(self, max_concurrent_updates: int = 256, max_pending_updates: int = MAX_PENDING_UPDATES):
+        super().__init__(max(max_concurrent_updates, max_pending_updates))
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._waiting: Dict[int, int] = {}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        lock = self._locks.get(chat.id)
+        if lock is None:
+            lock = self._locks[chat.id] = asyncio.Lock()
+        self._waiting[chat.id] = self._waiting.get(chat.id, 0) + 1
+        try:
+            async with lock:
+                async with self._slots:
+                    await coroutine
+        finally:
+            self._waiting[chat.id] -= 1
+            if not self._waiting[chat.id]:
+                del self._waiting[chat.id]
+                del self._locks[chat.id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass